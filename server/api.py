@@ -1,21 +1,44 @@
+import asyncio
+import json
 import traceback
+import zlib
 from datetime import datetime
 from typing import Dict, List, Union
 from uuid import UUID
 
 import redis_mgr
-import tqdm
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, ORJSONResponse, Response, StreamingResponse
+from lib.chain_plan import (CONFIG_CHANNEL, CONFIG_PLAN_KEY,
+                            CONFIG_VERSION_KEY, get_stream_lists)
+from lib.chain_queue import (attempts_key_name, dead_letter_list_name,
+                             pop_stream, push_stream, queue_stream_add,
+                             stream_backlog)
+from lib.json_stream import JsonStreamError, iter_json_items
 from lib.logging_utils import init_logger
+from lib.pagination import cursor_datetime, decode_cursor, encode_cursor
+from lib.redis_cluster import (json_get, json_mget_raw, list_key,
+                               queue_json_set, scan_keys, vcon_id_from_key,
+                               vcon_key)
+from lib.vcon_cache import queue_version_incr
+from lib.vcon_expiry import get_expiry_stats, remove_vcons, run_expiry_reaper
+from lib.vcon_index import (add_to_sorted_set, created_at_timestamp,
+                            get_rebuild_progress, get_sorted_set_size,
+                            page_sorted_set, queue_sorted_set_add,
+                            range_sorted_set, rebuild_recently,
+                            search_vcons, start_rebuild,
+                            update_vcon_indexes, update_vcons_indexes)
 from load_config import load_config
 from main_loop import tick
-from peewee import CharField, Model
+from peewee import CharField, Model, Tuple
 from playhouse.postgres_ext import (BinaryJSONField, DateTimeField,
                                     PostgresqlExtDatabase, UUIDField)
-from pydantic import BaseModel
-from settings import (VCON_SORTED_FORCE_RESET, VCON_SORTED_SET_NAME,
+from pydantic import BaseModel, ValidationError
+from redis.commands.json.path import Path
+from settings import (VCON_INDEX_ENABLED, VCON_INGEST_MAX_ITEM_BYTES,
+                      VCON_REDIS_CHUNK_SIZE, VCON_SORTED_FORCE_RESET,
                       VCON_STORAGE)
 
 logger = init_logger(__name__)
@@ -68,7 +91,7 @@ if VCON_STORAGE:
 
 async def add_vcon_to_set(vcon_uuid: UUID, timestamp: int):
     r = redis_mgr.get_client()
-    await r.zadd(VCON_SORTED_SET_NAME, {vcon_uuid: timestamp})
+    await add_to_sorted_set(r, {vcon_uuid: timestamp})
 
 
 @app.on_event("startup")
@@ -86,48 +109,100 @@ async def startup_event():
         # Use a sorted set, with the created_at field as the score, so that we can
         # sort the results by date.  Convert the created_at field to a unix timestamp
         logger.info("Using redis database")
-        sorted_set = VCON_SORTED_SET_NAME
 
-        # On startup, iterate over all the vCon keys in the database, and add them to the sorted set
-        # This is a one-time operation, so we can do it synchronously
-        # CHeck to see if we need to reset the sorted set
+        # On startup, rebuild the sorted set from the vCon keys in the database.
+        # It runs in the background, while the API serves, and only one worker
+        # rebuilds at a time.
         r = redis_mgr.get_client()
-        if VCON_SORTED_FORCE_RESET == "true" or await r.zcard(sorted_set) == 0:
-            logger.info("Resetting the sorted set")
-            # Delete the sorted set
-            await r.delete(sorted_set)
-            vcon_keys = await r.keys("vcon:*")
+        if (VCON_SORTED_FORCE_RESET == "true" and not await rebuild_recently(r)) or await get_sorted_set_size(r) == 0:
+            logger.info("Rebuilding the sorted set in the background")
+            app.state.rebuild_task = start_rebuild(r)
 
-            logger.info("Adding {} vcons to the sorted set".format(len(vcon_keys)))
-            for vcon_key in tqdm.tqdm(vcon_keys):
-                vcon = await r.json().get(vcon_key)
-                # Convert the ISO string to a unix timestamp
-                created_at = datetime.fromisoformat(vcon["created_at"])
-                timestamp = int(created_at.timestamp())
-                await add_vcon_to_set(vcon_key, timestamp)
+        # Reap the vCons past their expiry along with their sorted set
+        # members and index entries
+        app.state.expiry_task = asyncio.create_task(run_expiry_reaper(r))
 
 
 @app.on_event("shutdown")
 async def shutdown():
     logger.info("event shutdown")
+    for name in ("rebuild_task", "expiry_task"):
+        task = getattr(app.state, name, None)
+        if task and not task.done():
+            task.cancel()
     await redis_mgr.shutdown_pool()
 
 
 # These are the vCon data models
+class VconPage(BaseModel):
+    uuids: List[str]
+    next_cursor: str = None
+
+
+def get_vcons_page_postgres(size, since, until, after):
+    """A keyset page of vCon UUIDs, most recent first, after the
+    (created_at, uuid) of after"""
+    query = VConPeeWee.select(VConPeeWee.uuid, VConPeeWee.created_at)
+    if since:
+        query = query.where(VConPeeWee.created_at > since)
+    if until:
+        query = query.where(VConPeeWee.created_at < until)
+    if after:
+        query = query.where(
+            Tuple(VConPeeWee.created_at, VConPeeWee.uuid) < Tuple(cursor_datetime(after[0]), after[1])
+        )
+    query = query.order_by(VConPeeWee.created_at.desc(), VConPeeWee.uuid.desc()).limit(size)
+    # The datetimes go into the cursors as is, a timestamp could lose microseconds
+    return [(vcon.created_at, str(vcon.uuid)) for vcon in query]
+
+
+async def get_vcons_page_redis(size, since, until, after):
+    """A keyset page of vCon UUIDs, most recent first, after the
+    (created_at timestamp, uuid) of after"""
+    r = redis_mgr.get_client()
+    page = await page_sorted_set(
+        r,
+        since=int(since.timestamp()) if since else None,
+        until=int(until.timestamp()) if until else None,
+        after=after,
+        count=size,
+    )
+    return [(score, vcon_id_from_key(member)) for member, score in page]
+
+
 @app.get(
     "/vcon",
-    response_model=List[str],
+    response_model=Union[List[str], VconPage],
     summary="Gets a list of vCon UUIDs",
     description=(
         "Enables pagination of vCon UUIDs. "
         "Use the page and size parameters to paginate the results. "
-        "Can also filter by date with the since and until parameters."
+        "Can also filter by date with the since and until parameters. "
+        "With the cursor parameter, empty for the first page, the response is "
+        "{uuids, next_cursor}, pass next_cursor as cursor for the next page. "
+        "Cursor pages cost the same however deep, and do not shift as vCons arrive."
     ),
     tags=["vcon"],
 )
 async def get_vcons(
-    page: int = 1, size: int = 50, since: datetime = None, until: datetime = None
+    page: int = 1,
+    size: int = 50,
+    since: datetime = None,
+    until: datetime = None,
+    cursor: str = None,
 ):
+    if cursor is not None:
+        try:
+            after = decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if VCON_STORAGE:
+            keys = get_vcons_page_postgres(size, since, until, after)
+        else:
+            keys = await get_vcons_page_redis(size, since, until, after)
+        next_cursor = encode_cursor(*keys[-1]) if keys and len(keys) == size else None
+        return JSONResponse(content={"uuids": [vcon_uuid for _, vcon_uuid in keys], "next_cursor": next_cursor})
+
     if VCON_STORAGE:
         offset = (page - 1) * size
         query = VConPeeWee.select()
@@ -151,50 +226,265 @@ async def get_vcons(
         if until:
             until_timestamp = int(until.timestamp())
         offset = (page - 1) * size
-        vcon_uuids = await r.zrevrangebyscore(
-            VCON_SORTED_SET_NAME,
-            until_timestamp,
-            since_timestamp,
-            start=offset,
-            num=size,
+        # Fans out to the shards of the sorted set on a cluster
+        vcon_uuids = await range_sorted_set(
+            r,
+            since=None if since_timestamp == "-inf" else since_timestamp,
+            until=None if until_timestamp == "+inf" else until_timestamp,
+            offset=offset,
+            count=size,
         )
 
         # Convert the vcon_uuids to strings and strip the vcon: prefix
-        vcon_uuids = [vcon.decode("utf-8").split(":")[1] for vcon in vcon_uuids]
+        vcon_uuids = [vcon_id_from_key(vcon) for vcon in vcon_uuids]
         return vcon_uuids
 
 
+def get_compressor(compression):
+    """Returns a streaming compressor, with compress and flush, and the media
+    type of its output, for the compression of an export"""
+    if not compression or compression == "none":
+        return None, "application/x-ndjson"
+    if compression == "gzip":
+        return zlib.compressobj(wbits=31), "application/gzip"
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise HTTPException(status_code=400, detail="zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor().compressobj(), "application/zstd"
+    raise HTTPException(status_code=400, detail="Unknown compression {}".format(compression))
+
+
+def export_postgres_chunk(since, until, after, count):
+    """A chunk of the vCons created between since and until, exclusive as
+    for GET /vcon, oldest first, after the (created_at, uuid) of after"""
+    query = VConPeeWee.select(VConPeeWee.uuid, VConPeeWee.created_at, VConPeeWee.vcon_json)
+    if since:
+        query = query.where(VConPeeWee.created_at > since)
+    if until:
+        query = query.where(VConPeeWee.created_at < until)
+    if after:
+        query = query.where(
+            Tuple(VConPeeWee.created_at, VConPeeWee.uuid) > Tuple(cursor_datetime(after[0]), after[1])
+        )
+    query = query.order_by(VConPeeWee.created_at, VConPeeWee.uuid).limit(count)
+    return [
+        (row.created_at, str(row.uuid), json.dumps(row.vcon_json).encode("utf-8"))
+        for row in query
+    ]
+
+
+async def export_redis_chunk(r, since, until, after, count):
+    """A chunk of the vCons created between the since and until timestamps,
+    oldest first, after the (created_at timestamp, uuid) of after, as the
+    JSON text stored in redis"""
+    page = await page_sorted_set(r, since, until, after=after, count=count, reverse=False)
+    if not page:
+        return []
+    replies = await json_mget_raw(r, [member for member, _ in page], Path.root_path())
+    return [
+        (score, vcon_id_from_key(member), reply)
+        for (member, score), reply in zip(page, replies)
+    ]
+
+
+# Declared before /vcon/{vcon_uuid}, which would otherwise match it
 @app.get(
-    "/vcon/{vcon_uuid}",
-    response_model=Vcon,
-    summary="Gets a particular vCon by UUID",
-    description="How to get a particular vCon by UUID",
+    "/vcon/export",
+    status_code=200,
+    summary="Exports the vCons created over a time range",
+    description=(
+        "Streams the vCons created between since and until, oldest first, as "
+        "NDJSON, optionally gzip or zstd compressed. The vCons are read "
+        "VCON_REDIS_CHUNK_SIZE at a time, so memory stays bounded. With limit, "
+        "the export stops after that many vCons and, if there may be more, "
+        "ends with a {\"next_cursor\": ...} line; pass it as cursor to resume."
+    ),
     tags=["vcon"],
 )
-async def get_vcon(vcon_uuid: UUID):
-    if VCON_STORAGE:
-        q = VConPeeWee.select().where(VConPeeWee.uuid == vcon_uuid)
-        r = q.get()
-        # If we didn't find the vcon, return a 404, otherwise return the vcon
-        if r is None:
-            return JSONResponse(status_code=404)
-        else:
-            return JSONResponse(content=r.vcon_json)
+async def get_vcon_export(
+    since: datetime = None,
+    until: datetime = None,
+    format: str = "ndjson",
+    compression: str = None,
+    cursor: str = None,
+    limit: int = None,
+):
+    if format != "ndjson":
+        raise HTTPException(status_code=400, detail="Only the ndjson format is supported")
+    if limit is not None and limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    compressor, media_type = get_compressor(compression)
+
+    async def export_lines():
+        exported = 0
+        position = after
+        while limit is None or exported < limit:
+            count = VCON_REDIS_CHUNK_SIZE if limit is None else min(VCON_REDIS_CHUNK_SIZE, limit - exported)
+            if VCON_STORAGE:
+                # peewee is synchronous, keep its queries off the event loop
+                chunk = await run_in_threadpool(export_postgres_chunk, since, until, position, count)
+            else:
+                chunk = await export_redis_chunk(
+                    redis_mgr.get_client(),
+                    since.timestamp() if since else None,
+                    until.timestamp() if until else None,
+                    position,
+                    count,
+                )
+            # vCons gone since they were listed are skipped
+            yield b"".join(data + b"\n" for _, _, data in chunk if data)
+            exported += len(chunk)
+            if len(chunk) < count:
+                return
+            position = chunk[-1][:2]
+        yield json.dumps({"next_cursor": encode_cursor(*position)}).encode("utf-8") + b"\n"
+
+    async def stream():
+        try:
+            async for data in export_lines():
+                if compressor:
+                    data = compressor.compress(data)
+                if data:
+                    yield data
+        except Exception:
+            # The status is already sent, the truncated export tells the
+            # client something went wrong
+            logger.info(traceback.format_exc())
+            return
+        if compressor:
+            yield compressor.flush()
+
+    return StreamingResponse(stream(), media_type=media_type)
 
-    # Redis is storing the vCons. Use the vcons sorted set to get the vCon UUIDs
+
+# Declared before /vcon/{vcon_uuid}, which would otherwise match it
+@app.get(
+    "/vcon/search",
+    response_model=List[str],
+    summary="Searches vCon UUIDs by party, dialog or analysis",
+    description=(
+        "Returns the UUIDs of the vCons matching all the given criteria, "
+        "most recently created first, using the secondary indexes. "
+        "Needs VCON_INDEX_ENABLED. Can also filter by date with the since "
+        "and until parameters."
+    ),
+    tags=["vcon"],
+)
+async def get_vcon_search(
+    tel: str = None,
+    mailto: str = None,
+    dialog_type: str = None,
+    analysis_type: str = None,
+    vendor: str = None,
+    since: datetime = None,
+    until: datetime = None,
+    limit: int = 50,
+):
+    if VCON_STORAGE or not VCON_INDEX_ENABLED:
+        raise HTTPException(status_code=501, detail="The vCon indexes are not enabled")
+    criteria = {
+        "tel": tel,
+        "mailto": mailto,
+        "dialog_type": dialog_type,
+        "analysis_type": analysis_type,
+        "vendor": vendor,
+    }
     try:
         r = redis_mgr.get_client()
-        vcon = await r.json().get(f"vcon:{str(vcon_uuid)}")
+        return await search_vcons(
+            r,
+            criteria,
+            since=int(since.timestamp()) if since else None,
+            until=int(until.timestamp()) if until else None,
+            limit=limit,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception:
         logger.info(traceback.format_exc())
-        return None
+        raise HTTPException(status_code=500)
+
+
+@app.get(
+    "/vcon/{vcon_uuid}",
+    responses={200: {"model": Vcon}},
+    summary="Gets a particular vCon by UUID",
+    description="How to get a particular vCon by UUID",
+    tags=["vcon"],
+)
+async def get_vcon(vcon_uuid: UUID):
+    # The JSON text of the vCon is passed through as stored, neither parsed
+    # nor validated against the Vcon model, which costs more than the read
+    # itself on vCons of several MB
+    if VCON_STORAGE:
+        q = VConPeeWee.select(VConPeeWee.vcon_json.cast("text")).where(VConPeeWee.uuid == vcon_uuid)
+        vcon = q.scalar()
+    else:
+        # Redis is storing the vCons, JSON.GET without a path replies with the
+        # JSON text, which r.json().get would parse
+        try:
+            r = redis_mgr.get_client()
+            vcon = await r.execute_command("JSON.GET", vcon_key(str(vcon_uuid)))
+        except Exception:
+            logger.info(traceback.format_exc())
+            return None
     logger.debug(
         "Returning whole vcon for {} found: {}".format(vcon_uuid, vcon is not None)
     )
     if vcon is None:
         return JSONResponse(content=None, status_code=404)
     else:
-        return JSONResponse(content=vcon)
+        return Response(content=vcon, media_type="application/json")
+
+
+@app.post(
+    "/vcon/batch_get",
+    status_code=200,
+    summary="Gets many vCons by UUID",
+    description=(
+        "Returns a JSON array of the vCons with the given UUIDs, in the same "
+        "order, null for a vCon that is not found. The vCons are fetched "
+        "VCON_REDIS_CHUNK_SIZE at a time and the response is streamed."
+    ),
+    tags=["vcon"],
+)
+async def post_vcon_batch_get(vcon_uuids: List[UUID]):
+    vcon_uuids = [str(vcon_uuid) for vcon_uuid in vcon_uuids]
+
+    async def fetch_chunks():
+        for start in range(0, len(vcon_uuids), VCON_REDIS_CHUNK_SIZE):
+            chunk = vcon_uuids[start:start + VCON_REDIS_CHUNK_SIZE]
+            if VCON_STORAGE:
+                query = VConPeeWee.select().where(VConPeeWee.uuid.in_(chunk))
+                found = {str(row.uuid): json.dumps(row.vcon_json) for row in query}
+                yield [found.get(vcon_uuid) for vcon_uuid in chunk]
+            else:
+                r = redis_mgr.get_client()
+                # The JSON text straight from redis, without parsing it
+                replies = await json_mget_raw(r, [vcon_key(vcon_uuid) for vcon_uuid in chunk], Path.root_path())
+                yield [reply.decode("utf-8") if reply else None for reply in replies]
+
+    async def stream():
+        separator = "["
+        try:
+            async for vcons in fetch_chunks():
+                for vcon in vcons:
+                    yield separator + (vcon or "null")
+                    separator = ","
+        except Exception:
+            # The status is already sent, the truncated array tells the
+            # client something went wrong
+            logger.info(traceback.format_exc())
+            return
+        yield "[]" if separator == "[" else "]"
+
+    return StreamingResponse(stream(), media_type="application/json")
 
 
 @app.post(
@@ -224,30 +514,177 @@ async def post_vcon(inbound_vcon: Vcon):
             type=type,
             vcon_json=vcon_json,
         )
-        return JSONResponse(content=inbound_vcon.dict(), status_code=201)
+        return ORJSONResponse(content=inbound_vcon.dict(), status_code=201)
     else:
         try:
             r = redis_mgr.get_client()
             dict_vcon = inbound_vcon.dict()
             dict_vcon["uuid"] = str(inbound_vcon.uuid)
-            key = f"vcon:{str(dict_vcon['uuid'])}"
-            created_at = datetime.fromisoformat(dict_vcon["created_at"])
-            timestamp = int(created_at.timestamp())
+            key = vcon_key(dict_vcon["uuid"])
+            timestamp = created_at_timestamp(dict_vcon["created_at"])
 
             # Store the vcon in redis
             logger.debug(
                 "Posting vcon  {} len {}".format(inbound_vcon.uuid, len(dict_vcon))
             )
-            await r.json().set(key, "$", dict_vcon)
+            # Invalidate the copies cached by the workers
+            async with r.pipeline(transaction=False) as pipe:
+                queue_json_set(pipe, key, "$", dict_vcon)
+                queue_version_incr(pipe, dict_vcon["uuid"])
+                await pipe.execute()
             # Add the vcon to the sorted set
             logger.debug("Adding vcon {} to sorted set".format(inbound_vcon.uuid))
             await add_vcon_to_set(key, timestamp)
+            await update_vcon_indexes(r, dict_vcon)
         except Exception:
             # Print all of the details of the exception
             logger.info(traceback.format_exc())
             return None
         logger.debug("Posted vcon  {} len {}".format(inbound_vcon.uuid, len(dict_vcon)))
-        return JSONResponse(content=dict_vcon, status_code=201)
+        return ORJSONResponse(content=dict_vcon, status_code=201)
+
+
+async def store_vcon_batch(r, batch, ingress_list=None):
+    """Store a batch of validated vCons, add them to the sorted set and
+    optionally enqueue them on an ingress list, in a single pipeline.
+
+    Args:
+        batch (list): (index in the request, vCon dict) tuples
+        ingress_list (str): ingress list to push the UUIDs to
+
+    Returns:
+        list: the status of each vCon
+    """
+    statuses = []
+    # The created_at of each vCon is checked before anything is queued, so
+    # one that cannot be scored fails alone
+    valid = []
+    members = {}
+    for index, dict_vcon in batch:
+        try:
+            timestamp = created_at_timestamp(dict_vcon["created_at"])
+        except (TypeError, ValueError) as e:
+            statuses.append({"index": index, "uuid": dict_vcon["uuid"], "status": 422, "error": f"created_at: {e}"})
+            continue
+        valid.append((index, dict_vcon))
+        members[vcon_key(dict_vcon["uuid"])] = timestamp
+    if not valid:
+        return statuses
+
+    # Replies per vCon, its JSON.SET and, with the cache on, its version INCR
+    replies_per_vcon = 1
+    try:
+        async with r.pipeline(transaction=False) as pipe:
+            for _, dict_vcon in valid:
+                pipe.execute_command("JSON.SET", vcon_key(dict_vcon["uuid"]), "$", json.dumps(dict_vcon))
+                if queue_version_incr(pipe, dict_vcon["uuid"]):
+                    replies_per_vcon = 2
+            queue_sorted_set_add(pipe, members)
+            if ingress_list:
+                vcon_uuids = [dict_vcon["uuid"] for _, dict_vcon in valid]
+                if await is_stream_list(r, ingress_list):
+                    queue_stream_add(pipe, ingress_list, vcon_uuids)
+                else:
+                    pipe.lpush(list_key(ingress_list), *vcon_uuids)
+            results = await pipe.execute(raise_on_error=False)
+    except Exception as e:
+        logger.info("Error: {}".format(e))
+        statuses.extend(
+            {"index": index, "uuid": dict_vcon["uuid"], "status": 500, "error": str(e)} for index, dict_vcon in valid
+        )
+        return sorted(statuses, key=lambda status: status["index"])
+
+    stored = []
+    for position, (index, dict_vcon) in enumerate(valid):
+        replies = results[position * replies_per_vcon:(position + 1) * replies_per_vcon]
+        error = next((reply for reply in replies if isinstance(reply, Exception)), None)
+        if error:
+            statuses.append({"index": index, "uuid": dict_vcon["uuid"], "status": 500, "error": str(error)})
+        else:
+            statuses.append({"index": index, "uuid": dict_vcon["uuid"], "status": 201})
+            stored.append((statuses[-1], dict_vcon))
+    for result in results[len(valid) * replies_per_vcon:]:
+        if isinstance(result, Exception):
+            logger.error("Error adding a batch of vCons to the sorted set or ingress list: %s", result)
+    # The vCons are stored, an error indexing one is only reported with it
+    index_errors = await update_vcons_indexes(r, [dict_vcon for _, dict_vcon in stored])
+    for (status, _), error in zip(stored, index_errors):
+        if error is not None:
+            status["index_error"] = str(error)
+    return sorted(statuses, key=lambda status: status["index"])
+
+
+def store_vcon_batch_postgres(batch):
+    """Insert a batch of validated vCons in a single INSERT"""
+    rows = [
+        {
+            "id": dict_vcon["uuid"],
+            "uuid": dict_vcon["uuid"],
+            "vcon": dict_vcon["vcon"],
+            "created_at": dict_vcon["created_at"],
+            "subject": dict_vcon.get("subject"),
+            "vcon_json": dict_vcon,
+        }
+        for _, dict_vcon in batch
+    ]
+    try:
+        VConPeeWee.insert_many(rows).execute()
+    except Exception as e:
+        logger.info("Error: {}".format(e))
+        return [{"index": index, "uuid": dict_vcon["uuid"], "status": 500, "error": str(e)} for index, dict_vcon in batch]
+    return [{"index": index, "uuid": dict_vcon["uuid"], "status": 201} for index, dict_vcon in batch]
+
+
+@app.post(
+    "/vcons",
+    status_code=200,
+    summary="Inserts many vCons into the database",
+    description=(
+        "Takes a stream of vCons, as NDJSON or a JSON array, parsed as the "
+        "body arrives, and stores them in pipelined batches. With ingress_list "
+        "the UUIDs are also pushed to that ingress list. Returns an NDJSON "
+        "line per vCon with its index in the body, UUID and status: 201 stored, "
+        "400 not JSON, 422 not a valid vCon or 500 not stored. A stored vCon "
+        "that could not be added to the search indexes has an index_error."
+    ),
+    tags=["vcon"],
+)
+async def post_vcons(request: Request, ingress_list: str = None):
+    async def store(batch):
+        if VCON_STORAGE:
+            return store_vcon_batch_postgres(batch)
+        return await store_vcon_batch(redis_mgr.get_client(), batch, ingress_list)
+
+    # The body is read here, before the response is started: a streaming
+    # response also listens for the client disconnecting, which would take
+    # chunks of the body from under the parser
+    statuses = []
+    batch = []
+    try:
+        async for index, item in iter_json_items(request.stream(), VCON_INGEST_MAX_ITEM_BYTES):
+            if isinstance(item, Exception):
+                statuses.append({"index": index, "status": 400, "error": str(item)})
+                continue
+            try:
+                inbound_vcon = Vcon.parse_obj(item)
+            except ValidationError as e:
+                statuses.append({"index": index, "status": 422, "error": str(e)})
+                continue
+            dict_vcon = inbound_vcon.dict()
+            dict_vcon["uuid"] = str(inbound_vcon.uuid)
+            batch.append((index, dict_vcon))
+            if len(batch) >= VCON_REDIS_CHUNK_SIZE:
+                statuses.extend(await store(batch))
+                batch = []
+    except JsonStreamError as e:
+        statuses.append({"status": 400, "error": str(e)})
+    if batch:
+        statuses.extend(await store(batch))
+
+    return Response(
+        content="".join(json.dumps(status) + "\n" for status in statuses),
+        media_type="application/x-ndjson",
+    )
 
 
 @app.delete(
@@ -261,13 +698,24 @@ async def delete_vcon(vcon_uuid: UUID):
     # FIX: support the VCON_STORAGE case
     try:
         r = redis_mgr.get_client()
-        await r.json().delete(f"vcon:{str(vcon_uuid)}")
+        # Also removes it from the sorted set, the indexes and the expiry set
+        await remove_vcons(r, [str(vcon_uuid)])
     except Exception:
         # Print all of the details of the exception
         logger.info(traceback.format_exc())
         raise HTTPException(status_code=500)
 
 
+async def is_stream_list(r, list_name):
+    """True if the list is carried by a stream, being an ingress or egress
+    list of a chain with "transport" set to "stream"."""
+    return list_name in await get_stream_lists(r)
+
+
+# The /vcon/egress readers of a stream egress list share this consumer group
+EGRESS_GROUP = "egress"
+
+
 # Ingress and egress endpoints for vCon IDs
 # Create an endpoint to push vcon IDs to one or more redis lists
 @app.post(
@@ -280,8 +728,11 @@ async def delete_vcon(vcon_uuid: UUID):
 async def post_vcon_ingress(vcon_uuids: List[str], ingress_list: str):
     try:
         r = redis_mgr.get_client()
+        if await is_stream_list(r, ingress_list):
+            await push_stream(r, ingress_list, vcon_uuids)
+            return
         for vcon_uuid in vcon_uuids:
-            await r.lpush(ingress_list, vcon_uuid)
+            await r.lpush(list_key(ingress_list), vcon_uuid)
     except Exception as e:
         logger.info("Error: {}".format(e)) 
         raise HTTPException(status_code=500)
@@ -298,9 +749,12 @@ async def post_vcon_ingress(vcon_uuids: List[str], ingress_list: str):
 async def get_vcon_egress(egress_list: str, limit=1):
     try:
         r = redis_mgr.get_client()
+        if await is_stream_list(r, egress_list):
+            vcon_uuids = await pop_stream(r, egress_list, EGRESS_GROUP, "api", int(limit))
+            return JSONResponse(content=vcon_uuids)
         vcon_uuids = []
         for i in range(limit):
-            vcon_uuid = await r.rpop(egress_list)
+            vcon_uuid = await r.rpop(list_key(egress_list))
             if vcon_uuid:
                 vcon_uuids.append(vcon_uuid)
         return JSONResponse(content=vcon_uuids)
@@ -321,7 +775,10 @@ async def get_vcon_egress(egress_list: str, limit=1):
 async def get_vcon_count(egress_list: str):
     try:
         r = redis_mgr.get_client()
-        count = await r.llen(egress_list)
+        if await is_stream_list(r, egress_list):
+            count = await stream_backlog(r, egress_list, EGRESS_GROUP)
+        else:
+            count = await r.llen(list_key(egress_list))
         return JSONResponse(content=count)
 
     except Exception as e:
@@ -329,6 +786,114 @@ async def get_vcon_count(egress_list: str):
         raise HTTPException(status_code=500)
 
 
+@app.get(
+    "/index/rebuild",
+    status_code=200,
+    summary="Returns the progress of the vCon sorted set rebuild",
+    description=(
+        "Returns the status (running, done or failed), the vCons scanned and "
+        "indexed and the stale members removed by the last rebuild of the "
+        "vCon sorted set."
+    ),
+    tags=["vcon"],
+)
+async def get_index_rebuild():
+    try:
+        r = redis_mgr.get_client()
+        return JSONResponse(content=await get_rebuild_progress(r))
+
+    except Exception as e:
+        logger.info("Error: {}".format(e))
+        raise HTTPException(status_code=500)
+
+
+@app.get(
+    "/index/expiry",
+    status_code=200,
+    summary="Returns the counts of expired vCons reaped",
+    description=(
+        "Returns the vCons scheduled to expire and overdue, and the counts of "
+        "vCons, sorted set members and index entries reaped so far."
+    ),
+    tags=["vcon"],
+)
+async def get_index_expiry():
+    try:
+        r = redis_mgr.get_client()
+        return JSONResponse(content=await get_expiry_stats(r))
+
+    except Exception as e:
+        logger.info("Error: {}".format(e))
+        raise HTTPException(status_code=500)
+
+
+# Endpoints to inspect and replay the vCons that failed too many times
+# on the ingress list of a reliable chain
+@app.get(
+    "/dead_letter",
+    status_code=200,
+    summary="Returns the vCon UUIDs on the dead letter list of an ingress list",
+    description=(
+        "Returns the vCon UUIDs on the dead letter list of an ingress list, "
+        "most recently failed first."
+    ),
+    tags=["chain"],
+)
+async def get_dead_letter(ingress_list: str, start: int = 0, limit: int = 100):
+    try:
+        r = redis_mgr.get_client()
+        vcon_uuids = await r.lrange(dead_letter_list_name(ingress_list), start, start + limit - 1)
+        return JSONResponse(content=[vcon_uuid.decode("utf-8") for vcon_uuid in vcon_uuids])
+
+    except Exception as e:
+        logger.info("Error: {}".format(e))
+        raise HTTPException(status_code=500)
+
+
+@app.post(
+    "/dead_letter/replay",
+    status_code=200,
+    summary="Moves vCon UUIDs from the dead letter list back onto the ingress list",
+    description=(
+        "Moves up to limit vCon UUIDs, oldest first, from the dead letter list "
+        "back onto the ingress list with their attempts reset. "
+        "Returns the UUIDs replayed."
+    ),
+    tags=["chain"],
+)
+async def post_dead_letter_replay(ingress_list: str, limit: int = 100):
+    try:
+        r = redis_mgr.get_client()
+        vcon_uuids = []
+        if await is_stream_list(r, ingress_list):
+            # Entries are XADDed again, the new entries start with no deliveries.
+            # The UUIDs only leave the dead letter list once pushed, so a failed
+            # push loses none of them.
+            dead_letter_list = dead_letter_list_name(ingress_list)
+            vcon_uuids = [
+                vcon_uuid.decode("utf-8") for vcon_uuid in reversed(await r.lrange(dead_letter_list, -limit, -1))
+            ]
+            if vcon_uuids:
+                await push_stream(r, ingress_list, vcon_uuids)
+                async with r.pipeline(transaction=False) as pipe:
+                    for vcon_uuid in vcon_uuids:
+                        pipe.lrem(dead_letter_list, -1, vcon_uuid)
+                    await pipe.execute()
+            return JSONResponse(content=vcon_uuids)
+        for i in range(limit):
+            vcon_uuid = await r.lmove(dead_letter_list_name(ingress_list), list_key(ingress_list), "RIGHT", "LEFT")
+            if not vcon_uuid:
+                break
+            vcon_uuids.append(vcon_uuid.decode("utf-8"))
+        if vcon_uuids:
+            await r.hdel(attempts_key_name(ingress_list), *vcon_uuids)
+        return JSONResponse(content=vcon_uuids)
+
+    except Exception as e:
+        logger.info("Error: {}".format(e))
+        raise HTTPException(status_code=500)
+
+
 @app.get(
     "/config",
     status_code=200,
@@ -339,7 +904,7 @@ async def get_vcon_count(egress_list: str):
 async def get_config():
     try:
         r = redis_mgr.get_client()
-        config = await r.json().get("config")
+        config = await json_get(r, "config")
         return JSONResponse(content=config)
 
     except Exception as e:
@@ -376,18 +941,16 @@ async def delete_config():
     try:
         r = redis_mgr.get_client()
         await r.delete("config")
-        # Delete the links
-        links = await r.keys("link:*")
-        for link in links:
-            await r.delete(link)
-        # Delete the storages
-        storages = await r.keys("storage:*")
-        for storage in storages:
-            await r.delete(storage)
-        # Delete the chains
-        chains = await r.keys("chain:*")
-        for chain in chains:
-            await r.delete(chain)
+        # Delete the links, storages and chains, SCANning rather than
+        # using KEYS, on every node of a cluster
+        for pattern in ("link:*", "storage:*", "chain:*"):
+            async for keys in scan_keys(r, pattern):
+                for key in keys:
+                    await r.delete(key)
+        # Let the workers know the plan is gone
+        await r.delete(CONFIG_PLAN_KEY)
+        version = await r.incr(CONFIG_VERSION_KEY)
+        await r.publish(CONFIG_CHANNEL, version)
 
     except Exception as e:
         logger.info("Error: {}".format(e))
@@ -4,6 +4,7 @@ from playhouse.reflection import generate_models, print_model, print_table_sql
 import asyncio
 import json
 from lib.logging_utils import init_logger
+from lib.redis_cluster import vcon_key
 import server.redis_mgr
 
 logger = init_logger(__name__)
@@ -47,7 +48,7 @@ async def start(opts=default_options):
                     logger.debug("mongo plugin: message: {}".format(message))
                     vConUuid = message["data"].decode("utf-8")
                     logger.info("mongo plugin: received vCon: {}".format(vConUuid))
-                    body = await r.get("vcon:{}".format(str(vConUuid)))
+                    body = await r.get(vcon_key(str(vConUuid)))
                     vCon = json.loads(body)
                     for analysis in body["analysis"]:
                         if analysis["kind"] == "projection":
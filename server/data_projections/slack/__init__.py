@@ -2,6 +2,7 @@ import vcon
 from redis.commands.json.path import Path
 import asyncio
 from lib.logging_utils import init_logger
+from lib.redis_cluster import json_get, vcon_key
 from settings import SLACK_TOKEN
 import simplejson as json
 import copy
@@ -72,7 +73,7 @@ async def run(
     global header_block, divider_block, context_block, keywords_block, summary_block, actions_block, action_element
 
     r = server.redis_mgr.get_client()
-    inbound_vcon = await r.json().get(f"vcon:{str(vcon_uuid)}", Path.root_path())
+    inbound_vcon = await json_get(r, vcon_key(str(vcon_uuid)), Path.root_path())
     vCon = vcon.Vcon()
     vCon.loads(json.dumps(inbound_vcon))
 
@@ -0,0 +1,202 @@
+"""
+In memory plan of the chains, links and storages configured by load_config.
+
+load_config compiles the config into a single JSON document stored under
+CONFIG_PLAN_KEY, bumps CONFIG_VERSION_KEY and publishes the new version on
+CONFIG_CHANNEL.  Workers keep the compiled plan, with the link and storage
+modules already imported, and only go back to redis when the version changes,
+rather than looking up every chain, link and storage for every vCon.
+"""
+import asyncio
+import importlib
+from lib.executors import get_executor_name
+from lib.logging_utils import init_logger
+from lib.redis_cluster import json_get
+from settings import EXECUTOR_THREADS, REDIS_CLUSTER
+
+logger = init_logger(__name__)
+
+CONFIG_PLAN_KEY = "config_plan"
+CONFIG_VERSION_KEY = "config_version"
+CONFIG_CHANNEL = "config_updates"
+
+_plan = None
+# (config version, stream_lists) of the plan, for get_stream_lists
+_stream_lists = None
+
+
+def compile_plan(config, version):
+    """Build the JSON serializable plan from a parsed config file.
+
+    Args:
+        config (dict): the config, as loaded from the YAML config file
+        version (int): version number of this config
+
+    Returns:
+        dict: the chains, links and storages of the config
+    """
+    links = config.get("links") or {}
+    storages = config.get("storages") or {}
+    chains = {}
+    # Ingress and egress lists carried by a stream rather than a list, known
+    # without importing the modules of the chains
+    stream_lists = set()
+    for chain_name, chain in (config.get("chains") or {}).items():
+        for link_name in chain.get("links", []):
+            if link_name not in links:
+                logger.error("Chain %s uses unknown link %s", chain_name, link_name)
+        for storage_name in chain.get("storages", []):
+            if storage_name not in storages:
+                logger.error("Chain %s uses unknown storage %s", chain_name, storage_name)
+        chains[chain_name] = chain
+        if chain.get("transport", "list") == "stream":
+            stream_lists.update(chain.get("ingress_lists", []))
+            stream_lists.update(chain.get("egress_lists", []))
+
+    return {
+        "version": version,
+        "links": links,
+        "storages": storages,
+        "chains": chains,
+        "stream_lists": sorted(stream_lists),
+    }
+
+
+class PlanStep:
+    """A link or storage of a chain, with its module imported"""
+
+    def __init__(self, name, config, default_options=False, thread_pool=None):
+        self.name = name
+        self.config = config
+        self.module_name = config["module"]
+        self.module = importlib.import_module(self.module_name)
+        if default_options:
+            self.options = config.get("options", getattr(self.module, "default_options", None))
+        else:
+            self.options = config.get("options")
+        self.executor = get_executor_name(config, self.module)
+        # Sections a read only link loads, see VconRedis.get_vcon
+        self.vcon_paths = config.get("vcon_paths", getattr(self.module, "vcon_paths", None))
+        if self.vcon_paths and self.executor == "process":
+            # A PartialVcon cannot be sent to a process as JSON
+            raise ValueError(f"{name} sets vcon_paths, it cannot run on the process executor")
+        # Name and threads of the pool it runs on with the thread executor, a
+        # pool of its own has "threads" threads
+        if thread_pool:
+            self.thread_pool = (thread_pool, int(config.get("threads", EXECUTOR_THREADS)))
+        else:
+            self.thread_pool = ("default", EXECUTOR_THREADS)
+
+
+class PlanChain:
+    """A chain of the plan with its links and storages resolved"""
+
+    def __init__(self, name, config, links, storages):
+        self.name = name
+        self.config = config
+        self.links = links
+        self.storages = storages
+        self.ingress_lists = config.get("ingress_lists", [])
+        self.egress_lists = config.get("egress_lists", [])
+        # "list" or "stream", see lib.chain_queue
+        self.transport = config.get("transport", "list")
+
+    def get(self, key, default=None):
+        return self.config.get(key, default)
+
+
+class ChainPlan:
+    """The compiled plan for one version of the config"""
+
+    def __init__(self, plan):
+        self.version = plan.get("version", 0)
+        self.chains = {}
+        # Ingress and egress lists carried by a stream rather than a list,
+        # those of a chain that cannot be loaded included
+        self.stream_lists = set(plan.get("stream_lists", []))
+        links = {}
+        storages = {}
+        for chain_name, chain in plan.get("chains", {}).items():
+            try:
+                chain_links = []
+                for link_name in chain.get("links", []):
+                    if link_name not in links:
+                        links[link_name] = PlanStep(link_name, plan["links"][link_name])
+                    chain_links.append(links[link_name])
+                chain_storages = []
+                for storage_name in chain.get("storages", []):
+                    if storage_name not in storages:
+                        storages[storage_name] = PlanStep(
+                            storage_name, plan["storages"][storage_name], default_options=True,
+                            thread_pool=f"storage:{storage_name}",
+                        )
+                    chain_storages.append(storages[storage_name])
+            except Exception:
+                logger.exception("Cannot load chain %s, skipping it", chain_name)
+                continue
+            self.chains[chain_name] = PlanChain(chain_name, chain, chain_links, chain_storages)
+
+
+async def get_config_version(r):
+    version = await r.get(CONFIG_VERSION_KEY)
+    return int(version) if version else 0
+
+
+async def get_plan(r):
+    """Returns the current plan, only reloading it from redis when the
+    config version has changed since it was last loaded.
+    """
+    global _plan
+    version = await get_config_version(r)
+    if _plan is None or _plan.version != version:
+        plan = await json_get(r, CONFIG_PLAN_KEY)
+        _plan = ChainPlan(plan or {})
+        logger.info("Loaded config plan version %s with chains %s", _plan.version, list(_plan.chains))
+    return _plan
+
+
+async def get_stream_lists(r):
+    """Returns the lists carried by a stream, read from the stored plan
+    without importing any link or storage module, e.g. for the API, only
+    reloaded when the config version has changed."""
+    global _stream_lists
+    version = await get_config_version(r)
+    if _stream_lists is None or _stream_lists[0] != version:
+        reply = await json_get(r, CONFIG_PLAN_KEY, "$.stream_lists")
+        _stream_lists = (version, set(reply[0]) if reply else set())
+    return _stream_lists[1]
+
+
+async def wait_for_plan_change(r, version, stop_event, poll_interval=5):
+    """Wait until the config version differs from version.
+
+    Listens for the notifications published by load_config, and polls the
+    version key every poll_interval seconds in case a notification was missed.
+
+    Returns:
+        bool: True if the version changed, False if stop_event was set first
+    """
+    if REDIS_CLUSTER:
+        # The cluster client has no pub/sub, only poll
+        pubsub = None
+    else:
+        pubsub = r.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(CONFIG_CHANNEL)
+    try:
+        loop = asyncio.get_running_loop()
+        next_poll = loop.time() + poll_interval
+        while not stop_event.is_set():
+            if pubsub:
+                message = await pubsub.get_message(timeout=1.0)
+            else:
+                message = None
+                await asyncio.sleep(1.0)
+            if message or loop.time() >= next_poll:
+                if await get_config_version(r) != version:
+                    return True
+                next_poll = loop.time() + poll_interval
+        return False
+    finally:
+        if pubsub:
+            await pubsub.unsubscribe(CONFIG_CHANNEL)
+            await pubsub.close()
@@ -0,0 +1,439 @@
+"""
+Queues the conserver consumes the vCon UUIDs of a chain ingress list from.
+
+ListQueue pops the UUID off the ingress list, so a vCon is lost if the worker
+dies or the chain raises before it is done.
+
+ReliableQueue gives at least once processing.  The UUID is atomically moved
+to a processing list owned by the worker and recorded in an in flight sorted
+set scored by its visibility deadline.  It is only removed once the chain is
+done with it.  A vCon that fails, or is not acknowledged before its deadline,
+is put back on the ingress list, until it has been attempted max_attempts
+times, then it is parked on the dead letter list of the ingress list.
+
+StreamQueue is the Redis Streams transport of chains with "transport" set to
+"stream".  The ingress list is a stream the UUIDs are XADDed to, read by a
+consumer group named after the chain, so the workers of every conserver node
+share the entries, and every chain reading the stream gets all of them.  An
+entry stays pending until the chain is done with it and XACKs it, entries
+pending for longer than the visibility timeout are XAUTOCLAIMed by another
+consumer, and parked on the dead letter list after max_attempts deliveries.
+Acknowledged entries stay in the stream, trimmed to about STREAM_MAXLEN, so
+they can be replayed.
+
+The queues hand out vCon UUIDs in batches taken in a single round trip, the
+batch size being fixed or, with "auto", driven by the depth of the list.
+"""
+import time
+from redis.exceptions import ResponseError
+from lib.listen_list import listen_list
+from lib.logging_utils import init_logger
+from lib.redis_cluster import list_key, pipeline
+from settings import STREAM_MAXLEN
+
+logger = init_logger(__name__)
+
+
+def auto_batch_size(depth, max_batch_size):
+    """Batch size for a list depth: one at a time while the list is short,
+    growing up to max_batch_size as a backlog builds up."""
+    return max(1, min(max_batch_size, depth // 10))
+
+
+def dead_letter_list_name(ingress_list):
+    return f"{list_key(ingress_list)}:dead_letter"
+
+
+def attempts_key_name(ingress_list):
+    return f"{list_key(ingress_list)}:attempts"
+
+
+def stream_name(list_name):
+    """The stream of an ingress or egress list, kept apart from the list so
+    a chain can switch transport"""
+    return f"{list_key(list_name)}:stream"
+
+
+def queue_stream_add(pipe, list_name, vcon_ids):
+    """Queue on pipe the XADDs of the UUIDs to the stream of a list"""
+    for vcon_id in vcon_ids:
+        pipe.xadd(stream_name(list_name), {"vcon_uuid": vcon_id}, maxlen=STREAM_MAXLEN, approximate=True)
+
+
+async def push_stream(r, list_name, vcon_ids):
+    """XADD the UUIDs to the stream of a list, in a single round trip"""
+    async with r.pipeline(transaction=False) as pipe:
+        queue_stream_add(pipe, list_name, vcon_ids)
+        await pipe.execute()
+
+
+async def create_group(r, list_name, group):
+    """Create the consumer group, and the stream, if they do not exist yet"""
+    try:
+        await r.xgroup_create(stream_name(list_name), group, id="0", mkstream=True)
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+async def pop_stream(r, list_name, group, consumer, count):
+    """Read up to count UUIDs not yet delivered to the group, acknowledging
+    them at once, the stream equivalent of popping them off a list"""
+    await create_group(r, list_name, group)
+    reply = await r.xreadgroup(group, consumer, {stream_name(list_name): ">"}, count=count)
+    entries = reply[0][1] if reply else []
+    if entries:
+        await r.xack(stream_name(list_name), group, *[entry_id for entry_id, _ in entries])
+    return [fields[b"vcon_uuid"].decode("utf-8") for _, fields in entries]
+
+
+async def stream_backlog(r, list_name, group):
+    """Number of entries of the stream not yet delivered to the group, the
+    whole stream if the group does not exist yet"""
+    try:
+        groups = await r.xinfo_groups(stream_name(list_name))
+    except ResponseError:
+        return 0
+    for info in groups:
+        if info["name"].decode("utf-8") != group:
+            continue
+        if info.get("lag") is not None:
+            return info["lag"]
+        # Before Redis 7 the group has no lag, and XLEN would also count the
+        # entries already delivered and acknowledged
+        return await count_entries_after(r, stream_name(list_name), info["last-delivered-id"])
+    return await r.xlen(stream_name(list_name))
+
+
+async def count_entries_after(r, stream, entry_id, page_size=1000):
+    """Number of entries of the stream after entry_id, read page_size ids at a time"""
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode("utf-8")
+    count = 0
+    while True:
+        entries = await r.xrange(stream, min=f"({entry_id}", max="+", count=page_size)
+        count += len(entries)
+        if len(entries) < page_size:
+            return count
+        entry_id = entries[-1][0].decode("utf-8")
+
+
+class ChainQueue:
+    """Batching shared by the queues"""
+
+    async def depth(self):
+        return await self.r.llen(self.key)
+
+    async def resolve_batch_size(self, batch_size, max_batch_size):
+        if batch_size == "auto":
+            return auto_batch_size(await self.depth(), max_batch_size)
+        return max(1, int(batch_size))
+
+    async def fill_batch(self, vcon_id, batch_size, max_batch_size):
+        """Returns a batch made of vcon_id and whatever else is waiting on
+        the ingress list, up to the batch size."""
+        vcon_ids = [vcon_id]
+        batch_size = await self.resolve_batch_size(batch_size, max_batch_size)
+        if batch_size > 1:
+            vcon_ids.extend(await self.claim_batch(batch_size - 1))
+        return vcon_ids
+
+
+class ListQueue(ChainQueue):
+    """Plain redis list, the UUID is gone from redis once it has been popped"""
+
+    def __init__(self, r, ingress_list):
+        self.r = r
+        self.ingress_list = ingress_list
+        self.key = list_key(ingress_list)
+
+    async def claim(self, timeout=None):
+        """Take the next UUID off the list, blocking up to timeout seconds
+        if timeout is not None.  Returns None if the list is empty."""
+        if timeout is None:
+            vcon_id = await self.r.lpop(self.key)
+        else:
+            values = await self.r.blpop([self.key], timeout=timeout)
+            vcon_id = values[1] if values else None
+        return vcon_id.decode("utf-8") if vcon_id else None
+
+    async def claim_batch(self, count):
+        """Take up to count UUIDs off the list with a single LPOP, without blocking"""
+        vcon_ids = await self.r.lpop(self.key, count)
+        return [vcon_id.decode("utf-8") for vcon_id in vcon_ids or []]
+
+    async def listen(self, timeout, stop_event, batch_size=1, max_batch_size=100):
+        """Yield batches of UUIDs as they arrive on the list"""
+        async for vcon_id in listen_list(self.r, self.key, timeout=timeout, stop_event=stop_event):
+            yield await self.fill_batch(vcon_id.decode("utf-8"), batch_size, max_batch_size)
+
+    async def ack(self, *vcon_ids):
+        pass
+
+    async def fail(self, vcon_id):
+        pass
+
+    async def recover(self):
+        return 0
+
+    async def requeue_expired(self):
+        return 0
+
+
+class ReliableQueue(ChainQueue):
+    """At least once consumption of a redis list, see the module doc"""
+
+    def __init__(self, r, ingress_list, worker_id, visibility_timeout=300, max_attempts=3):
+        self.r = r
+        self.ingress_list = ingress_list
+        self.worker_id = worker_id
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.key = list_key(ingress_list)
+        self.processing_list = f"{self.key}:processing:{worker_id}"
+        self.inflight_key = f"{self.key}:inflight"
+        self.owners_key = f"{self.key}:owners"
+        self.attempts_key = attempts_key_name(ingress_list)
+        self.dead_letter_list = dead_letter_list_name(ingress_list)
+
+    async def claim(self, timeout=None):
+        """Move the next UUID from the ingress list to the processing list of
+        this worker, blocking up to timeout seconds if timeout is not None.
+        Returns None if the ingress list is empty."""
+        if timeout is None:
+            vcon_id = await self.r.lmove(self.key, self.processing_list, "LEFT", "LEFT")
+        else:
+            vcon_id = await self.r.blmove(self.key, self.processing_list, timeout, "LEFT", "LEFT")
+        if not vcon_id:
+            return None
+
+        vcon_id = vcon_id.decode("utf-8")
+        await self._track([vcon_id])
+        return vcon_id
+
+    async def claim_batch(self, count):
+        """Move up to count UUIDs to the processing list of this worker in
+        a single pipeline, without blocking"""
+        async with self.r.pipeline(transaction=False) as pipe:
+            for _ in range(count):
+                pipe.lmove(self.key, self.processing_list, "LEFT", "LEFT")
+            vcon_ids = [vcon_id.decode("utf-8") for vcon_id in await pipe.execute() if vcon_id]
+        if vcon_ids:
+            await self._track(vcon_ids)
+        return vcon_ids
+
+    async def _track(self, vcon_ids):
+        deadline = time.time() + self.visibility_timeout
+        async with pipeline(self.r, transaction=True) as pipe:
+            pipe.zadd(self.inflight_key, {vcon_id: deadline for vcon_id in vcon_ids})
+            pipe.hset(self.owners_key, mapping={vcon_id: self.processing_list for vcon_id in vcon_ids})
+            for vcon_id in vcon_ids:
+                pipe.hincrby(self.attempts_key, vcon_id, 1)
+            await pipe.execute()
+
+    async def listen(self, timeout, stop_event, batch_size=1, max_batch_size=100):
+        """Yield batches of UUIDs as they arrive on the ingress list"""
+        while not stop_event.is_set():
+            vcon_id = await self.claim(timeout)
+            if vcon_id:
+                yield await self.fill_batch(vcon_id, batch_size, max_batch_size)
+
+    async def ack(self, *vcon_ids):
+        """The chain is done with the vCons, forget about them"""
+        if not vcon_ids:
+            return
+        async with pipeline(self.r, transaction=True) as pipe:
+            for vcon_id in vcon_ids:
+                pipe.lrem(self.processing_list, 1, vcon_id)
+            pipe.zrem(self.inflight_key, *vcon_ids)
+            pipe.hdel(self.owners_key, *vcon_ids)
+            pipe.hdel(self.attempts_key, *vcon_ids)
+            await pipe.execute()
+
+    async def fail(self, vcon_id):
+        """The chain failed on the vCon, retry it or park it on the dead letter list"""
+        await self._release(vcon_id, self.processing_list)
+
+    async def _release(self, vcon_id, processing_list):
+        attempts = int(await self.r.hget(self.attempts_key, vcon_id) or 0)
+        async with pipeline(self.r, transaction=True) as pipe:
+            pipe.lrem(processing_list, 1, vcon_id)
+            pipe.zrem(self.inflight_key, vcon_id)
+            pipe.hdel(self.owners_key, vcon_id)
+            if attempts >= self.max_attempts:
+                logger.error(
+                    "vCon %s failed %s times on %s, moving it to %s",
+                    vcon_id, attempts, self.ingress_list, self.dead_letter_list
+                )
+                pipe.hdel(self.attempts_key, vcon_id)
+                pipe.lpush(self.dead_letter_list, vcon_id)
+            else:
+                logger.info("Requeuing vCon %s on %s after %s attempts", vcon_id, self.ingress_list, attempts)
+                pipe.rpush(self.key, vcon_id)
+            await pipe.execute()
+
+    async def recover(self):
+        """Release the UUIDs left on this worker's processing list by a
+        previous run of the worker that did not shut down cleanly."""
+        vcon_ids = await self.r.lrange(self.processing_list, 0, -1)
+        for vcon_id in vcon_ids:
+            await self._release(vcon_id.decode("utf-8"), self.processing_list)
+        if vcon_ids:
+            logger.info("Recovered %s vCons from %s", len(vcon_ids), self.processing_list)
+        return len(vcon_ids)
+
+    async def requeue_expired(self, limit=100):
+        """Release the in flight UUIDs of any worker that are past their
+        visibility deadline.  Returns the number released."""
+        expired = await self.r.zrangebyscore(self.inflight_key, "-inf", time.time(), start=0, num=limit)
+        released = 0
+        for vcon_id in expired:
+            vcon_id = vcon_id.decode("utf-8")
+            owner = await self.r.hget(self.owners_key, vcon_id)
+            # Only the worker that manages to remove it releases the vCon
+            if not await self.r.zrem(self.inflight_key, vcon_id):
+                continue
+            logger.warning("vCon %s passed its visibility timeout on %s", vcon_id, self.ingress_list)
+            await self._release(vcon_id, owner.decode("utf-8") if owner else self.processing_list)
+            released += 1
+        return released
+
+
+class StreamQueue(ChainQueue):
+    """Consumer group on the stream of an ingress list, see the module doc"""
+
+    def __init__(self, r, ingress_list, group, consumer, visibility_timeout=300, max_attempts=3):
+        self.r = r
+        self.ingress_list = ingress_list
+        self.stream = stream_name(ingress_list)
+        self.group = group
+        self.consumer = consumer
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.dead_letter_list = dead_letter_list_name(ingress_list)
+        # Entry ids of the UUIDs handed out, to XACK them by UUID
+        self.entry_ids = {}
+        # Entries recovered or claimed from other consumers, handed out first
+        self.reclaimed = []
+        self.group_created = False
+        # Where the next XAUTOCLAIM goes on scanning the pending entries from
+        self.autoclaim_cursor = "0-0"
+
+    async def depth(self):
+        return await stream_backlog(self.r, self.ingress_list, self.group)
+
+    def _hand_out(self, entries):
+        vcon_ids = []
+        for entry_id, fields in entries:
+            if not fields:
+                # Trimmed from the stream while pending
+                continue
+            vcon_id = fields[b"vcon_uuid"].decode("utf-8")
+            self.entry_ids[vcon_id] = entry_id
+            vcon_ids.append(vcon_id)
+        return vcon_ids
+
+    async def _read(self, count, block=None):
+        if not self.group_created:
+            await create_group(self.r, self.ingress_list, self.group)
+            self.group_created = True
+        if self.reclaimed:
+            entries, self.reclaimed = self.reclaimed[:count], self.reclaimed[count:]
+            return self._hand_out(entries)
+        reply = await self.r.xreadgroup(
+            self.group, self.consumer, {self.stream: ">"}, count=count, block=block
+        )
+        return self._hand_out(reply[0][1] if reply else [])
+
+    async def claim(self, timeout=None):
+        """Read the next UUID, blocking up to timeout seconds if timeout is
+        not None.  Returns None if there is none."""
+        vcon_ids = await self._read(1, block=int(timeout * 1000) if timeout else None)
+        return vcon_ids[0] if vcon_ids else None
+
+    async def claim_batch(self, count):
+        """Read up to count UUIDs with a single XREADGROUP, without blocking"""
+        return await self._read(count)
+
+    async def listen(self, timeout, stop_event, batch_size=1, max_batch_size=100):
+        """Yield batches of UUIDs as they arrive on the stream, each read with
+        one XREADGROUP of COUNT the batch size, blocking up to timeout"""
+        while not stop_event.is_set():
+            count = await self.resolve_batch_size(batch_size, max_batch_size)
+            vcon_ids = await self._read(count, block=int(timeout * 1000))
+            if vcon_ids:
+                yield vcon_ids
+
+    async def ack(self, *vcon_ids):
+        """The chain is done with the vCons, XACK their entries"""
+        entry_ids = [self.entry_ids.pop(vcon_id) for vcon_id in vcon_ids if vcon_id in self.entry_ids]
+        if entry_ids:
+            await self.r.xack(self.stream, self.group, *entry_ids)
+
+    async def fail(self, vcon_id):
+        """The chain failed on the vCon.  Its entry is left pending, to be
+        claimed again once past the visibility timeout, unless it has been
+        delivered max_attempts times, then it is parked on the dead letter list."""
+        entry_id = self.entry_ids.pop(vcon_id, None)
+        if entry_id is None:
+            return
+        pending = await self.r.xpending_range(self.stream, self.group, entry_id, entry_id, 1)
+        attempts = pending[0]["times_delivered"] if pending else 0
+        if attempts >= self.max_attempts:
+            await self._dead_letter(vcon_id, entry_id, attempts)
+        else:
+            logger.info("vCon %s left pending on %s after %s attempts", vcon_id, self.stream, attempts)
+
+    async def _dead_letter(self, vcon_id, entry_id, attempts):
+        logger.error(
+            "vCon %s failed %s times on %s, moving it to %s",
+            vcon_id, attempts, self.stream, self.dead_letter_list
+        )
+        async with pipeline(self.r, transaction=True) as pipe:
+            pipe.lpush(self.dead_letter_list, vcon_id)
+            pipe.xack(self.stream, self.group, entry_id)
+            await pipe.execute()
+
+    async def recover(self):
+        """Hand out again the entries left pending on this consumer by a
+        previous run of the worker that did not shut down cleanly."""
+        await create_group(self.r, self.ingress_list, self.group)
+        self.group_created = True
+        reply = await self.r.xreadgroup(self.group, self.consumer, {self.stream: "0"})
+        entries = reply[0][1] if reply else []
+        self.reclaimed.extend(entries)
+        if entries:
+            logger.info("Recovered %s vCons pending on %s for %s", len(entries), self.stream, self.consumer)
+        return len(entries)
+
+    async def requeue_expired(self, limit=100):
+        """XAUTOCLAIM the entries pending on any consumer for longer than the
+        visibility timeout, to be handed out again by this one.  Each call
+        goes on from where the previous one stopped, so the entries past the
+        first limit are reached too.  Returns the number claimed."""
+        if not self.group_created:
+            await create_group(self.r, self.ingress_list, self.group)
+            self.group_created = True
+        reply = await self.r.xautoclaim(
+            self.stream, self.group, self.consumer,
+            min_idle_time=int(self.visibility_timeout * 1000), start_id=self.autoclaim_cursor, count=limit,
+        )
+        # "0-0" once the scan has gone through all the pending entries
+        self.autoclaim_cursor = reply[0]
+        entries = [(entry_id, fields) for entry_id, fields in reply[1] if fields]
+        if not entries:
+            return 0
+        pending = await self.r.xpending_range(
+            self.stream, self.group, entries[0][0], entries[-1][0], len(entries), consumername=self.consumer
+        )
+        attempts = {info["message_id"]: info["times_delivered"] for info in pending}
+        claimed = 0
+        for entry_id, fields in entries:
+            # XAUTOCLAIM counts as a delivery
+            if attempts.get(entry_id, 0) > self.max_attempts:
+                await self._dead_letter(fields[b"vcon_uuid"].decode("utf-8"), entry_id, attempts[entry_id] - 1)
+                continue
+            logger.warning("vCon entry %s passed its visibility timeout on %s", entry_id, self.stream)
+            self.reclaimed.append((entry_id, fields))
+            claimed += 1
+        return claimed
@@ -0,0 +1,135 @@
+"""
+Thread and process pools the chain runs blocking links and storages on.
+
+A link or storage picks where its run_vcon(vcon, opts) or save_vcon(vcon, opts)
+runs with an "executor" entry in its config, defaulting to the
+default_executor of its module, or inline if it has none:
+
+    inline:  awaited on the event loop of the worker, for modules that only
+             do async I/O
+    thread:  run on its own event loop in a bounded thread pool, for modules
+             calling synchronous clients (openai, slack, pymongo, boto3, ...).
+             Each storage has a pool of its own, of "threads" threads, as a
+             call timed out by the chain keeps its thread until it returns,
+             so a storage that hangs only exhausts its own threads.
+    process: run in a bounded pool of processes, for CPU bound modules such
+             as whisper.  The vCon is sent to and back from the process as JSON,
+             the chain moves the change tracking of the vCon sent to the
+             copy returned, see vcon_redis.transfer_snapshot.
+
+Modules on a thread or process must not use the redis client of the worker,
+which belongs to the worker's event loop.
+"""
+import asyncio
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import vcon
+from lib.logging_utils import init_logger
+from settings import EXECUTOR_THREADS, EXECUTOR_PROCESSES
+
+logger = init_logger(__name__)
+
+EXECUTORS = ("inline", "thread", "process")
+
+_thread_pools = {}
+# Calls submitted to each thread pool that have not returned yet, running
+# or waiting for a thread, including those the caller stopped waiting for
+_thread_pool_pending = {}
+_process_pool = None
+
+
+def get_executor_name(config, module):
+    """Returns the executor a link or storage runs on, from its config or
+    the default_executor of its module."""
+    executor = config.get("executor") or getattr(module, "default_executor", "inline")
+    if executor not in EXECUTORS:
+        raise ValueError(f"Unknown executor {executor}, expected one of {', '.join(EXECUTORS)}")
+    return executor
+
+
+def get_thread_pool(name="default", max_workers=EXECUTOR_THREADS):
+    if name not in _thread_pools:
+        _thread_pools[name] = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"conserver-{name}")
+        _thread_pool_pending[name] = set()
+    return _thread_pools[name]
+
+
+def get_thread_pool_stats():
+    """Returns the number of threads of each thread pool and of the calls
+    submitted to it that have not returned yet"""
+    return {
+        name: {"threads": pool._max_workers, "busy": len(_thread_pool_pending[name])}
+        for name, pool in _thread_pools.items()
+    }
+
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        # Spawn rather than fork, the worker has threads and open redis connections
+        _process_pool = ProcessPoolExecutor(
+            max_workers=EXECUTOR_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _process_pool
+
+
+def shutdown_executors():
+    global _process_pool
+    for pool in _thread_pools.values():
+        pool.shutdown(wait=True)
+    _thread_pools.clear()
+    _thread_pool_pending.clear()
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=True)
+        _process_pool = None
+
+
+def _run_in_thread(func, vCon, opts):
+    return asyncio.run(func(vCon, opts))
+
+
+def _run_in_process(module_name, func_name, vcon_json, opts):
+    module = importlib.import_module(module_name)
+    vCon = vcon.Vcon()
+    vCon.loads(vcon_json)
+    result = asyncio.run(getattr(module, func_name)(vCon, opts))
+    if isinstance(result, vcon.Vcon):
+        return result.dumps()
+    return result
+
+
+async def run_step(step, func_name, vCon):
+    """Call func_name(vCon, step.options) of a link or storage module on the
+    executor of the step.
+
+    Args:
+        step (PlanStep): the link or storage
+        func_name (str): run_vcon or save_vcon
+        vCon (vcon.Vcon): the vCon to pass to the module
+
+    Returns:
+        whatever the module returned, a vCon returned from a process being
+        a new vcon.Vcon
+    """
+    func = getattr(step.module, func_name)
+    if step.executor == "inline":
+        return await func(vCon, step.options)
+
+    if step.executor == "thread":
+        name, max_workers = step.thread_pool
+        future = get_thread_pool(name, max_workers).submit(_run_in_thread, func, vCon, step.options)
+        pending = _thread_pool_pending[name]
+        pending.add(future)
+        future.add_done_callback(pending.discard)
+        return await asyncio.wrap_future(future)
+
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(
+        get_process_pool(), _run_in_process, step.module_name, func_name, vCon.dumps(), step.options
+    )
+    if isinstance(result, str):
+        returned_vcon = vcon.Vcon()
+        returned_vcon.loads(result)
+        return returned_vcon
+    return result
@@ -0,0 +1,208 @@
+"""
+Incremental parsing of a request body holding many JSON documents, either
+NDJSON, one document per line, or a JSON array of documents, as the chunks
+of the body arrive, so only the document being parsed is held in memory.
+
+Each byte of the body is scanned once, for the end of a line or of a
+document of the array, and each document is parsed once, when complete, so
+the cost stays linear however many chunks a document of several MB spans.
+"""
+import json
+import re
+
+WHITESPACE = b" \t\r\n"
+# What to look for inside a string of a document, and outside of one
+STRING_SPECIAL = re.compile(rb'["\\]')
+STRUCTURE = re.compile(rb'[{}\[\]"]')
+# The end of a number, true, false or null in the array
+SCALAR_END = re.compile(rb"[\s,\]]")
+
+
+class JsonStreamError(ValueError):
+    """The body cannot be parsed any further"""
+
+
+async def iter_json_items(chunks, max_item_bytes):
+    """Yield (index, document) for each document of the body.
+
+    A line of NDJSON that is not valid JSON is yielded as (index, error) with
+    a ValueError, and parsing goes on with the next line.  A JSON array cannot
+    be resynchronised after an invalid document, so JsonStreamError is raised.
+
+    Args:
+        chunks: async iterator of the bytes of the body
+        max_item_bytes (int): largest document accepted, in bytes, a document
+            still incomplete past this size raises JsonStreamError
+    """
+    parser = None
+    buffer = bytearray()
+    index = 0
+    async for chunk in chunks:
+        buffer += chunk
+        if parser is None:
+            start = len(buffer) - len(buffer.lstrip(WHITESPACE))
+            if start == len(buffer):
+                continue
+            parser = _ArrayParser() if buffer[start:start + 1] == b"[" else _LineParser()
+        for item in parser.parse(buffer):
+            yield index, item
+            index += 1
+        if parser.pending(buffer) > max_item_bytes:
+            raise JsonStreamError(f"Document {index} is larger than {max_item_bytes} bytes")
+
+    if parser is not None:
+        for item in parser.parse(buffer, final=True):
+            yield index, item
+            index += 1
+
+
+def _loads_line(line):
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return e
+
+
+class _LineParser:
+    """NDJSON, the lines are looked for in the bytes added since the last
+    chunk only"""
+
+    def __init__(self):
+        self.scanned = 0
+
+    def parse(self, buffer, final=False):
+        """The documents of the complete lines of buffer, which is left with
+        the incomplete last line"""
+        items = []
+        start = 0
+        end = buffer.find(b"\n", self.scanned)
+        while end != -1:
+            if buffer[start:end].strip(WHITESPACE):
+                items.append(_loads_line(bytes(buffer[start:end])))
+            start = end + 1
+            end = buffer.find(b"\n", start)
+        if final and buffer[start:].strip(WHITESPACE):
+            items.append(_loads_line(bytes(buffer[start:])))
+            start = len(buffer)
+        del buffer[:start]
+        self.scanned = len(buffer)
+        return items
+
+    def pending(self, buffer):
+        return len(buffer)
+
+
+class _ArrayParser:
+    """A JSON array, the end of each document is found by following its
+    strings and nesting through the bytes added since the last chunk"""
+
+    def __init__(self):
+        self.opened = False
+        self.closed = False
+        # Start of the document being scanned in the buffer, None between documents
+        self.start = None
+        self.position = 0
+        self.depth = 0
+        self.in_string = False
+
+    def parse(self, buffer, final=False):
+        """The documents completed in buffer, which is left with the start
+        of the next one"""
+        items = []
+        while True:
+            end = self._scan(buffer, final)
+            if end is None:
+                break
+            try:
+                items.append(json.loads(bytes(buffer[self.start:end])))
+            except ValueError as e:
+                raise JsonStreamError(f"Invalid document in the array: {e}") from e
+            del buffer[:end]
+            self.start = None
+            self.position = 0
+        if final and (self.start is not None or not self.opened):
+            raise JsonStreamError("The array is incomplete or invalid")
+        return items
+
+    def pending(self, buffer):
+        return len(buffer) - self.start if self.start is not None else 0
+
+    def _scan(self, buffer, final):
+        """The end of the next complete document, None if there is none yet"""
+        if self.start is None and not self._next_document(buffer, final):
+            return None
+        while True:
+            if self.in_string:
+                match = STRING_SPECIAL.search(buffer, self.position)
+                if match is None:
+                    self.position = len(buffer)
+                    return None
+                if match.group() == b"\\":
+                    if match.end() == len(buffer):
+                        # Wait for the escaped character
+                        self.position = match.start()
+                        return None
+                    self.position = match.end() + 1
+                    continue
+                self.in_string = False
+                self.position = match.end()
+                if self.depth == 0:
+                    return self.position
+                continue
+            if self.depth == 0:
+                # A number, true, false or null
+                match = SCALAR_END.search(buffer, self.position)
+                if match is None:
+                    self.position = len(buffer)
+                    return len(buffer) if final else None
+                return match.start()
+            match = STRUCTURE.search(buffer, self.position)
+            if match is None:
+                self.position = len(buffer)
+                return None
+            self.position = match.end()
+            character = match.group()
+            if character == b'"':
+                self.in_string = True
+            elif character in b"{[":
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth == 0:
+                    return self.position
+
+    def _next_document(self, buffer, final):
+        """Skip to the start of the next document, False if there is none yet"""
+        if self.closed:
+            if buffer.strip(WHITESPACE):
+                raise JsonStreamError("Unexpected data after the end of the array")
+            del buffer[:]
+            return False
+        position = self.position
+        while position < len(buffer) and (buffer[position] in WHITESPACE or buffer[position:position + 1] == b","):
+            position += 1
+        if not self.opened and position < len(buffer):
+            self.opened = True
+            position += 1
+            while position < len(buffer) and buffer[position] in WHITESPACE:
+                position += 1
+        del buffer[:position]
+        self.position = 0
+        if not buffer:
+            return False
+        if buffer[:1] == b"]":
+            self.closed = True
+            if buffer[1:].strip(WHITESPACE):
+                raise JsonStreamError("Unexpected data after the end of the array")
+            del buffer[:]
+            return False
+        self.start = 0
+        self.depth = 0
+        first = buffer[:1]
+        if first in (b"{", b"["):
+            self.depth = 1
+            self.position = 1
+        elif first == b'"':
+            self.in_string = True
+            self.position = 1
+        return True
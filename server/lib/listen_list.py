@@ -3,9 +3,18 @@ from lib.logging_utils import init_logger
 logger = init_logger(__name__)
 
 
-async def listen_list(r, list_name):
-    while True:
-        values = await r.blpop([list_name])
-        logger.info(f"Got the value {values}")
+async def listen_list(r, list_name, timeout=0, stop_event=None):
+    """Yield the values pushed onto one or more redis lists as they arrive.
+
+    Args:
+        r: async redis client
+        list_name (str | list): name of the list, or names of the lists, to block on
+        timeout (int): seconds BLPOP blocks before giving up, 0 blocks forever
+        stop_event (asyncio.Event): when set, stop listening after the current BLPOP returns
+    """
+    list_names = [list_name] if isinstance(list_name, str) else list(list_name)
+    while stop_event is None or not stop_event.is_set():
+        values = await r.blpop(list_names, timeout=timeout)
         if values:
+            logger.debug(f"Got the value {values}")
             yield values[1]
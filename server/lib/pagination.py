@@ -0,0 +1,41 @@
+"""
+Opaque cursors for keyset pagination.
+
+A cursor holds the position of the last vCon handed out, its created_at and
+its UUID: the score and member of the vCon sorted set on redis, and the
+(created_at, uuid) key on Postgres, where created_at is kept as an ISO 8601
+datetime so the microseconds survive the round trip.  The next page starts
+right after it, so a deep page costs the same as the first one, and vCons
+arriving meanwhile do not shift the pages.
+"""
+import base64
+import json
+from datetime import datetime
+
+
+def encode_cursor(position, vcon_uuid):
+    """position is the created_at datetime of the vCon, or its sorted set score"""
+    if isinstance(position, datetime):
+        data = {"d": position.isoformat(), "u": vcon_uuid}
+    else:
+        data = {"t": position, "u": vcon_uuid}
+    data = json.dumps(data, separators=(",", ":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Returns the (created_at datetime or timestamp, uuid) of a cursor,
+    raises ValueError if it is not one"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if "d" in data:
+            return datetime.fromisoformat(data["d"]), str(data["u"])
+        return float(data["t"]), str(data["u"])
+    except (TypeError, KeyError, ValueError) as e:
+        raise ValueError(f"Invalid cursor {cursor!r}") from e
+
+
+def cursor_datetime(position):
+    """The created_at of a cursor position as a datetime, for a cursor
+    holding a timestamp"""
+    return position if isinstance(position, datetime) else datetime.fromtimestamp(position)
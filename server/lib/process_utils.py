@@ -1,4 +1,5 @@
 import asyncio
+import zlib
 from multiprocessing import Process
 
 
@@ -16,3 +17,12 @@ def start_async_process(func, *args):
     process = Process(target=async_runner, args=(func, *args))
     process.start()
     return process
+
+
+def shard_for(key, shard_count):
+    """Returns the shard a key belongs to.
+
+    Uses crc32 rather than hash() as python string hashes are randomized per
+    process, and every worker process has to agree on the partitioning.
+    """
+    return zlib.crc32(key.encode("utf-8")) % shard_count
@@ -0,0 +1,115 @@
+"""
+Helpers keeping the redis access of the conserver working on a Redis Cluster.
+
+With REDIS_CLUSTER set, keys that are used together carry a hash tag so they
+land in the same slot: vcon:{uuid} with its version and index key sets, and
+an ingress list {name} with its processing lists, in flight set, attempts
+and dead letter list.  The cluster client cannot run MULTI, so the
+pipelines that are transactions on a single node are plain pipelines of
+commands on the one slot on a cluster.  Commands that would span several
+slots, SCAN and JSON.MGET, are run per node or per key.  The cluster client
+of redis-py has no .json(), so the JSON commands are sent with
+execute_command, through the json_* helpers, on both kinds of client.
+
+Without REDIS_CLUSTER the keys and commands are the same as ever.
+"""
+import json
+from settings import REDIS_CLUSTER
+
+VCON_KEY_PREFIX = "vcon:"
+
+
+def hash_tag(value):
+    """The value as a hash tag on a cluster, so the keys built from it share a slot"""
+    return f"{{{value}}}" if REDIS_CLUSTER else value
+
+
+def vcon_key(vcon_id):
+    return f"{VCON_KEY_PREFIX}{hash_tag(vcon_id)}"
+
+
+def vcon_id_from_key(key):
+    """The UUID of a vcon: key or sorted set member, tagged or not"""
+    if isinstance(key, bytes):
+        key = key.decode("utf-8")
+    return key[len(VCON_KEY_PREFIX):].strip("{}")
+
+
+def list_key(list_name):
+    """The key of an ingress or egress list, the keys of its queue are built on it"""
+    return hash_tag(list_name)
+
+
+def pipeline(r, transaction=False):
+    """A pipeline, a transaction on a single node if asked for"""
+    return r.pipeline(transaction=transaction and not REDIS_CLUSTER)
+
+
+async def scan_keys(r, match, count=1000, _type=None):
+    """Yield batches of the keys matching match, SCANning every primary of
+    a cluster in turn rather than using KEYS."""
+    if not REDIS_CLUSTER:
+        cursor = None
+        while cursor != 0:
+            cursor, keys = await r.scan(cursor or 0, match=match, count=count, _type=_type)
+            if keys:
+                yield keys
+        return
+
+    args = ["MATCH", match, "COUNT", count]
+    if _type:
+        args.extend(["TYPE", _type])
+    for node in r.get_primaries():
+        cursor = None
+        while cursor != 0:
+            cursor, keys = await node.execute_command("SCAN", cursor or 0, *args)
+            cursor = int(cursor)
+            if keys:
+                yield keys
+
+
+async def json_mget(r, keys, path):
+    """JSON.MGET of path on the keys, as one JSON.GET per key on a cluster
+    where the keys are in different slots, pipelined by node."""
+    if not REDIS_CLUSTER:
+        return await r.json().mget(keys, path)
+    return [json.loads(reply) if reply is not None else None for reply in await json_mget_raw(r, keys, path)]
+
+
+async def json_mget_raw(r, keys, path):
+    """json_mget returning the JSON text of each value, None for a missing key"""
+    if not REDIS_CLUSTER:
+        return await r.execute_command("JSON.MGET", *keys, path)
+    async with r.pipeline() as pipe:
+        for key in keys:
+            pipe.execute_command("JSON.GET", key, path)
+        return await pipe.execute()
+
+
+async def json_get(r, key, *paths):
+    """JSON.GET of the paths of key, parsed as r.json().get would, None for
+    a missing key"""
+    reply = await r.execute_command("JSON.GET", key, *paths)
+    return json_loads(reply)
+
+
+def json_loads(reply):
+    """A JSON.GET reply queued on a pipeline, parsed"""
+    return json.loads(reply) if reply is not None else None
+
+
+async def json_set(r, key, path, value):
+    return await r.execute_command("JSON.SET", key, path, json.dumps(value))
+
+
+def queue_json_set(pipe, key, path, value):
+    """Queue on pipe a JSON.SET of value, serialized here"""
+    pipe.execute_command("JSON.SET", key, path, json.dumps(value))
+
+
+def queue_json_arrappend(pipe, key, path, *values):
+    pipe.execute_command("JSON.ARRAPPEND", key, path, *[json.dumps(value) for value in values])
+
+
+def queue_json_delete(pipe, key, path):
+    pipe.execute_command("JSON.DEL", key, path)
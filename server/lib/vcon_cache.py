@@ -0,0 +1,92 @@
+"""
+Worker local LRU cache of vCons for VconRedis, bounded by bytes.
+
+With the cache on, every store of a vCon through VconRedis (or the API)
+increments a version counter, vcon_version:{uuid}, in the same transaction
+as the write.  The cache keeps the JSON of a vCon with the version it was
+read or written at, and an entry is only used after a GET of the version
+key confirms it is still current, which is much cheaper than transferring
+the vCon.
+
+The cache is off unless VCON_CACHE_MAX_BYTES is set, and the version
+counters are then not written at all, so VCON_CACHE_MAX_BYTES must be set
+alike for the API and the workers.
+"""
+from collections import OrderedDict
+from lib.redis_cluster import hash_tag
+from settings import VCON_CACHE_MAX_BYTES
+
+_cache = None
+
+
+def vcon_version_key(vcon_id):
+    # In the slot of the vCon on a cluster, it is incremented with each store
+    return f"vcon_version:{hash_tag(vcon_id)}"
+
+
+def queue_version_incr(pipe, vcon_id):
+    """Queue on pipe the increment of the version of a vCon, if the cache is
+    on.  Returns True if it was queued."""
+    if VCON_CACHE_MAX_BYTES <= 0:
+        return False
+    pipe.incr(vcon_version_key(vcon_id))
+    return True
+
+
+class VconCache:
+    """LRU of vCon JSON bytes and the version they are at"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, vcon_id):
+        """Returns the (version, data) cached for a vCon, or None"""
+        entry = self._entries.get(vcon_id)
+        if entry is not None:
+            self._entries.move_to_end(vcon_id)
+        return entry
+
+    def put(self, vcon_id, version, data):
+        self.invalidate(vcon_id)
+        if len(data) > self.max_bytes:
+            return
+        self._entries[vcon_id] = (version, data)
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.evictions += 1
+
+    def invalidate(self, vcon_id):
+        entry = self._entries.pop(vcon_id, None)
+        if entry is not None:
+            self.size -= len(entry[1])
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def get_vcon_cache():
+    """Returns the cache of this process, None if caching is off"""
+    global _cache
+    if _cache is None and VCON_CACHE_MAX_BYTES > 0:
+        _cache = VconCache(VCON_CACHE_MAX_BYTES)
+    return _cache
+
+
+def get_vcon_cache_stats():
+    """Returns the hit, miss and eviction counts of the cache, None if caching is off"""
+    cache = get_vcon_cache()
+    return cache.stats() if cache else None
@@ -0,0 +1,162 @@
+"""
+Expiry of the vCons stored in redis.
+
+A TTL on vcon:{uuid} makes redis drop the vCon, but not its member of the
+VCON_SORTED_SET_NAME sorted set, or of its shard on a cluster, nor its
+secondary index entries, so those would pile up and get_vcons would page
+through UUIDs that 404.  Expiring a vCon therefore also records its expiry
+time in the EXPIRY_SET_KEY sorted set, and the reaper periodically removes,
+in batches, everything belonging to the vCons past their expiry.  The counts
+of what was reaped are kept in the REAPED_STATS_KEY hash.
+"""
+import asyncio
+import time
+from lib.logging_utils import init_logger
+from lib.redis_cluster import vcon_key
+from lib.vcon_cache import vcon_version_key
+from lib.vcon_index import get_vcons_sorted_set_keys, vcon_index_keys_key
+from settings import REDIS_CLUSTER, VCON_EXPIRY_BATCH_SIZE, VCON_EXPIRY_REAP_INTERVAL, VCON_SORTED_SET_NAME
+
+logger = init_logger(__name__)
+
+EXPIRY_SET_KEY = f"{VCON_SORTED_SET_NAME}:expiry"
+# The sorted set shard of each vCon to expire, on a cluster, where the vCon
+# may be gone by the time it is reaped
+EXPIRY_SORTED_SETS_KEY = f"{VCON_SORTED_SET_NAME}:expiry_sorted_sets"
+REAPED_STATS_KEY = f"{VCON_SORTED_SET_NAME}:reaped"
+
+
+async def expire_vcon(r, vcon_id, seconds):
+    """Expire a vCon in seconds, the vCon key gets a TTL so it goes away even
+    if no reaper runs"""
+    sorted_set = None
+    if REDIS_CLUSTER:
+        sorted_set, = await get_vcons_sorted_set_keys(r, [vcon_id])
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.zadd(EXPIRY_SET_KEY, {vcon_id: time.time() + seconds})
+        if sorted_set:
+            pipe.hset(EXPIRY_SORTED_SETS_KEY, vcon_id, sorted_set)
+        pipe.expire(vcon_key(vcon_id), seconds)
+        pipe.expire(vcon_version_key(vcon_id), seconds)
+        await pipe.execute()
+
+
+async def remove_vcons(r, vcon_ids, sorted_sets=None):
+    """Remove the vCons, their sorted set members, secondary index entries
+    and expiry, in a few round trips.
+
+    Args:
+        vcon_ids (list): UUIDs of the vCons
+        sorted_sets (list): the sorted set each vCon is in, looked up from
+            the created_at of the vCons if not given
+
+    Returns:
+        dict: the number of vCon keys, sorted set members and index entries removed
+    """
+    if not vcon_ids:
+        return {"vcons": 0, "sorted_set": 0, "indexes": 0}
+    if sorted_sets is None:
+        sorted_sets = await get_vcons_sorted_set_keys(r, vcon_ids)
+    async with r.pipeline(transaction=False) as pipe:
+        for vcon_id in vcon_ids:
+            pipe.smembers(vcon_index_keys_key(vcon_id))
+        index_keys = await pipe.execute()
+
+    # One command per key, the keys of different vCons may be in different
+    # slots of a cluster
+    async with r.pipeline(transaction=False) as pipe:
+        for vcon_id in vcon_ids:
+            pipe.delete(vcon_key(vcon_id))
+        for vcon_id, sorted_set in zip(vcon_ids, sorted_sets):
+            # A vCon gone from a cluster before it was reaped is left to the
+            # sorted set rebuild
+            if sorted_set:
+                pipe.zrem(sorted_set, vcon_key(vcon_id))
+        for vcon_id, keys in zip(vcon_ids, index_keys):
+            for key in keys:
+                pipe.zrem(key, vcon_id)
+        for vcon_id in vcon_ids:
+            pipe.delete(vcon_version_key(vcon_id), vcon_index_keys_key(vcon_id))
+        pipe.zrem(EXPIRY_SET_KEY, *vcon_ids)
+        pipe.hdel(EXPIRY_SORTED_SETS_KEY, *vcon_ids)
+        results = await pipe.execute()
+    removed_from_sets = len([sorted_set for sorted_set in sorted_sets if sorted_set])
+    removed_from_indexes = sum(len(keys) for keys in index_keys)
+    return {
+        "vcons": sum(results[:len(vcon_ids)]),
+        "sorted_set": sum(results[len(vcon_ids):len(vcon_ids) + removed_from_sets]),
+        "indexes": sum(results[len(vcon_ids) + removed_from_sets:][:removed_from_indexes]),
+    }
+
+
+async def reap_expired_vcons(r, batch_size=VCON_EXPIRY_BATCH_SIZE, now=None):
+    """Remove one batch of the vCons past their expiry.
+
+    Several reapers can run at once, each expired vCon is only reaped by the
+    one that manages to remove it from the expiry set.
+
+    Returns:
+        dict: the number of vCons reaped, and of vCon keys, sorted set
+        members and index entries removed
+    """
+    now = time.time() if now is None else now
+    expired = await r.zrangebyscore(EXPIRY_SET_KEY, "-inf", now, start=0, num=batch_size)
+    if not expired:
+        return {"reaped": 0, "vcons": 0, "sorted_set": 0, "indexes": 0}
+
+    async with r.pipeline(transaction=False) as pipe:
+        for vcon_id in expired:
+            pipe.zrem(EXPIRY_SET_KEY, vcon_id)
+        claimed = [vcon_id.decode("utf-8") for vcon_id, removed in zip(expired, await pipe.execute()) if removed]
+
+    sorted_sets = None
+    if REDIS_CLUSTER and claimed:
+        recorded = await r.hmget(EXPIRY_SORTED_SETS_KEY, claimed)
+        sorted_sets = [sorted_set.decode("utf-8") if sorted_set else None for sorted_set in recorded]
+        if None in sorted_sets:
+            looked_up = await get_vcons_sorted_set_keys(r, claimed)
+            sorted_sets = [sorted_set or other for sorted_set, other in zip(sorted_sets, looked_up)]
+    counts = {"reaped": len(claimed), **await remove_vcons(r, claimed, sorted_sets)}
+    async with r.pipeline(transaction=False) as pipe:
+        for name, count in counts.items():
+            pipe.hincrby(REAPED_STATS_KEY, name, count)
+        pipe.hset(REAPED_STATS_KEY, "last_reaped_at", now)
+        await pipe.execute()
+    return counts
+
+
+async def get_expiry_stats(r):
+    """Returns the counts of vCons scheduled to expire, overdue and reaped so far"""
+    async with r.pipeline(transaction=False) as pipe:
+        pipe.zcard(EXPIRY_SET_KEY)
+        pipe.zcount(EXPIRY_SET_KEY, "-inf", time.time())
+        pipe.hgetall(REAPED_STATS_KEY)
+        scheduled, overdue, reaped = await pipe.execute()
+    stats = {key.decode("utf-8"): float(value) for key, value in reaped.items()}
+    return {
+        "scheduled": scheduled,
+        "overdue": overdue,
+        "reaped": int(stats.pop("reaped", 0)),
+        "vcons": int(stats.pop("vcons", 0)),
+        "sorted_set": int(stats.pop("sorted_set", 0)),
+        "indexes": int(stats.pop("indexes", 0)),
+        **stats,
+    }
+
+
+async def run_expiry_reaper(r, interval=VCON_EXPIRY_REAP_INTERVAL, batch_size=VCON_EXPIRY_BATCH_SIZE):
+    """Reap the expired vCons every interval seconds, until cancelled"""
+    logger.info("Reaping expired vCons every %s seconds", interval)
+    while True:
+        try:
+            while True:
+                counts = await reap_expired_vcons(r, batch_size)
+                if counts["reaped"]:
+                    logger.info("Reaped %s expired vCons", counts["reaped"])
+                if counts["reaped"] < batch_size:
+                    break
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Error reaping expired vCons")
+        await asyncio.sleep(interval)
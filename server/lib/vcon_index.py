@@ -0,0 +1,576 @@
+"""
+Indexes of the vCons stored in redis.
+
+The VCON_SORTED_SET_NAME sorted set holds "vcon:{uuid}" members scored by
+the created_at of the vCon, and is what the API pages through.  On a Redis
+Cluster it is sharded into one sorted set per day of created_at, e.g.
+vcons:20230415, so it spreads over the nodes, and the shards are listed in
+the SORTED_SET_SHARDS_KEY sorted set scored by the start of their day.
+
+The secondary indexes are sorted sets of vCon UUIDs scored by created_at, one
+per party tel and mailto, dialog type, analysis type and analysis vendor, e.g.
+vcon_index:tel:+15551234567.  The index keys a vCon is in are kept in the set
+vcon_index_keys:{uuid}, so its entries can be moved or removed when the vCon
+changes or goes away.
+"""
+import asyncio
+import time
+import uuid
+from datetime import datetime
+from redis.exceptions import LockError
+from lib.logging_utils import init_logger
+from lib.redis_cluster import hash_tag, json_mget, scan_keys, vcon_id_from_key, vcon_key
+from settings import (
+    REDIS_CLUSTER,
+    VCON_INDEX_ENABLED,
+    VCON_SORTED_SET_NAME,
+    VCON_SORTED_REBUILD_BATCH_SIZE,
+    VCON_SORTED_REBUILD_INTERVAL,
+)
+
+logger = init_logger(__name__)
+
+REBUILD_LOCK_KEY = f"{VCON_SORTED_SET_NAME}:rebuild_lock"
+REBUILD_PROGRESS_KEY = f"{VCON_SORTED_SET_NAME}:rebuild"
+REBUILD_LOCK_TIMEOUT = 60
+REBUILD_LOG_INTERVAL = 10
+SORTED_SET_SHARDS_KEY = f"{VCON_SORTED_SET_NAME}:shards"
+SECONDS_PER_DAY = 24 * 60 * 60
+
+INDEX_PREFIX = "vcon_index"
+# Index name, and the section and element field it indexes
+INDEXES = {
+    "tel": ("parties", "tel"),
+    "mailto": ("parties", "mailto"),
+    "dialog_type": ("dialog", "type"),
+    "analysis_type": ("analysis", "type"),
+    "vendor": ("analysis", "vendor"),
+}
+# Sections a change to which can change the index keys of a vCon
+INDEXED_SECTIONS = {"created_at"} | {section for section, _ in INDEXES.values()}
+
+
+def created_at_timestamp(created_at):
+    """Sorted set score of a created_at, a unix timestamp, a datetime or an
+    ISO string, which fromisoformat before Python 3.11 cannot parse with a
+    Z suffix"""
+    if isinstance(created_at, datetime):
+        return int(created_at.timestamp())
+    if isinstance(created_at, (int, float)):
+        return int(created_at)
+    if created_at.endswith("Z"):
+        created_at = created_at[:-1] + "+00:00"
+    return int(datetime.fromisoformat(created_at).timestamp())
+
+
+def day_start(timestamp):
+    return int(timestamp) - int(timestamp) % SECONDS_PER_DAY
+
+
+def sorted_set_key(timestamp):
+    """The sorted set a vCon created at timestamp belongs in"""
+    if not REDIS_CLUSTER:
+        return VCON_SORTED_SET_NAME
+    return f"{VCON_SORTED_SET_NAME}:{datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d')}"
+
+
+def queue_sorted_set_add(pipe, members):
+    """Queue on pipe the ZADDs of vCons to the sorted set, one per shard.
+
+    Args:
+        members (dict): vcon key to created_at score
+    """
+    shards = {}
+    for member, score in members.items():
+        shards.setdefault(sorted_set_key(score), {})[member] = score
+    for key, shard_members in shards.items():
+        pipe.zadd(key, shard_members)
+        if REDIS_CLUSTER:
+            pipe.zadd(SORTED_SET_SHARDS_KEY, {key: day_start(next(iter(shard_members.values())))})
+
+
+async def add_to_sorted_set(r, members):
+    """Add vCons to the sorted set, see queue_sorted_set_add"""
+    async with r.pipeline(transaction=False) as pipe:
+        queue_sorted_set_add(pipe, members)
+        await pipe.execute()
+
+
+async def get_sorted_set_keys(r, since=None, until=None):
+    """The sorted sets holding the vCons created between the since and until
+    timestamps, most recent first"""
+    if not REDIS_CLUSTER:
+        return [VCON_SORTED_SET_NAME]
+    keys = await r.zrevrangebyscore(
+        SORTED_SET_SHARDS_KEY,
+        day_start(until) if until is not None else "+inf",
+        day_start(since) if since is not None else "-inf",
+    )
+    return [key.decode("utf-8") for key in keys]
+
+
+async def get_sorted_set_size(r):
+    keys = await get_sorted_set_keys(r)
+    async with r.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.zcard(key)
+        return sum(await pipe.execute())
+
+
+async def range_sorted_set(r, since=None, until=None, offset=0, count=50):
+    """Returns a page of the sorted set members of the vCons created between
+    the since and until timestamps, most recent first.
+
+    On a cluster the shards in range are counted with one fan out of ZCOUNT,
+    and only the shards the page falls in are read.  The shards hold
+    disjoint days, so their pages merge by concatenating them in order.
+    """
+    max_score = until if until is not None else "+inf"
+    min_score = since if since is not None else "-inf"
+    keys = await get_sorted_set_keys(r, since, until)
+    if len(keys) == 1:
+        return await r.zrevrangebyscore(keys[0], max_score, min_score, start=offset, num=count)
+
+    async with r.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.zcount(key, min_score, max_score)
+        counts = await pipe.execute()
+    async with r.pipeline(transaction=False) as pipe:
+        for key, shard_count in zip(keys, counts):
+            if count <= 0:
+                break
+            if offset >= shard_count:
+                offset -= shard_count
+                continue
+            pipe.zrevrangebyscore(key, max_score, min_score, start=offset, num=count)
+            count -= shard_count - offset
+            offset = 0
+        pages = await pipe.execute()
+    return [member for page in pages for member in page]
+
+
+async def page_sorted_set(r, since=None, until=None, after=None, count=50, reverse=True):
+    """Returns a keyset page of the sorted set, the (member, score) of the
+    vCons created between the since and until timestamps, most recent first
+    if reverse, starting right after the vCon after points to.
+
+    The page is found from the rank of the after member, falling back to its
+    score if the vCon is gone, so a deep page costs the same as the first.
+
+    Args:
+        after (tuple): the (created_at timestamp, uuid) of the last vCon of
+            the previous page, see lib.pagination
+    """
+    if after is not None:
+        # Only the shards on the far side of the cursor
+        since, until = (since, after[0]) if reverse else (after[0], until)
+    keys = await get_sorted_set_keys(r, since, until)
+    if not reverse:
+        keys.reverse()
+    max_score = until if until is not None else "+inf"
+    min_score = since if since is not None else "-inf"
+    page = []
+    for key in keys:
+        remaining = count - len(page)
+        if remaining <= 0:
+            break
+        if after is not None and key == sorted_set_key(after[0]):
+            page.extend(await page_after(r, key, after, min_score, max_score, remaining, reverse))
+        elif reverse:
+            page.extend(await r.zrevrangebyscore(key, max_score, min_score, start=0, num=remaining, withscores=True))
+        else:
+            page.extend(await r.zrangebyscore(key, min_score, max_score, start=0, num=remaining, withscores=True))
+    return page
+
+
+async def page_after(r, key, after, min_score, max_score, count, reverse):
+    """The count members of one sorted set that follow the after vCon"""
+    score, vcon_uuid = after
+    member = vcon_key(vcon_uuid).encode("utf-8")
+    async with r.pipeline(transaction=False) as pipe:
+        if reverse:
+            pipe.zrevrank(key, member)
+        else:
+            pipe.zrank(key, member)
+        pipe.zscore(key, member)
+        rank, current_score = await pipe.execute()
+
+    if rank is not None and current_score == score:
+        if reverse:
+            members = await r.zrevrange(key, rank + 1, rank + count, withscores=True)
+            return [(m, s) for m, s in members if min_score == "-inf" or s >= min_score]
+        members = await r.zrange(key, rank + 1, rank + count, withscores=True)
+        return [(m, s) for m, s in members if max_score == "+inf" or s <= max_score]
+
+    # The vCon is gone or moved, continue from its score.  Members with the
+    # same score are ordered by member.
+    if reverse:
+        ties = await r.zrevrangebyscore(key, score, score, withscores=True)
+        page = [(m, s) for m, s in ties if m < member][:count]
+        if len(page) < count:
+            page.extend(await r.zrevrangebyscore(
+                key, f"({score}", min_score, start=0, num=count - len(page), withscores=True
+            ))
+    else:
+        ties = await r.zrangebyscore(key, score, score, withscores=True)
+        page = [(m, s) for m, s in ties if m > member][:count]
+        if len(page) < count:
+            page.extend(await r.zrangebyscore(
+                key, f"({score}", max_score, start=0, num=count - len(page), withscores=True
+            ))
+    return page
+
+
+async def get_vcons_sorted_set_keys(r, vcon_ids):
+    """The sorted set each of the vCons is in, from its created_at, None
+    for a vCon that is gone"""
+    if not REDIS_CLUSTER:
+        return [VCON_SORTED_SET_NAME] * len(vcon_ids)
+    created_ats = await json_mget(r, [vcon_key(vcon_id) for vcon_id in vcon_ids], "$.created_at")
+    return [
+        sorted_set_key(created_at_timestamp(created_at[0])) if created_at else None
+        for created_at in created_ats
+    ]
+
+
+def index_key(index, value):
+    if index == "mailto":
+        value = value.lower()
+    return f"{INDEX_PREFIX}:{index}:{value}"
+
+
+def vcon_index_keys_key(vcon_id):
+    return f"vcon_index_keys:{hash_tag(vcon_id)}"
+
+
+def vcon_index_keys(vcon_dict):
+    """Returns the index keys a vCon belongs in"""
+    keys = set()
+    for index, (section, field) in INDEXES.items():
+        for element in vcon_dict.get(section) or []:
+            value = element.get(field) if isinstance(element, dict) else None
+            if value is not None and value != "":
+                keys.add(index_key(index, value))
+    return keys
+
+
+def queue_index_update(pipe, vcon_dict, old_keys, rescore=False):
+    """Queue on pipe the commands moving a vCon from the index keys in
+    old_keys to those of its current content, rescoring it in all of them
+    if rescore, e.g. when its created_at changed.  Returns False if there
+    is nothing to change."""
+    vcon_id = vcon_dict["uuid"]
+    keys_key = vcon_index_keys_key(vcon_id)
+    new_keys = vcon_index_keys(vcon_dict)
+    added = new_keys if rescore else new_keys - old_keys
+    removed = old_keys - new_keys
+    if not added and not removed:
+        return False
+
+    created_at = vcon_dict.get("created_at")
+    score = created_at_timestamp(created_at) if created_at else 0
+    for key in removed:
+        pipe.zrem(key, vcon_id)
+    for key in added:
+        pipe.zadd(key, {vcon_id: score})
+    if removed:
+        pipe.srem(keys_key, *removed)
+    if added:
+        pipe.sadd(keys_key, *added)
+    return True
+
+
+async def update_vcon_indexes(r, vcon_dict, old_keys=None, rescore=False):
+    """Move a vCon to the index keys of its current content.
+
+    The vCon is already stored, so an error is logged and returned rather
+    than raised, its index entries are fixed by the next change or rebuild.
+
+    Args:
+        r: async redis client
+        vcon_dict (dict): the vCon
+        old_keys (set): the index keys the vCon was in, read from redis if
+            not known, e.g. from a snapshot of the vCon as it was loaded
+        rescore (bool): the created_at of the vCon changed
+
+    Returns:
+        Exception: the error indexing the vCon, None if it was indexed
+    """
+    if not VCON_INDEX_ENABLED:
+        return None
+    try:
+        if old_keys is None:
+            old_keys = {key.decode("utf-8") for key in await r.smembers(vcon_index_keys_key(vcon_dict["uuid"]))}
+        async with r.pipeline(transaction=False) as pipe:
+            if queue_index_update(pipe, vcon_dict, old_keys, rescore):
+                await pipe.execute()
+    except Exception as e:
+        logger.error("Error indexing vCon %s: %s", vcon_dict.get("uuid"), e)
+        return e
+    return None
+
+
+async def update_vcons_indexes(r, vcon_dicts):
+    """update_vcon_indexes for several vCons, in two round trips
+
+    Returns:
+        list: the error indexing each vCon, None for those indexed
+    """
+    errors = [None] * len(vcon_dicts)
+    if not VCON_INDEX_ENABLED or not vcon_dicts:
+        return errors
+    try:
+        async with r.pipeline(transaction=False) as pipe:
+            for vcon_dict in vcon_dicts:
+                pipe.smembers(vcon_index_keys_key(vcon_dict["uuid"]))
+            old_keys = await pipe.execute()
+    except Exception as e:
+        logger.error("Error reading the index keys of %s vCons: %s", len(vcon_dicts), e)
+        return [e] * len(vcon_dicts)
+
+    async with r.pipeline(transaction=False) as pipe:
+        # Range of the replies of each vCon in the pipeline
+        queued = {}
+        for position, (vcon_dict, keys) in enumerate(zip(vcon_dicts, old_keys)):
+            start = len(pipe)
+            try:
+                queue_index_update(pipe, vcon_dict, {key.decode("utf-8") for key in keys})
+            except Exception as e:
+                errors[position] = e
+                continue
+            if len(pipe) > start:
+                queued[position] = (start, len(pipe))
+        if queued:
+            total = len(pipe)
+            try:
+                results = await pipe.execute(raise_on_error=False)
+            except Exception as e:
+                results = [e] * total
+            for position, (start, end) in queued.items():
+                errors[position] = next(
+                    (result for result in results[start:end] if isinstance(result, Exception)), None
+                )
+    for vcon_dict, error in zip(vcon_dicts, errors):
+        if error is not None:
+            logger.error("Error indexing vCon %s: %s", vcon_dict.get("uuid"), error)
+    return errors
+
+
+async def remove_vcon_indexes(r, vcon_id):
+    """Remove a vCon from all its index keys"""
+    keys_key = vcon_index_keys_key(vcon_id)
+    keys = await r.smembers(keys_key)
+    async with r.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.zrem(key, vcon_id)
+        pipe.delete(keys_key)
+        await pipe.execute()
+
+
+async def search_vcons(r, criteria, since=None, until=None, limit=50):
+    """Returns the UUIDs of the vCons matching all the criteria, most
+    recently created first.
+
+    Args:
+        r: async redis client
+        criteria (dict): index name to value, e.g. {"tel": "+15551234567"}
+        since (int): only vCons created at or after this unix timestamp
+        until (int): only vCons created at or before this unix timestamp
+        limit (int): maximum number of UUIDs returned
+    """
+    keys = [index_key(index, value) for index, value in criteria.items() if value]
+    if not keys:
+        raise ValueError("At least one search criteria is required")
+    max_score = until if until is not None else "+inf"
+    min_score = since if since is not None else "-inf"
+    if len(keys) == 1:
+        vcon_ids = await r.zrevrangebyscore(keys[0], max_score, min_score, start=0, num=limit)
+    elif REDIS_CLUSTER:
+        # The indexes are in different slots, intersect them here
+        return await intersect_indexes(r, keys, max_score, min_score, limit)
+    else:
+        # Intersect into a short lived key, in the same transaction as the read
+        result_key = f"{INDEX_PREFIX}:search:{uuid.uuid4()}"
+        async with r.pipeline(transaction=True) as pipe:
+            pipe.zinterstore(result_key, keys, aggregate="MAX")
+            pipe.zrevrangebyscore(result_key, max_score, min_score, start=0, num=limit)
+            pipe.delete(result_key)
+            _, vcon_ids, _ = await pipe.execute()
+    return [vcon_id.decode("utf-8") for vcon_id in vcon_ids]
+
+
+async def intersect_indexes(r, keys, max_score, min_score, limit):
+    """Pages through the first index, keeping the UUIDs that are in every
+    other index, checked with one pipeline of ZSCORE per page"""
+    vcon_ids = []
+    offset = 0
+    while len(vcon_ids) < limit:
+        page = await r.zrevrangebyscore(keys[0], max_score, min_score, start=offset, num=limit)
+        if not page:
+            break
+        async with r.pipeline(transaction=False) as pipe:
+            for vcon_id in page:
+                for key in keys[1:]:
+                    pipe.zscore(key, vcon_id)
+            scores = await pipe.execute()
+        others = len(keys) - 1
+        for position, vcon_id in enumerate(page):
+            if all(score is not None for score in scores[position * others:(position + 1) * others]):
+                vcon_ids.append(vcon_id.decode("utf-8"))
+        offset += len(page)
+    return vcon_ids[:limit]
+
+
+async def get_rebuild_progress(r):
+    """Returns the status and counts of the last sorted set rebuild"""
+    progress = await r.hgetall(REBUILD_PROGRESS_KEY)
+    return {key.decode("utf-8"): value.decode("utf-8") for key, value in progress.items()}
+
+
+async def rebuild_recently(r, interval=VCON_SORTED_REBUILD_INTERVAL):
+    """True if a rebuild completed less than interval seconds ago"""
+    progress = await get_rebuild_progress(r)
+    if progress.get("status") != "done":
+        return False
+    return time.time() - float(progress.get("started_at", 0)) < interval
+
+
+async def rebuild_sorted_set(r, batch_size=VCON_SORTED_REBUILD_BATCH_SIZE):
+    """Rebuild the vCon sorted set from the vCons in redis.
+
+    Runs under a distributed lock so only one API worker rebuilds at a time,
+    while the sorted set stays in use.  The vCon keys are SCANned in batches,
+    only their $.created_at is fetched, with one JSON.MGET per batch, and they
+    are added with one ZADD per batch.  Members whose vCon no longer exists
+    are then removed, also in batches.  Progress is kept in the
+    REBUILD_PROGRESS_KEY hash.
+
+    Returns:
+        bool: False if another rebuild holds the lock
+    """
+    lock = r.lock(REBUILD_LOCK_KEY, timeout=REBUILD_LOCK_TIMEOUT)
+    if not await lock.acquire(blocking=False):
+        logger.info("Sorted set %s is being rebuilt by another worker", VCON_SORTED_SET_NAME)
+        return False
+
+    progress = {"status": "running", "started_at": time.time(), "scanned": 0, "indexed": 0, "removed": 0}
+    await r.delete(REBUILD_PROGRESS_KEY)
+    await r.hset(REBUILD_PROGRESS_KEY, mapping=progress)
+    try:
+        # Add every vCon
+        async for keys in scan_keys(r, "vcon:*", count=batch_size, _type="ReJSON-RL"):
+            created_ats = await json_mget(r, keys, "$.created_at")
+            members = {}
+            for key, created_at in zip(keys, created_ats):
+                if not created_at:
+                    continue
+                try:
+                    members[key] = created_at_timestamp(created_at[0])
+                except (TypeError, ValueError):
+                    logger.warning("Cannot index %s with created_at %s", key, created_at)
+            if members:
+                await add_to_sorted_set(r, members)
+                if VCON_INDEX_ENABLED:
+                    await add_secondary_indexes(r, members)
+            progress["scanned"] += len(keys)
+            progress["indexed"] += len(members)
+            await update_progress(r, lock, progress)
+
+        # Drop the members of vCons that are gone
+        for sorted_set in await get_sorted_set_keys(r):
+            cursor = None
+            while cursor != 0:
+                cursor, members = await r.zscan(sorted_set, cursor or 0, count=batch_size)
+                if members:
+                    async with r.pipeline(transaction=False) as pipe:
+                        for member, _ in members:
+                            pipe.exists(member)
+                        exists = await pipe.execute()
+                    missing = [member for (member, _), found in zip(members, exists) if not found]
+                    if missing:
+                        await r.zrem(sorted_set, *missing)
+                    progress["removed"] += len(missing)
+                await update_progress(r, lock, progress)
+
+        progress["status"] = "done"
+        progress["finished_at"] = time.time()
+        logger.info(
+            "Rebuilt sorted set %s, indexed %s of %s vCons, removed %s",
+            VCON_SORTED_SET_NAME, progress["indexed"], progress["scanned"], progress["removed"]
+        )
+    except Exception as e:
+        progress["status"] = "failed"
+        progress["error"] = repr(e)
+        raise
+    finally:
+        await r.hset(REBUILD_PROGRESS_KEY, mapping=progress)
+        try:
+            await lock.release()
+        except LockError:
+            pass
+    return True
+
+
+def start_rebuild(r, batch_size=VCON_SORTED_REBUILD_BATCH_SIZE):
+    """Run rebuild_sorted_set in the background.  Returns its task, which
+    logs the error the rebuild fails with and records it in the progress hash."""
+    task = asyncio.create_task(rebuild_sorted_set(r, batch_size))
+    task.add_done_callback(lambda task: _rebuild_done(r, task))
+    return task
+
+
+def _rebuild_done(r, task):
+    if task.cancelled() or task.exception() is None:
+        return
+    error = task.exception()
+    logger.error("Rebuilding sorted set %s failed", VCON_SORTED_SET_NAME, exc_info=error)
+    # Also covers a failure before the rebuild recorded any progress
+    asyncio.ensure_future(_record_rebuild_error(r, error))
+
+
+async def _record_rebuild_error(r, error):
+    try:
+        await r.hset(REBUILD_PROGRESS_KEY, mapping={"status": "failed", "error": repr(error)})
+    except Exception:
+        logger.exception("Cannot record the failure of the sorted set rebuild")
+
+
+async def add_secondary_indexes(r, members):
+    """Add a batch of vCons to the secondary indexes, fetching only the
+    indexed fields with one JSON.MGET per field.
+
+    Args:
+        members (dict): vCon key to created_at score
+    """
+    keys = list(members)
+    columns = await asyncio.gather(*[
+        json_mget(r, keys, f"$.{section}[*].{field}") for section, field in INDEXES.values()
+    ])
+
+    async with r.pipeline(transaction=False) as pipe:
+        for position, key in enumerate(keys):
+            vcon_id = vcon_id_from_key(key)
+            index_keys = set()
+            for (index, _), values in zip(INDEXES.items(), columns):
+                for value in values[position] or []:
+                    if value is not None and value != "":
+                        index_keys.add(index_key(index, value))
+            for index_key_name in index_keys:
+                pipe.zadd(index_key_name, {vcon_id: members[key]})
+            if index_keys:
+                pipe.sadd(vcon_index_keys_key(vcon_id), *index_keys)
+        await pipe.execute()
+
+
+async def update_progress(r, lock, progress):
+    """Record the progress and keep the lock alive between batches"""
+    now = time.time()
+    progress["updated_at"] = now
+    await r.hset(REBUILD_PROGRESS_KEY, mapping=progress)
+    await lock.reacquire()
+    if now - progress.get("logged_at", progress["started_at"]) >= REBUILD_LOG_INTERVAL:
+        logger.info(
+            "Rebuilding sorted set %s: scanned %s, indexed %s, removed %s",
+            VCON_SORTED_SET_NAME, progress["scanned"], progress["indexed"], progress["removed"]
+        )
+        progress["logged_at"] = now
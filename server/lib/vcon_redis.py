@@ -1,13 +1,163 @@
+import copy
 import json
-from typing import Optional
+import weakref
+from typing import List, Optional
 import redis.asyncio as redis
 from lib.logging_utils import init_logger
 from redis.commands.json.path import Path
 import redis_mgr
 import vcon
+from lib.redis_cluster import (json_get, json_loads, json_mget, pipeline,
+                                queue_json_arrappend, queue_json_delete,
+                                queue_json_set, vcon_key)
+from lib.vcon_cache import get_vcon_cache, queue_version_incr, vcon_version_key
+from lib.vcon_index import INDEXED_SECTIONS, update_vcon_indexes, update_vcons_indexes, vcon_index_keys
+from settings import VCON_REDIS_CHUNK_SIZE
 
 logger = init_logger(__name__)
 
+# Copy of each vCon as it is in redis, for the vCons loaded with track_changes.
+# The copy shares the strings of the vCon, so it costs the number of objects in
+# the vCon rather than its size, and comparing the two mostly compares identities.
+_snapshots = weakref.WeakKeyDictionary()
+
+
+def _snapshot(vCon):
+    _snapshots[vCon] = copy.deepcopy(vCon.to_dict())
+
+
+def transfer_snapshot(source, target):
+    """Track the changes of target against the snapshot of source, for a
+    copy of a vCon loaded with track_changes, such as the one returned by a
+    link on a process executor.  Returns False if source has no snapshot."""
+    snapshot = _snapshots.get(source)
+    if snapshot is None:
+        return False
+    _snapshots[target] = snapshot
+    return True
+
+
+def vcon_changes(snapshot, current):
+    """Returns the redis JSON commands turning the snapshot of a vCon into its
+    current content, as (command, path, values) tuples.
+
+    Sections only appended to, such as analysis and attachments, become a
+    JSON.ARRAPPEND of the new elements, elements changed in place a JSON.SET of
+    the element, and any other change a JSON.SET or JSON.DEL of the section.
+    """
+    changes = []
+    for name, value in current.items():
+        path = f"$.{name}"
+        if name not in snapshot:
+            changes.append(("set", path, [value]))
+            continue
+        before = snapshot[name]
+        if value == before:
+            continue
+        if isinstance(value, list) and isinstance(before, list):
+            if len(value) > len(before) and value[:len(before)] == before:
+                changes.append(("arrappend", path, value[len(before):]))
+                continue
+            if len(value) == len(before):
+                for index, (element, element_before) in enumerate(zip(value, before)):
+                    if element != element_before:
+                        changes.append(("set", f"{path}[{index}]", [element]))
+                continue
+        changes.append(("set", path, [value]))
+    for name in snapshot:
+        if name not in current:
+            changes.append(("delete", f"$.{name}", []))
+    return changes
+
+
+# Top level sections of a vCon, and those that are lists of dicts
+VCON_SECTIONS = [name for name, value in vars(vcon.Vcon).items() if isinstance(value, vcon.VconAttribute)]
+VCON_LIST_SECTIONS = [name for name, value in vars(vcon.Vcon).items() if isinstance(value, vcon.VconDictList)]
+
+
+class UnloadedVconSection(Exception):
+    """A section of a partial vCon that was not loaded from redis was read"""
+
+
+class PartialVconSection(vcon.VconAttribute):
+    """Section of a PartialVcon, raising UnloadedVconSection if it was not loaded"""
+
+    def __get__(self, instance_object, class_type=None):
+        if instance_object is None:
+            return self
+        if self.name not in instance_object._loaded_sections:
+            raise UnloadedVconSection(
+                f"vCon section {self.name} was not loaded, add it to the paths passed to get_vcon"
+            )
+        return super().__get__(instance_object, class_type)
+
+
+class PartialVcon(vcon.Vcon):
+    """Read only vCon holding only the sections loaded by
+    VconRedis.get_vcon(vcon_id, paths=[...]).
+
+    Reading a section that was not loaded raises UnloadedVconSection.  It
+    cannot be modified, serialized or stored, so it can never overwrite the
+    full vCon in redis.  Only fields of the elements of its sections can be
+    set, with set_element_field, and are written alone by
+    VconRedis.store_partial_vcon.
+    """
+
+    def __init__(self, loaded_sections):
+        self._loaded_sections = set(loaded_sections) | {"uuid"}
+        # (JSONPath, value) of the fields set since the vCon was loaded or stored
+        self._updates = []
+        super().__init__()
+
+    def set_element_field(self, section, index, field, value):
+        """Set a field of an element of a loaded list section, recording it
+        for store_partial_vcon"""
+        getattr(self, section)[index][field] = value
+        self._updates.append((f"$.{section}[{index}].{field}", value))
+
+    def _attempting_modify(self) -> None:
+        raise vcon.InvalidVconState("Cannot modify a partial vCon, it is read only")
+
+    def to_dict(self, signed=True) -> dict:
+        raise vcon.InvalidVconState("Cannot serialize a partial vCon, load the full vCon instead")
+
+
+for _section in VCON_SECTIONS:
+    _descriptor = PartialVconSection()
+    _descriptor.__set_name__(PartialVcon, _section)
+    setattr(PartialVcon, _section, _descriptor)
+
+
+def set_element_field(vCon, section, index, field, value):
+    """Set a field of an element of a list section of a vCon, such as a flag
+    on an analysis, on a full vCon as on a PartialVcon, so a link declaring
+    vcon_paths works on both."""
+    setter = getattr(vCon, "set_element_field", None)
+    if setter is not None:
+        setter(section, index, field, value)
+    else:
+        getattr(vCon, section)[index][field] = value
+
+
+def parse_vcon_paths(paths):
+    """Returns the sections to load for get_vcon paths, mapped to None to
+    load the whole section, or to the fields to load from each element.
+
+    A path is the name of a section, such as "analysis", or a section and a
+    field of its elements, such as "dialog.url".
+    """
+    sections = {}
+    for path in paths:
+        section, _, field = path.partition(".")
+        if section not in VCON_SECTIONS:
+            raise ValueError(f"Unknown vCon section {section} in path {path}")
+        if not field or section not in VCON_LIST_SECTIONS:
+            sections[section] = None
+        elif sections.get(section, []) is not None:
+            sections.setdefault(section, []).append(field)
+    return sections
+
+
 class VconRedis:
     """Encapsulate vcon redis operation"""
 
@@ -29,24 +179,255 @@ class VconRedis:
         Args:
             vCon (vcon.Vcon): this vCon gets stored in redis
         """
-        key = f"vcon:{vCon.uuid}"
-        cleanvCon = json.loads(vCon.dumps())
-        await self._redis_client.json().set(key, Path.root_path(), cleanvCon)
+        key = vcon_key(vCon.uuid)
+        # Serialize once, as Vcon.dumps does, the same JSON goes to redis and to the cache
+        data = vCon.dumps()
+        async with pipeline(self._redis_client, transaction=True) as pipe:
+            pipe.execute_command("JSON.SET", key, Path.root_path(), data)
+            queue_version_incr(pipe, vCon.uuid)
+            results = await pipe.execute()
+        cache = get_vcon_cache()
+        if cache:
+            cache.put(vCon.uuid, results[1], data.encode("utf-8"))
+        snapshot = _snapshots.get(vCon)
+        await update_vcon_indexes(
+            self._redis_client, vCon.to_dict(), vcon_index_keys(snapshot) if snapshot is not None else None
+        )
+        if snapshot is not None:
+            _snapshot(vCon)
+
+    async def store_vcons(self, vcons: List[vcon.Vcon], chunk_size: Optional[int] = None):
+        """Stores several vcons into redis, with one pipeline of JSON.SET
+        per chunk of vcons
+
+        Args:
+            vcons (List[vcon.Vcon]): these vCons get stored in redis
+            chunk_size (int): vCons per pipeline, VCON_REDIS_CHUNK_SIZE by default
+        """
+        chunk_size = chunk_size or VCON_REDIS_CHUNK_SIZE
+        for start in range(0, len(vcons), chunk_size):
+            async with self._redis_client.pipeline(transaction=False) as pipe:
+                for vCon in vcons[start:start + chunk_size]:
+                    pipe.execute_command("JSON.SET", vcon_key(vCon.uuid), Path.root_path(), vCon.dumps())
+                    queue_version_incr(pipe, vCon.uuid)
+                await pipe.execute()
+        await update_vcons_indexes(self._redis_client, [vCon.to_dict() for vCon in vcons])
+        cache = get_vcon_cache()
+        for vCon in vcons:
+            if cache:
+                cache.invalidate(vCon.uuid)
+            if vCon in _snapshots:
+                _snapshot(vCon)
+
+    async def store_vcon_changes(self, vCon: vcon.Vcon) -> int:
+        """Stores only the sections of the vcon changed since it was loaded
+        with track_changes, in a single transaction, so the cost of storing
+        follows the size of the change rather than the size of the vCon.
+
+        Falls back to store_vcon for a vCon that was not loaded with
+        track_changes.
+
+        Args:
+            vCon (vcon.Vcon): this vCon gets stored in redis
+
+        Returns:
+            int: the number of JSON commands sent, 0 if nothing changed
+        """
+        snapshot = _snapshots.get(vCon)
+        if snapshot is None:
+            await self.store_vcon(vCon)
+            return 1
+
+        changes = vcon_changes(snapshot, vCon.to_dict())
+        if not changes:
+            return 0
+        key = vcon_key(vCon.uuid)
+        async with pipeline(self._redis_client, transaction=True) as pipe:
+            for command, path, values in changes:
+                if command == "arrappend":
+                    queue_json_arrappend(pipe, key, path, *values)
+                elif command == "set":
+                    queue_json_set(pipe, key, path, values[0])
+                else:
+                    queue_json_delete(pipe, key, path)
+            queue_version_incr(pipe, vCon.uuid)
+            await pipe.execute()
+        cache = get_vcon_cache()
+        if cache:
+            cache.invalidate(vCon.uuid)
+        if any(path[2:].split("[")[0] in INDEXED_SECTIONS for _, path, _ in changes):
+            await update_vcon_indexes(
+                self._redis_client, vCon.to_dict(), vcon_index_keys(snapshot),
+                rescore=snapshot.get("created_at") != vCon.to_dict().get("created_at"),
+            )
+        _snapshot(vCon)
+        return len(changes)
+
+    async def store_partial_vcon(self, partial_vcon: PartialVcon) -> int:
+        """Stores the fields set on a PartialVcon with set_element_field, one
+        JSON.SET per field, in a single transaction.  The fields must not be
+        ones the secondary indexes are built on.
+
+        Returns:
+            int: the number of fields stored, 0 if none were set
+        """
+        updates = partial_vcon._updates
+        if not updates:
+            return 0
+        key = vcon_key(partial_vcon.uuid)
+        async with pipeline(self._redis_client, transaction=True) as pipe:
+            for path, value in updates:
+                queue_json_set(pipe, key, path, value)
+            queue_version_incr(pipe, partial_vcon.uuid)
+            await pipe.execute()
+        cache = get_vcon_cache()
+        if cache:
+            cache.invalidate(partial_vcon.uuid)
+        partial_vcon._updates = []
+        return len(updates)
 
-    async def get_vcon(self, vcon_id: str) -> Optional[vcon.Vcon]:
+    async def get_vcon(
+        self, vcon_id: str, track_changes: bool = False, paths: Optional[List[str]] = None
+    ) -> Optional[vcon.Vcon]:
         """Retrives the vcon from redis for given vcon_id
 
         Args:
             vcon_id (str): vcon id
+            track_changes (bool): keep a snapshot of the vCon so that
+                store_vcon_changes only writes what changed
+            paths (List[str]): only load these sections, such as "analysis",
+                or fields of the elements of a section, such as "dialog.url",
+                and return a read only PartialVcon
 
         Returns:
             Optional[vcon.Vcon]: Returns vcon for givin vcon id or None if vcon is not present.
         """
-        vcon_dict = await self._redis_client.json().get(
-            f"vcon:{vcon_id}", Path.root_path()
-        )
+        if paths:
+            return await self.get_partial_vcon(vcon_id, paths)
+        if get_vcon_cache():
+            vcon_dict = await self._get_cached_vcon_dict(vcon_id)
+        else:
+            vcon_dict = await json_get(
+                self._redis_client, vcon_key(vcon_id), Path.root_path()
+            )
         if not vcon_dict:
             return None
-        _vcon = vcon.Vcon()
-        _vcon.loads(json.dumps(vcon_dict))
+        # The dict is already parsed, build the vCon from it directly
+        _vcon = vcon.Vcon.from_dict(vcon_dict)
+        if track_changes:
+            _snapshot(_vcon)
         return _vcon
+
+    async def _get_cached_vcon_dict(self, vcon_id: str) -> Optional[dict]:
+        """Returns the vCon from the cache if its version is still the one
+        in redis, otherwise reads it and its version and caches them."""
+        cache = get_vcon_cache()
+        version_key = vcon_version_key(vcon_id)
+        entry = cache.get(vcon_id)
+        if entry is not None:
+            version = await self._redis_client.get(version_key)
+            if version is not None and int(version) == entry[0]:
+                cache.hits += 1
+                return json.loads(entry[1])
+        cache.misses += 1
+
+        async with pipeline(self._redis_client, transaction=True) as pipe:
+            pipe.execute_command("JSON.GET", vcon_key(vcon_id))
+            pipe.get(version_key)
+            data, version = await pipe.execute()
+        if data is None:
+            cache.invalidate(vcon_id)
+            return None
+        # vCons written without a version, by older code, are not cached
+        if version is not None:
+            cache.put(vcon_id, int(version), data)
+        return json.loads(data)
+
+    async def get_vcons(
+        self, vcon_ids: List[str], chunk_size: Optional[int] = None
+    ) -> List[Optional[vcon.Vcon]]:
+        """Retrives several vcons from redis, with one JSON.MGET per chunk
+        of vcon ids
+
+        Args:
+            vcon_ids (List[str]): vcon ids
+            chunk_size (int): vCons per JSON.MGET, VCON_REDIS_CHUNK_SIZE by default
+
+        Returns:
+            List[Optional[vcon.Vcon]]: the vcons in the order of vcon_ids, None
+            for the ids that are not present
+        """
+        chunk_size = chunk_size or VCON_REDIS_CHUNK_SIZE
+        vcons = []
+        for start in range(0, len(vcon_ids), chunk_size):
+            keys = [vcon_key(vcon_id) for vcon_id in vcon_ids[start:start + chunk_size]]
+            vcon_dicts = await json_mget(self._redis_client, keys, Path.root_path())
+            vcons.extend(
+                vcon.Vcon.from_dict(vcon_dict) if vcon_dict else None for vcon_dict in vcon_dicts
+            )
+        return vcons
+
+    async def get_partial_vcon(self, vcon_id: str, paths: List[str]) -> Optional[PartialVcon]:
+        """Loads only the given paths of a vCon, see get_vcon.
+
+        The sections and fields are fetched with a single JSON.GET of several
+        JSONPaths, so inline recordings in sections that are not asked for are
+        not transferred.  A section whose elements do not all have the fields
+        asked for is loaded whole.
+        """
+        key = vcon_key(vcon_id)
+        sections = parse_vcon_paths(paths)
+        json_paths = ["$.uuid"]
+        for section, fields in sections.items():
+            if fields is None:
+                json_paths.append(f"$.{section}")
+            else:
+                json_paths.extend(f"$.{section}[*].{field}" for field in fields)
+
+        async with self._redis_client.pipeline(transaction=False) as pipe:
+            pipe.execute_command("JSON.GET", key, *json_paths)
+            for section, fields in sections.items():
+                if fields is not None:
+                    pipe.execute_command("JSON.ARRLEN", key, f"$.{section}")
+            results = await pipe.execute(raise_on_error=False)
+        reply = results[0]
+        if not reply or isinstance(reply, Exception):
+            return None
+        reply = json_loads(reply)
+        lengths = iter(results[1:])
+
+        vcon_dict = {"uuid": vcon_id}
+        whole_sections = []
+        for section, fields in sections.items():
+            if fields is None:
+                values = reply.get(f"$.{section}") or [None]
+                vcon_dict[section] = values[0]
+                whole_sections.append(section)
+                continue
+            length = next(lengths)
+            length = length[0] if isinstance(length, list) and length else None
+            if length is None:
+                vcon_dict[section] = None
+                continue
+            columns = {field: reply.get(f"$.{section}[*].{field}") or [] for field in fields}
+            if any(len(values) != length for values in columns.values()):
+                whole_sections.append(section)
+                continue
+            vcon_dict[section] = [
+                {field: columns[field][index] for field in fields} for index in range(length)
+            ]
+
+        missing = [section for section in whole_sections if section not in vcon_dict]
+        if missing:
+            reply = await json_get(self._redis_client, key, "$.uuid", *[f"$.{section}" for section in missing])
+            for section in missing:
+                values = (reply or {}).get(f"$.{section}") or [None]
+                vcon_dict[section] = values[0]
+
+        # Only whole sections can be migrated, fields of elements are returned as stored
+        vcon.Vcon.migrate_0_0_1_vcon(
+            {section: vcon_dict[section] for section in whole_sections if vcon_dict[section] is not None}
+        )
+        partial_vcon = PartialVcon(sections)
+        partial_vcon._vcon_dict = vcon_dict
+        return partial_vcon
@@ -9,6 +9,8 @@ default_options = {
     "analysis_type": "summary",
     "model": "gpt-4"
 }
+# openai.ChatCompletion.create is synchronous, keep it off the event loop
+default_executor = "thread"
 
 
 def get_analysys_for_type(vcon, index, analysis_type):
@@ -31,20 +33,16 @@ def generate_analysis(transcript, prompt, model):
     return sentiment_result["choices"][0]["message"]["content"]
 
 
-async def run(
-    vcon_uuid,
+async def run_vcon(
+    vCon,
     opts=default_options,
 ):
     link_name = __name__.split(".")[-1]
-    logger.info(f"Starting {link_name} plugin for: {vcon_uuid}")
+    logger.info(f"Starting {link_name} plugin for: {vCon.uuid}")
     merged_opts = default_options.copy()
     merged_opts.update(opts)
     opts = merged_opts
     propogate_to_next_link = True
-    # Cannot create redis client in global context as it will wait on async event
-    # loop which may go away.
-    vcon_redis = VconRedis()
-    vCon = await vcon_redis.get_vcon(vcon_uuid)
 
     openai.api_key = opts["OPENAI_API_KEY"]
 
@@ -64,7 +62,20 @@ async def run(
         vCon.add_analysis_transcript(
             index, analysis, "openai", analysis_type=opts["analysis_type"]
         )
-    await vcon_redis.store_vcon(vCon)
 
     if propogate_to_next_link:
+        return vCon
+
+
+async def run(
+    vcon_uuid,
+    opts=default_options,
+):
+    # Cannot create redis client in global context as it will wait on async event
+    # loop which may go away.
+    vcon_redis = VconRedis()
+    vCon = await vcon_redis.get_vcon(vcon_uuid)
+    vCon = await run_vcon(vCon, opts)
+    if vCon:
+        await vcon_redis.store_vcon(vCon)
         return vcon_uuid
@@ -8,16 +8,14 @@ logger = init_logger(__name__)
 default_options = {
     "prompt": "Anonymize this conversation, using friendly names: ",
 }
+# openai.Completion.create is synchronous, keep it off the event loop
+default_executor = "thread"
 
-async def run(
-    vcon_uuid,
+async def run_vcon(
+    vCon,
     opts=default_options,
 ):
     logger.debug("Starting anonymous")
-    # Cannot create redis client in global context as it will wait on async
-    # event loop which may go away.
-    vcon_redis = VconRedis()
-    vCon = await vcon_redis.get_vcon(vcon_uuid)
 
     # Find the transcript, if it exists.
     for analysis in vCon.analysis:
@@ -37,12 +35,22 @@ async def run(
             
             anonymous = summarize_result["choices"][0]["text"]                
             vCon.add_analysis(analysis['dialog'], 'anonymous', anonymous, 'openai', opts['prompt'])
-            
-
 
-    await vcon_redis.store_vcon(vCon)
-
-    # Return the vcon_uuid down the chain.
+    # Return the vCon down the chain.
     # If you want the vCon processing to stop (if you are filtering them, for instance)
     # send None
-    return vcon_uuid
+    return vCon
+
+
+async def run(
+    vcon_uuid,
+    opts=default_options,
+):
+    # Cannot create redis client in global context as it will wait on async
+    # event loop which may go away.
+    vcon_redis = VconRedis()
+    vCon = await vcon_redis.get_vcon(vcon_uuid)
+    vCon = await run_vcon(vCon, opts)
+    if vCon:
+        await vcon_redis.store_vcon(vCon)
+        return vcon_uuid
@@ -37,19 +37,15 @@ async def transcribe_dg(dg_client, dialog) -> Optional[dict]:
         return None
 
 
-async def run(
-    vcon_uuid,
+async def run_vcon(
+    vCon,
     opts=default_options,
 ):
     merged_opts = default_options.copy()
     merged_opts.update(opts)
     opts = merged_opts
     
-    logger.info("Starting deepgram plugin for vCon: %s", vcon_uuid)
-    # Cannot create reids client in global context as redis clients get started on async
-    # event loop which may go away.
-    vcon_redis = VconRedis()
-    vCon = await vcon_redis.get_vcon(vcon_uuid)
+    logger.info("Starting deepgram plugin for vCon: %s", vCon.uuid)
 
     for index, dialog in enumerate(vCon.dialog):
         if dialog["type"] != "recording":
@@ -85,10 +81,22 @@ async def run(
         vCon.add_analysis_transcript(
             index, result, "deepgram", analysis_type="transcript"
         )
-    await vcon_redis.store_vcon(vCon)
 
-    # Forward the vcon_uuid down the chain.
+    # Forward the vCon down the chain.
     # If you want the vCon processing to stop (if you are filtering them out, for instance)
     # send None
-    return vcon_uuid
+    return vCon
 
+
+async def run(
+    vcon_uuid,
+    opts=default_options,
+):
+    # Cannot create reids client in global context as redis clients get started on async
+    # event loop which may go away.
+    vcon_redis = VconRedis()
+    vCon = await vcon_redis.get_vcon(vcon_uuid)
+    vCon = await run_vcon(vCon, opts)
+    if vCon:
+        await vcon_redis.store_vcon(vCon)
+        return vcon_uuid
@@ -1,5 +1,6 @@
 import redis_mgr
 from lib.logging_utils import init_logger
+from lib.vcon_expiry import expire_vcon
 
 logger = init_logger(__name__)
 
@@ -7,6 +8,6 @@ default_options = { "seconds": 60 * 60 * 24 }
 async def run(vcon_uuid, opts=default_options):
     logger.debug("Starting expire_vcon::run")
     r = redis_mgr.get_client()
-    await r.expire(f"vcon:{vcon_uuid}", opts["seconds"])
+    await expire_vcon(r, vcon_uuid, opts["seconds"])
     logger.info(f"expire_vcon plugin: set expire for {vcon_uuid}")
     return vcon_uuid
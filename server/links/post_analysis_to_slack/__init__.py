@@ -1,4 +1,4 @@
-from server.lib.vcon_redis import VconRedis
+from server.lib.vcon_redis import VconRedis, set_element_field
 from lib.logging_utils import init_logger
 import json
 from slack_sdk.web import WebClient
@@ -15,6 +15,11 @@ default_options = {
         "includes": "NEEDS REVIEW"
     }
 }
+# The slack WebClient is synchronous, keep it off the event loop
+default_executor = "thread"
+# Only the analysis and the dealer attachments are read, the chain hands the
+# link a PartialVcon of them rather than loading the recordings
+vcon_paths = ["analysis", "attachments.type", "attachments.body"]
 
 
 def get_team(vcon):
@@ -95,23 +100,18 @@ def post_blocks_to_channel(token, channel_name, abstract, url, opts):
         logger.error(f"An error occurred posting to {channel_name}: {e}")
 
 
-async def run(
-    vcon_id,
+async def run_vcon(
+    vcon,
     opts=default_options
 ):
     link_name = __name__.split(".")[-1]
-    logger.info(f"Starting {link_name} plugin for: {vcon_id}")
+    logger.info(f"Starting {link_name} plugin for: {vcon.uuid}")
     merged_opts = default_options.copy()
     merged_opts.update(opts)
     opts = merged_opts
     propogate_to_next_link = True
 
-    # Cannot create redis client in global context as it will wait on async event
-    # loop which may go away.
-    vcon_redis = VconRedis()
-    vcon = await vcon_redis.get_vcon(vcon_id)
-
-    for a in vcon.analysis:
+    for index, a in enumerate(vcon.analysis):
         if a['type'] != opts["only_if"]["analysis_type"]:
             continue
         if opts["only_if"]["includes"] not in a['body']:
@@ -131,10 +131,22 @@ async def run(
             post_blocks_to_channel(opts['token'], channel_name , abstract, url, opts)
 
         post_blocks_to_channel(opts['token'], opts["default_channel_name"] , abstract, url, opts)
-        a['was_posted_to_slack'] = True
-
-    await vcon_redis.store_vcon(vcon)
+        # Written back on its own when vcon is a PartialVcon
+        set_element_field(vcon, "analysis", index, "was_posted_to_slack", True)
 
     if propogate_to_next_link:
-        return vcon_id
+        return vcon
 
+
+async def run(
+    vcon_id,
+    opts=default_options
+):
+    # Cannot create redis client in global context as it will wait on async event
+    # loop which may go away.
+    vcon_redis = VconRedis()
+    vcon = await vcon_redis.get_vcon(vcon_id)
+    vcon = await run_vcon(vcon, opts)
+    if vcon:
+        await vcon_redis.store_vcon(vcon)
+        return vcon_id
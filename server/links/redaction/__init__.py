@@ -4,6 +4,7 @@ import dataprofiler as dp
 from dataprofiler import Profiler
 from dataprofiler.data_readers.text_data import TextData
 from lib.logging_utils import init_logger
+from lib.redis_cluster import vcon_key
 from redis.commands.json.path import Path
 import server.redis_mgr
 
@@ -42,7 +43,7 @@ async def start(opts=default_options):
                 message = await p.get_message()
                 if message:
                     vConUuid = message["data"].decode("utf-8")
-                    body = await r.get("vcon:{}".format(str(vConUuid)))
+                    body = await r.get(vcon_key(str(vConUuid)))
                     vCon = vcon.Vcon()
                     vCon.loads(body)
 
@@ -81,8 +82,8 @@ async def start(opts=default_options):
                         adapter_meta["type"] = "redaction"
                         adapter_meta["data"] = redacted_text
                         vCon.attachments.append(adapter_meta)
-                    await r.json().set(
-                        "vcon:{}".format(vCon.uuid), Path.root_path(), vCon.dumps()
+                    await r.execute_command(
+                        "JSON.SET", vcon_key(vCon.uuid), Path.root_path(), vCon.dumps()
                     )
 
                     for topic in opts["egress-topics"]:
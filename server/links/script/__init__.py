@@ -11,16 +11,14 @@ logger = init_logger(__name__)
 default_options = {
     "prompt": "Rewrite this transcript into speakers, speaking like they are from Boston : ",
 }
+# openai.Completion.create is synchronous, keep it off the event loop
+default_executor = "thread"
 
-async def run(
-    vcon_uuid,
+async def run_vcon(
+    vCon,
     opts=default_options,
 ):
     logger.debug("Starting script::run")
-    # Cannot create redis client in global context as it will wait on async
-    # event loop which may go away.
-    vcon_redis = VconRedis()
-    vCon = await vcon_redis.get_vcon(vcon_uuid)
 
  # Find the transcript, if it exists.
     for analysis in vCon.analysis:
@@ -49,9 +47,21 @@ async def run(
         # TODO: Add new mime type for script (text/plain)
         vCon.add_analysis(analysis['dialog'], 'script', script, 'openai', opts['prompt'])
 
-    await vcon_redis.store_vcon(vCon)
-
-    # Return the vcon_uuid down the chain.
+    # Return the vCon down the chain.
     # If you want the vCon processing to stop (if you are filtering them, for instance)
     # send None
-    return vcon_uuid
+    return vCon
+
+
+async def run(
+    vcon_uuid,
+    opts=default_options,
+):
+    # Cannot create redis client in global context as it will wait on async
+    # event loop which may go away.
+    vcon_redis = VconRedis()
+    vCon = await vcon_redis.get_vcon(vcon_uuid)
+    vCon = await run_vcon(vCon, opts)
+    if vCon:
+        await vcon_redis.store_vcon(vCon)
+        return vcon_uuid
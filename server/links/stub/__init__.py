@@ -0,0 +1,74 @@
+import asyncio
+import math
+import random
+import time
+from server.lib.vcon_redis import VconRedis
+from lib.logging_utils import init_logger
+logger = init_logger(__name__)
+
+# Stand in for a real link when measuring the conserver itself, it waits
+# for a latency drawn from a distribution and can burn some CPU.
+#
+# distribution: fixed, uniform (latency_ms +/- jitter_ms), exponential
+# (mean latency_ms) or lognormal (median latency_ms, shape sigma)
+default_options = {
+    "latency_ms": 0,
+    "distribution": "fixed",
+    "jitter_ms": 0,
+    "sigma": 0.5,
+    "cpu_ms": 0,
+}
+
+
+def sample_latency(opts):
+    """Returns a latency in seconds drawn from the distribution in opts"""
+    latency_ms = opts.get("latency_ms", 0)
+    distribution = opts.get("distribution", "fixed")
+    if latency_ms <= 0:
+        return 0
+    if distribution == "fixed":
+        sample = latency_ms
+    elif distribution == "uniform":
+        jitter_ms = opts.get("jitter_ms", 0)
+        sample = random.uniform(latency_ms - jitter_ms, latency_ms + jitter_ms)
+    elif distribution == "exponential":
+        sample = random.expovariate(1 / latency_ms)
+    elif distribution == "lognormal":
+        sample = random.lognormvariate(math.log(latency_ms), opts.get("sigma", 0.5))
+    else:
+        raise ValueError(f"Unknown latency distribution {distribution}")
+    return max(0, sample) / 1000
+
+
+async def run_vcon(
+    vCon,
+    opts=default_options,
+):
+    merged_opts = default_options.copy()
+    merged_opts.update(opts or {})
+    logger.debug("Starting stub::run for %s", vCon.uuid)
+
+    cpu_ms = merged_opts["cpu_ms"]
+    if cpu_ms > 0:
+        deadline = time.perf_counter() + cpu_ms / 1000
+        while time.perf_counter() < deadline:
+            pass
+
+    latency = sample_latency(merged_opts)
+    if latency:
+        await asyncio.sleep(latency)
+    return vCon
+
+
+async def run(
+    vcon_uuid,
+    opts=default_options,
+):
+    # Cannot create redis client in global context as it will wait on async
+    # event loop which may go away.
+    vcon_redis = VconRedis()
+    vCon = await vcon_redis.get_vcon(vcon_uuid)
+    vCon = await run_vcon(vCon, opts)
+    if vCon:
+        await vcon_redis.store_vcon(vCon)
+        return vcon_uuid
@@ -6,19 +6,28 @@ default_options = {
     "tags": ["iron", "maiden"],
 }
 
+async def run_vcon(
+    vCon,
+    opts=default_options,
+):
+    logger.debug("Starting tag::run")
+    vCon.add_analysis(0, 'tags', opts['tags'])
+
+    # Return the vCon down the chain.
+    # If you want the vCon processing to stop (if you are filtering them, for instance)
+    # send None
+    return vCon
+
+
 async def run(
     vcon_uuid,
     opts=default_options,
 ):
-    logger.debug("Starting tag::run")
     # Cannot create redis client in global context as it will wait on async
     # event loop which may go away.
     vcon_redis = VconRedis()
     vCon = await vcon_redis.get_vcon(vcon_uuid)
-    vCon.add_analysis(0, 'tags', opts['tags'])
-    await vcon_redis.store_vcon(vCon)
-
-    # Return the vcon_uuid down the chain.
-    # If you want the vCon processing to stop (if you are filtering them, for instance)
-    # send None
-    return vcon_uuid
+    vCon = await run_vcon(vCon, opts)
+    if vCon:
+        await vcon_redis.store_vcon(vCon)
+        return vcon_uuid
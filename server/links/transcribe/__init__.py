@@ -13,33 +13,42 @@ default_options = {
         "output_options": ["vendor"]
     }
 }
+# Whisper is CPU bound, keep it off the event loop
+default_executor = "process"
 
-async def run(
-    vcon_uuid,
+async def run_vcon(
+    vCon,
     opts=default_options,
 ):
     logger.debug("Starting transcribe::run")
-    # Cannot create the redis client in the global context as it will wait on async
-    # event loop which may go away.
-    vcon_redis = VconRedis()
-    vCon = await vcon_redis.get_vcon(vcon_uuid)
     original_analysis_count = len(vCon.analysis)
     annotated_vcon = vCon.transcribe(**opts["transcribe_options"])
     new_analysis_count = len(annotated_vcon.analysis)
     logger.debug(
         "transcribe plugin: vCon: {} analysis was: {} now: {}".format(
-            vcon_uuid, original_analysis_count, new_analysis_count
+            vCon.uuid, original_analysis_count, new_analysis_count
         )
     )
-    # If we added any analysis, save it
-    if new_analysis_count != original_analysis_count:
-        await vcon_redis.store_vcon(vCon)
 
-    # Return the vcon_uuid down the chain.
+    # Return the vCon down the chain.
     # If you want the vCon processing to stop (if you are filtering them, for instance)
     # send None
-    return vcon_uuid
-
-
+    return annotated_vcon
 
 
+async def run(
+    vcon_uuid,
+    opts=default_options,
+):
+    # Cannot create the redis client in the global context as it will wait on async
+    # event loop which may go away.
+    vcon_redis = VconRedis()
+    vCon = await vcon_redis.get_vcon(vcon_uuid)
+    original_analysis_count = len(vCon.analysis)
+    vCon = await run_vcon(vCon, opts)
+    if not vCon:
+        return None
+    # If we added any analysis, save it
+    if len(vCon.analysis) != original_analysis_count:
+        await vcon_redis.store_vcon(vCon)
+    return vcon_uuid
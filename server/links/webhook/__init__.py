@@ -8,12 +8,8 @@ default_options = {
     "webhook-urls": ["https://eo91qivu6evxsty.m.pipedream.net"],
 }
 
-async def run(vcon_uuid, opts=default_options,):
-    logger.debug("Starting transcribe::run")
-    # Cannot create redis client in global context as it will get created on async
-    # event loop which may go away.
-    vcon_redis = VconRedis()
-    vCon = await vcon_redis.get_vcon(vcon_uuid)
+async def run_vcon(vCon, opts=default_options,):
+    logger.debug("Starting webhook::run")
 
     # The webhook needs a stringified JSON version. 
     json_vCon = vCon.dumps()
@@ -22,10 +18,20 @@ async def run(vcon_uuid, opts=default_options,):
     # Post this to each webhook url
     for url in opts["webhook-urls"]:
         async with aiohttp.ClientSession() as session:
-            logger.info(f"webhook plugin: posting vcon {vcon_uuid} to webhook url: {url}")
+            logger.info(f"webhook plugin: posting vcon {vCon.uuid} to webhook url: {url}")
             async with session.post(url, json=json_dict) as resp:
-                logger.info(f"webhook plugin response for {vcon_uuid}: {resp.status} {await resp.text()}")
-    # Return the vcon_uuid down the chain.
+                logger.info(f"webhook plugin response for {vCon.uuid}: {resp.status} {await resp.text()}")
+    # Return the vCon down the chain.
     # If you want the vCon processing to stop (if you are filtering them, for instance)
     # send None
-    return vcon_uuid
+    return vCon
+
+
+async def run(vcon_uuid, opts=default_options,):
+    # Cannot create redis client in global context as it will get created on async
+    # event loop which may go away.
+    vcon_redis = VconRedis()
+    vCon = await vcon_redis.get_vcon(vcon_uuid)
+    # The webhook does not modify the vCon, so there is nothing to store
+    if await run_vcon(vCon, opts):
+        return vcon_uuid
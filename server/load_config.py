@@ -4,6 +4,7 @@ from redis_mgr import get_key, set_key
 import importlib
 import yaml
 from lib.logging_utils import init_logger
+from lib.chain_plan import CONFIG_CHANNEL, CONFIG_PLAN_KEY, CONFIG_VERSION_KEY, compile_plan
 import time
 
 logger = init_logger(__name__)
@@ -54,7 +55,15 @@ async def load_config():
         await set_key(f"chain:{chain_name}", chain)
         logger.debug(f"Added chain {chain_name}")
         chain_names.append(chain_name)
-    
+
+    # Publish the compiled plan under a new version, so that the workers
+    # pick up the new chains without looking up each key for every vCon
+    logger.debug("Compiling the plan")
+    version = await r.incr(CONFIG_VERSION_KEY)
+    await set_key(CONFIG_PLAN_KEY, compile_plan(config, version))
+    await r.publish(CONFIG_CHANNEL, version)
+    logger.debug(f"Published plan version {version}")
+
     # Now that system is xded up, start whatever adapters there are.
     logger.debug("Starting the adapters")
     for adapter_name in config.get('adapters', []):
@@ -1,8 +1,22 @@
-import importlib
 from lib.logging_utils import init_logger
+from lib.chain_queue import ListQueue, ReliableQueue, StreamQueue, queue_stream_add
+from lib.executors import get_thread_pool_stats, run_step, shutdown_executors
+from lib.process_utils import shard_for
+from lib.redis_cluster import list_key
+from lib.chain_plan import get_plan, wait_for_plan_change
+from lib.vcon_cache import get_vcon_cache_stats
+from lib.vcon_redis import PartialVcon, VconRedis, transfer_snapshot
 import redis_mgr
-from redis_mgr import get_key
-from settings import TICK_INTERVAL
+from settings import (
+    TICK_INTERVAL,
+    CONSERVER_CONSUMERS,
+    CONSUMER_BLOCK_TIMEOUT,
+    MAX_BATCH_SIZE,
+    QUEUE_MAX_ATTEMPTS,
+    QUEUE_VISIBILITY_TIMEOUT,
+    STATS_LOG_INTERVAL,
+    STORAGE_TIMEOUT,
+)
 from rocketry import Rocketry
 from rocketry.log import MinimalRecord
 from redbird.repos import CSVFileRepo
@@ -10,14 +24,30 @@ from load_config import (
     load_config,
 )
 import asyncio
+import signal
+import socket
+import time
 
 
 logger = init_logger(__name__)
 
+# Per link counts of vCons run and seconds spent running them
+link_stats = {}
+# Per storage counts of saved, failed and timed out vCons
+storage_stats = {}
+# Per chain bound on the storage writes running for chains with async_storages set
+storage_semaphores = {}
+
 
 async def main():
     redis_mgr.create_pool()
     await load_config()
+
+    if CONSERVER_CONSUMERS > 0:
+        logger.info("Starting %s consumers per ingress list", CONSERVER_CONSUMERS)
+        await run_worker_process()
+        return
+
     repo = CSVFileRepo(filename="tasks.csv", model=MinimalRecord)
 
     scheduler_app = Rocketry(execution="async", logger_repo=repo)
@@ -35,61 +65,475 @@ async def main():
         logger.info("Rocktry ticking DISABLED!!!!!!!!!!!!!!!!!!!!!!")
 
 
+async def process_vcon(r, chain, vcon_id, pending_storages=None):
+    """Run a single vCon through the links of a chain, then hand it to
+    the egress lists and storages of the chain.
+
+    Links and storages that provide run_vcon(vcon, opts) / save_vcon(vcon, opts)
+    share one in memory vcon.Vcon, loaded once from redis and stored once when
+    the chain is done, or after each link named in the "checkpoints" entry of
+    the chain config.  Only the sections of the vCon the links changed are
+    written back.  Read only links declaring "vcon_paths", in their config or
+    module, get a PartialVcon of those paths unless the full vCon is loaded
+    already.  They run on the executor of the link or storage, see
+    lib.executors.  Links that only provide run(vcon_uuid, opts) and storages
+    that only provide save(vcon_uuid, opts) read and write redis themselves, so
+    the shared vCon is stored before and reloaded after them.
+
+    The storages are written concurrently, and the call only returns once
+    they are done, unless "async_storages" is set in the chain config and
+    pending_storages is given.  The storage writes are then started in a
+    task added to pending_storages, for the caller to await before
+    acknowledging the vCon, once one of the "storage_concurrency" writes
+    allowed for the chain at a time is free.
+
+    Args:
+        r: async redis client
+        chain (PlanChain): the chain, from the compiled config plan
+        vcon_id (str): UUID of the vCon to process
+        pending_storages (list): where to add the task writing the storages
+            of an async_storages chain
+
+    Returns:
+        bool: True if the vCon made it through every link and should be
+        pushed to the egress lists of the chain
+    """
+    logger.debug("Processing vCon %s", vcon_id)
+    vcon_redis = VconRedis(redis_client=r)
+    checkpoints = chain.get("checkpoints", [])
+    vCon = None
+    modified = False
+    forwarded = False
+
+    async def load():
+        nonlocal vCon
+        if vCon is None:
+            vCon = await vcon_redis.get_vcon(vcon_id, track_changes=True)
+            if vCon is None:
+                raise KeyError(f"vCon {vcon_id} not found")
+        return vCon
+
+    async def persist():
+        nonlocal modified
+        if modified:
+            await vcon_redis.store_vcon_changes(vCon)
+            modified = False
+
+    for link in chain.links:
+        logger.debug("Processing link %s", link.name)
+        logger.debug("Running module %s with options %s", link.module_name, link.options)
+        stats = link_stats.setdefault(link.name, {"processed": 0, "seconds": 0.0})
+        if hasattr(link.module, "run_vcon"):
+            if vCon is None and link.vcon_paths:
+                # A read only link needing only some sections, leave the full vCon unloaded
+                link_vcon = await vcon_redis.get_vcon(vcon_id, paths=link.vcon_paths)
+                if link_vcon is None:
+                    raise KeyError(f"vCon {vcon_id} not found")
+            else:
+                link_vcon = await load()
+            started = time.perf_counter()
+            result = await run_step(link, "run_vcon", link_vcon)
+            if isinstance(result, PartialVcon):
+                # Only the fields the link set on its partial vCon are written
+                await vcon_redis.store_partial_vcon(result)
+            elif result is not None:
+                if result is not link_vcon:
+                    # A copy, such as the vCon back from a process executor,
+                    # only its changes are still stored
+                    transfer_snapshot(link_vcon, result)
+                vCon = result
+                modified = True
+        else:
+            await persist()
+            started = time.perf_counter()
+            result = await link.module.run(vcon_id, link.options)
+            # The link may have changed the vCon in redis
+            vCon = None
+        stats["processed"] += 1
+        stats["seconds"] += time.perf_counter() - started
+        if not result:
+            # This means that the module does not want to forward the vCon
+            logger.debug("Module %s did not want to forward the vCon, no result returned. Ending chain", link.module_name)
+            break
+
+        if link.name in checkpoints:
+            await persist()
+
+        # If the module wants to forward the vCon, check if it is the last link in the chain
+        if link is chain.links[-1]:
+            await persist()
+
+            storage_vcon = None
+            if any(hasattr(storage.module, "save_vcon") for storage in chain.storages):
+                storage_vcon = await load()
+            if chain.get("async_storages") and pending_storages is not None:
+                # Waiting for a free slot holds up the vCon, and so the chain
+                semaphore = get_storage_semaphore(chain)
+                await semaphore.acquire()
+                task = asyncio.create_task(save_to_storages(chain, vcon_id, storage_vcon))
+                task.add_done_callback(lambda _: semaphore.release())
+                pending_storages.append(task)
+            else:
+                await save_to_storages(chain, vcon_id, storage_vcon)
+            forwarded = True
+
+    # A link declined to forward the vCon, keep what the links before it did
+    await persist()
+    return forwarded
+
+
+async def push_to_egress(r, chain, vcon_ids):
+    """Push the vCons that made it through the chain to its egress lists,
+    one LPUSH per egress list, or XADDs for a stream chain, for all of them
+    in a single round trip."""
+    if not vcon_ids or not chain.egress_lists:
+        return
+    async with r.pipeline(transaction=False) as pipe:
+        for egress_list in chain.egress_lists:
+            if chain.transport == "stream":
+                queue_stream_add(pipe, egress_list, vcon_ids)
+            else:
+                pipe.lpush(list_key(egress_list), *vcon_ids)
+        await pipe.execute()
+
+
+async def save_to_storage(storage, vcon_id, vCon):
+    """Save a vCon to one storage, counting its successes and failures
+    separately from the other storages."""
+    stats = storage_stats.setdefault(storage.name, {"saved": 0, "failed": 0, "timed_out": 0})
+    timeout = storage.config.get("timeout", STORAGE_TIMEOUT) or None
+    try:
+        if hasattr(storage.module, "save_vcon"):
+            await asyncio.wait_for(run_step(storage, "save_vcon", vCon), timeout)
+        else:
+            await asyncio.wait_for(storage.module.save(vcon_id, storage.options), timeout)
+        stats["saved"] += 1
+    except asyncio.TimeoutError:
+        stats["timed_out"] += 1
+        logger.error("Timed out saving vCon %s to storage %s after %s seconds", vcon_id, storage.name, timeout)
+    except Exception as e:
+        stats["failed"] += 1
+        logger.error("Error saving vCon %s to storage %s: %s", vcon_id, storage.name, e)
+
+
+async def save_to_storages(chain, vcon_id, vCon):
+    """Save a vCon to all the storages of a chain at once, so the slowest
+    storage rather than the sum of them sets the latency."""
+    await asyncio.gather(*[
+        save_to_storage(storage, vcon_id, vCon) for storage in chain.storages
+    ])
+
+
+def get_storage_semaphore(chain):
+    """Returns the semaphore bounding the storage writes of an async_storages
+    chain, to its "storage_concurrency" entry, by default its concurrency."""
+    limit = max(1, int(chain.get("storage_concurrency", get_chain_concurrency(chain))))
+    key = (chain.name, limit)
+    if key not in storage_semaphores:
+        storage_semaphores[key] = asyncio.Semaphore(limit)
+    return storage_semaphores[key]
+
+
+def get_link_stats():
+    """Returns the count of vCons run by each link and the seconds spent on them"""
+    return {name: dict(stats) for name, stats in link_stats.items()}
+
+
+def get_storage_stats():
+    """Returns the saved, failed and timed out counts of each storage"""
+    return {name: dict(stats) for name, stats in storage_stats.items()}
+
+
+def log_stats():
+    """Log the per link, per storage, thread pool and vCon cache counts of
+    this worker"""
+    if link_stats:
+        logger.info("Links: %s", get_link_stats())
+    if storage_stats:
+        logger.info("Storages: %s", get_storage_stats())
+    thread_pool_stats = get_thread_pool_stats()
+    if thread_pool_stats:
+        logger.info("Thread pools: %s", thread_pool_stats)
+    cache_stats = get_vcon_cache_stats()
+    if cache_stats:
+        logger.info("vCon cache: %s", cache_stats)
+
+
+async def log_stats_periodically(stop_event, interval=STATS_LOG_INTERVAL):
+    """Log the counts of this worker every interval seconds until stop_event is set"""
+    if interval <= 0:
+        return
+    while not stop_event.is_set():
+        try:
+            await asyncio.wait_for(stop_event.wait(), interval)
+        except asyncio.TimeoutError:
+            log_stats()
+
+
+async def finish_vcon(r, chain, queue, vcon_id, task, pending_storages):
+    """Wait for one vCon of a batch, push it to the egress lists if it made
+    it through the chain and acknowledge it on the queue it came from, as
+    soon as it is done rather than with the rest of its batch.  A vCon the
+    chain raised on is reported as failed, and logged rather than raised so
+    that one failed vCon does not take down the others.
+    """
+    try:
+        forwarded = await task
+        if forwarded:
+            await push_to_egress(r, chain, [vcon_id])
+        # The storage writes of async_storages chains go on past the vCon
+        # task, the vCon stays on the queue until they are done.  Storage
+        # failures are counted per storage, not raised.
+        await asyncio.gather(*pending_storages)
+    except Exception as e:
+        logger.error("Error processing vCon %s in %s", vcon_id, chain.name, exc_info=e)
+        await queue.fail(vcon_id)
+        return
+    await queue.ack(vcon_id)
+
+
+async def start_batch(r, chain, queue, vcon_ids, semaphore):
+    """Start processing each vCon of a batch, claimed from the queue in one
+    round trip, in its own task as the chain semaphore lets them through.
+    Returns the future done once every vCon of the batch is finished."""
+    finishing = []
+    for vcon_id in vcon_ids:
+        await semaphore.acquire()
+        pending_storages = []
+        task = asyncio.create_task(process_vcon(r, chain, vcon_id, pending_storages))
+        task.add_done_callback(lambda _: semaphore.release())
+        finishing.append(asyncio.create_task(finish_vcon(r, chain, queue, vcon_id, task, pending_storages)))
+    return asyncio.gather(*finishing)
+
+
+def get_chain_batch_size(chain, default=1):
+    """Returns the "batch_size" chain entry, a number or "auto", and the
+    largest batch allowed when it is auto."""
+    return chain.get("batch_size", default), chain.get("max_batch_size", MAX_BATCH_SIZE)
+
+
+def get_chain_queue(r, chain, ingress_list, worker_id):
+    """Returns the queue to consume an ingress list of the chain through,
+    a StreamQueue for a chain with "transport" set to "stream", else a
+    ReliableQueue if the chain config has "reliable" set."""
+    if chain.transport == "stream":
+        return StreamQueue(
+            r,
+            ingress_list,
+            chain.name,
+            worker_id,
+            visibility_timeout=chain.get("visibility_timeout", QUEUE_VISIBILITY_TIMEOUT),
+            max_attempts=chain.get("max_attempts", QUEUE_MAX_ATTEMPTS),
+        )
+    if chain.get("reliable"):
+        return ReliableQueue(
+            r,
+            ingress_list,
+            worker_id,
+            visibility_timeout=chain.get("visibility_timeout", QUEUE_VISIBILITY_TIMEOUT),
+            max_attempts=chain.get("max_attempts", QUEUE_MAX_ATTEMPTS),
+        )
+    return ListQueue(r, ingress_list)
+
+
+def get_chain_concurrency(chain, default=1):
+    """Returns the number of vCons allowed through a chain at once.
+
+    Set with a "concurrency" entry in the chain config.
+    """
+    return max(1, int(chain.get("concurrency", default)))
+
+
 async def tick():
     logger.debug("Starting tick")
-    r = await redis_mgr.get_client()
-
-    # Get list of chains from redis
-    # These chains are setup as redis keys in the load_config module.
-    # One downside here is that although the operation of the conserver
-    # is dynamic (they are read every time through the loop) the
-    # loop itself is more fragile than it needs to be.
-    chain_names = await r.keys("chain:*")
-    for chain_name in chain_names:
-        chain_name = chain_name.decode('utf-8')
-
-        logger.debug("Checking chain %s", chain_name)
-        chain_details = await r.json().get(chain_name)
-        for ingress_list in chain_details['ingress_lists']:
-            vcon_id = await r.lpop(ingress_list)
-            if not vcon_id:
-                continue
-
-            vcon_id = vcon_id.decode('utf-8')
-            logger.debug("Processing vCon %s", vcon_id)
-            # If there is a vCon to process, process it
-            for link_name in chain_details['links']:
-                logger.debug("Processing link %s", link_name)
-                link = await get_key(f"link:{link_name}")
-                module_name = link['module']
-
-                module = importlib.import_module(module_name)
-                options = link.get('options')
-                logger.debug("Running module %s with options %s", module_name, options)
-                result = await module.run(vcon_id, options)
-                if not result:
-                    # This means that the module does not want to forward the vCon
-                    logger.debug("Module %s did not want to forward the vCon, no result returned. Ending chain", module_name)
-                    continue
-                
-                # If the module wants to forward the vCon, check if it is the last link in the chain
-                if link_name == chain_details['links'][-1]:
-                    # If it is, then we need to put it in the outbound queue
-                    for egress_list in chain_details['egress_lists']:
-                        await r.lpush(egress_list, vcon_id)
-
-                    for storage_name in chain_details.get("storages", []):
-                        try:
-                            storage = await get_key(f"storage:{storage_name}")
-                            module_name = storage['module']
-                            module = importlib.import_module(module_name)
-                            options = storage.get('options', module.default_options)
-                            result = await module.save(vcon_id, options)
-                        except Exception as e:
-                            logger.error("Error saving vCon %s to storage %s: %s", vcon_id, storage_name, e)
-    
-        logger.debug("Finished processing chain %s", chain_name)
+    r = redis_mgr.get_client()
+
+    # The chains come from the plan compiled by load_config, which is only
+    # reloaded from redis when the config version changes.
+    plan = await get_plan(r)
+    chains = list(plan.chains.values())
+
+    # Each chain runs in its own group of tasks so that a slow link in one
+    # chain does not hold up the others.
+    results = await asyncio.gather(
+        *[tick_chain(r, chain) for chain in chains],
+        return_exceptions=True,
+    )
+    for chain, result in zip(chains, results):
+        if isinstance(result, Exception):
+            logger.error("Error ticking chain %s: %s", chain.name, result)
+
+
+async def tick_chain(r, chain):
+    logger.debug("Checking chain %s", chain.name)
+    concurrency = get_chain_concurrency(chain)
+    semaphore = asyncio.Semaphore(concurrency)
+    # Without a batch size take up to concurrency vCons from each ingress list,
+    # so a chain with concurrency 1 keeps the one vCon per ingress list per
+    # tick behaviour.
+    batch_size, max_batch_size = get_chain_batch_size(chain, default=concurrency)
+
+    batches = []
+    for ingress_list in chain.ingress_lists:
+        queue = get_chain_queue(r, chain, ingress_list, f"{socket.gethostname()}-tick")
+        await queue.requeue_expired()
+        size = await queue.resolve_batch_size(batch_size, max_batch_size)
+        vcon_ids = await queue.claim_batch(size)
+        if not vcon_ids:
+            continue
+
+        # If there are vCons to process, process them
+        batches.append(await start_batch(r, chain, queue, vcon_ids, semaphore))
+    await asyncio.gather(*batches)
+
+    logger.debug("Finished processing chain %s", chain.name)
+
+
+async def consume_ingress_list(chain, queue, consumer_index, semaphore, in_flight, stop_event):
+    """Long lived consumer blocking on one ingress list of a chain.
+
+    Each batch of vCons is started as soon as the blocking pop returns, so
+    latency does not depend on a tick and throughput scales with the number
+    of consumers.  The chain semaphore bounds how many vCons run at once
+    across all the consumers of the chain.
+    """
+    logger.info("Consumer %s started on %s for %s", consumer_index, queue.ingress_list, chain.name)
+    r = redis_mgr.get_client()
+    batch_size, max_batch_size = get_chain_batch_size(chain)
+    await queue.recover()
+    async for vcon_ids in queue.listen(CONSUMER_BLOCK_TIMEOUT, stop_event, batch_size, max_batch_size):
+        batch = await start_batch(r, chain, queue, vcon_ids, semaphore)
+        in_flight.add(batch)
+        batch.add_done_callback(in_flight.discard)
+    logger.info("Consumer %s stopped on %s for %s", consumer_index, queue.ingress_list, chain.name)
+
+
+async def requeue_expired(chain, queues, stop_event):
+    """Periodically put back the vCons of the chain whose visibility timeout
+    has passed, from this or any other worker."""
+    interval = max(1, chain.get("visibility_timeout", QUEUE_VISIBILITY_TIMEOUT) / 2)
+    while not stop_event.is_set():
+        for queue in queues:
+            try:
+                await queue.requeue_expired()
+            except Exception:
+                logger.exception("Error requeuing expired vCons on %s", queue.ingress_list)
+        try:
+            await asyncio.wait_for(stop_event.wait(), interval)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_chain_workers(chain, ingress_lists, worker_name, stop_event):
+    """Run the consumers of a single chain, isolated from the other chains.
+
+    The number of consumers per ingress list defaults to CONSERVER_CONSUMERS
+    and can be overridden with a "consumers" entry in the chain config.  When
+    the chain has no "concurrency" entry, every consumer may have one vCon
+    in flight.
+    """
+    r = redis_mgr.get_client()
+    num_consumers = chain.get("consumers") or CONSERVER_CONSUMERS or 1
+    concurrency = get_chain_concurrency(chain, default=num_consumers * len(ingress_lists))
+    semaphore = asyncio.Semaphore(concurrency)
+    in_flight = set()
+    logger.info("Chain %s running with concurrency %s", chain.name, concurrency)
+
+    consumers = []
+    queues = []
+    for ingress_list in ingress_lists:
+        for consumer_index in range(num_consumers):
+            # The worker id is stable across restarts, so a restarted worker
+            # recovers what it left on its processing list
+            queue = get_chain_queue(r, chain, ingress_list, f"{worker_name}-{consumer_index}")
+            queues.append(queue)
+            consumers.append(
+                consume_ingress_list(chain, queue, consumer_index, semaphore, in_flight, stop_event)
+            )
+    if chain.get("reliable") or chain.transport == "stream":
+        # One queue per ingress list is enough, they share the in flight set
+        # or consumer group
+        consumers.append(requeue_expired(chain, queues[::num_consumers], stop_event))
+
+    await asyncio.gather(*consumers)
+
+    # Let the vCons already taken off the ingress lists finish
+    if in_flight:
+        logger.info("Waiting for %s vCons in flight on %s", len(in_flight), chain.name)
+        await asyncio.gather(*in_flight, return_exceptions=True)
+
+
+async def run_plan_workers(plan, stop_event, shard_index=0, shard_count=1):
+    """Run the consumers of every chain in the plan until stop_event is set.
+
+    Every chain gets its own group of tasks so a slow chain cannot starve a
+    fast one, and a failure in one chain does not stop the others.
+
+    When several worker processes share the chains, each one only consumes
+    the ingress lists hashed to its shard_index.
+    """
+    worker_name = f"{socket.gethostname()}-{shard_index}"
+    chains = []
+    chain_groups = []
+    for chain in plan.chains.values():
+        ingress_lists = [
+            ingress_list for ingress_list in chain.ingress_lists
+            if shard_for(f"{chain.name}:{ingress_list}", shard_count) == shard_index
+        ]
+        if not ingress_lists:
+            continue
+        chains.append(chain)
+        chain_groups.append(run_chain_workers(chain, ingress_lists, worker_name, stop_event))
+
+    results = await asyncio.gather(*chain_groups, return_exceptions=True)
+    for chain, result in zip(chains, results):
+        if isinstance(result, Exception):
+            logger.error("Chain %s workers failed: %s", chain.name, result)
+
+
+async def run_workers(stop_event=None, shard_index=0, shard_count=1):
+    """Start the blocking consumers for every configured chain and wait for them.
+
+    When the config version changes the consumers of the old plan are
+    drained and new ones started for the new plan.
+    """
+    if stop_event is None:
+        stop_event = asyncio.Event()
+    r = redis_mgr.get_client()
+    while not stop_event.is_set():
+        plan = await get_plan(r)
+        plan_stop_event = asyncio.Event()
+        workers = asyncio.create_task(run_plan_workers(plan, plan_stop_event, shard_index, shard_count))
+        changed = await wait_for_plan_change(r, plan.version, stop_event)
+        if changed:
+            logger.info("Config version changed from %s, restarting the consumers", plan.version)
+        plan_stop_event.set()
+        await workers
+
+
+async def run_worker_process(shard_index=0, shard_count=1):
+    """Entry point of a worker process.
+
+    Owns its own redis pool, and on SIGTERM or SIGINT stops taking new vCons
+    and drains the ones in flight before exiting.
+    """
+    redis_mgr.create_pool()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    logger.info("Worker %s of %s starting", shard_index, shard_count)
+    stats_logger = asyncio.create_task(log_stats_periodically(stop_event))
+    try:
+        await run_workers(stop_event, shard_index, shard_count)
+    finally:
+        stats_logger.cancel()
+        log_stats()
+        shutdown_executors()
+        await redis_mgr.shutdown_pool()
+    logger.info("Worker %s of %s stopped", shard_index, shard_count)
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
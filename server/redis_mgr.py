@@ -6,12 +6,17 @@ bind to a asyncio loop which may be started and stopped.  In which case
 redis will be bound to an old loop which will no longer work
 
 The redis connection pool must be shutdown and restarted when FASTApi does.
+
+With REDIS_CLUSTER set, the clients are a single RedisCluster client, which
+keeps a pool of connections per node.
 """
 
 from lib.logging_utils import init_logger
+from lib.redis_cluster import json_get, json_set, scan_keys
+from redis.asyncio.cluster import RedisCluster
 from redis.asyncio.connection import ConnectionPool
 from redis.asyncio.client import Redis
-from settings import REDIS_URL
+from settings import REDIS_CLUSTER, REDIS_URL
 
 
 
@@ -19,13 +24,24 @@ logger = init_logger(__name__)
 
 REDIS_POOL = None
 REDIS_POOL_INITIALIZATION_COUNT = 0
+REDIS_CLUSTER_CLIENT = None
 
 
 def create_pool():
     global REDIS_POOL
     global REDIS_POOL_INITIALIZATION_COUNT
-    if REDIS_POOL is not None:
+    global REDIS_CLUSTER_CLIENT
+    if REDIS_POOL is not None or REDIS_CLUSTER_CLIENT is not None:
         logger.info("Redis pool already created")
+    elif REDIS_CLUSTER:
+        logger.info("Creating Redis cluster client...")
+        REDIS_POOL_INITIALIZATION_COUNT += 1
+        REDIS_CLUSTER_CLIENT = RedisCluster.from_url(REDIS_URL)
+        logger.info(
+            "Redis cluster client created. initialization count: {}".format(
+                REDIS_POOL_INITIALIZATION_COUNT
+            )
+        )
     else:
         logger.info("Creating Redis pool...")
         REDIS_POOL_INITIALIZATION_COUNT += 1
@@ -42,7 +58,15 @@ def create_pool():
 
 async def shutdown_pool():
     global REDIS_POOL
-    if REDIS_POOL is not None:
+    global REDIS_CLUSTER_CLIENT
+    if REDIS_CLUSTER_CLIENT is not None:
+        logger.info("closing Redis cluster client")
+        tmp_client = REDIS_CLUSTER_CLIENT
+        REDIS_CLUSTER_CLIENT = None
+        await tmp_client.close()
+        logger.info("Redis cluster client closed")
+
+    elif REDIS_POOL is not None:
         logger.info("disconnecting Redis pool")
         log_pool_stats()
         tmp_pool = REDIS_POOL
@@ -70,9 +94,11 @@ def log_pool_stats():
 def get_client():
     logger.debug("entering get_client")
     global REDIS_POOL
-    if REDIS_POOL is None:
+    if REDIS_POOL is None and REDIS_CLUSTER_CLIENT is None:
         logger.info("REDIS_POOL is not initialized")
         create_pool()
+    if REDIS_CLUSTER_CLIENT is not None:
+        return REDIS_CLUSTER_CLIENT
     r = Redis(connection_pool=REDIS_POOL)
     logger.debug("client type: {}".format(type(r)))
     return r
@@ -80,13 +106,13 @@ def get_client():
 
 async def set_key(key, value):
     r = get_client()
-    result = await r.json().set(key, "$", value)
+    result = await json_set(r, key, "$", value)
     return result
 
 
 async def get_key(key):
     r = get_client()
-    result = await r.json().get(key)
+    result = await json_get(r, key)
     return result
 
 
@@ -97,5 +123,7 @@ async def delete_key(key):
 
 async def show_keys(pattern):
     r = get_client()
-    result = await r.keys(pattern)
-    return result
\ No newline at end of file
+    result = []
+    async for keys in scan_keys(r, pattern):
+        result.extend(keys)
+    return result
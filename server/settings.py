@@ -2,7 +2,48 @@ import os
 from pathlib import Path
 
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost")
+# Connect to a Redis Cluster at REDIS_URL, see lib/redis_cluster.py.  The vCon
+# sorted set is then sharded per day of created_at.
+REDIS_CLUSTER = os.getenv("REDIS_CLUSTER", "false") == "true"
 TICK_INTERVAL = int(os.getenv("TICK_INTERVAL", 5000))
+# Number of blocking consumers started per chain ingress list.  When greater
+# than 0 the conserver runs in worker mode instead of the Rocketry tick.
+CONSERVER_CONSUMERS = int(os.getenv("CONSERVER_CONSUMERS", 0))
+# Seconds a consumer blocks on its ingress list before checking for shutdown
+CONSUMER_BLOCK_TIMEOUT = int(os.getenv("CONSUMER_BLOCK_TIMEOUT", 5))
+# Number of worker processes started by supervisor.py, 0 means one per CPU core
+CONSERVER_PROCESSES = int(os.getenv("CONSERVER_PROCESSES", 0))
+# Seconds the supervisor waits for workers to drain on SIGTERM before killing them
+SUPERVISOR_DRAIN_TIMEOUT = int(os.getenv("SUPERVISOR_DRAIN_TIMEOUT", 60))
+# Chains with "reliable" set move vCons to a processing list rather than popping
+# them, and requeue them if not done within the visibility timeout (seconds),
+# up to max attempts before parking them on the ingress list's dead letter list.
+# Can be overridden with "visibility_timeout" and "max_attempts" chain entries.
+QUEUE_VISIBILITY_TIMEOUT = int(os.getenv("QUEUE_VISIBILITY_TIMEOUT", 300))
+QUEUE_MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", 3))
+# Approximate number of entries kept in the streams of chains with "transport"
+# set to "stream", acknowledged entries are kept for replay until trimmed.
+STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", 100000))
+# Largest batch of vCons taken off an ingress list at once by chains with
+# "batch_size" set to auto.  Can be overridden with a "max_batch_size" chain entry.
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 100))
+# Default seconds allowed for a storage to save a vCon, 0 disables the timeout.
+# Can be overridden with a "timeout" entry in the storage config.
+STORAGE_TIMEOUT = int(os.getenv("STORAGE_TIMEOUT", 60))
+# Seconds between the logs of the per link and per storage counts of a worker,
+# which are also logged when it stops.  0 only logs them when it stops.
+STATS_LOG_INTERVAL = int(os.getenv("STATS_LOG_INTERVAL", 300))
+# vCons per JSON.MGET or pipeline of JSON.SET in VconRedis.get_vcons and store_vcons,
+# and per pipeline of POST /vcons
+VCON_REDIS_CHUNK_SIZE = int(os.getenv("VCON_REDIS_CHUNK_SIZE", 100))
+# Largest vCon accepted by POST /vcons, which holds one vCon of the body at a time
+VCON_INGEST_MAX_ITEM_BYTES = int(os.getenv("VCON_INGEST_MAX_ITEM_BYTES", 64 * 1024 * 1024))
+# Bytes of vCon JSON each process keeps in its VconRedis LRU cache, 0 disables the cache
+VCON_CACHE_MAX_BYTES = int(os.getenv("VCON_CACHE_MAX_BYTES", 0))
+# Size of the thread and process pools links and storages with an "executor"
+# of thread or process run on, per worker process.
+EXECUTOR_THREADS = int(os.getenv("EXECUTOR_THREADS", 8))
+EXECUTOR_PROCESSES = int(os.getenv("EXECUTOR_PROCESSES", 2))
 HOSTNAME = os.getenv("HOSTNAME", "http://localhost:8000")
 ENV = os.getenv("ENV", "dev")
 LOG_LEVEL = os.getenv("LOG_LEVEL", "DEBUG")
@@ -20,5 +61,17 @@ WEVIATE_HOST=os.getenv("WEVIATE_HOST", "localhost:8000")
 WEVIATE_API_KEY=os.getenv('WEVIATE_API_KEY')
 VCON_SORTED_FORCE_RESET=os.getenv("VCON_SORTED_FORCE_RESET", "true")
 VCON_SORTED_SET_NAME=os.getenv("VCON_SORTED_SET_NAME", "vcons")
+# Maintain the party tel/mailto, dialog type, analysis type and vendor indexes
+# used by /vcon/search when vCons are stored, off by default as it costs a
+# round trip more per store.
+VCON_INDEX_ENABLED = os.getenv("VCON_INDEX_ENABLED", "false") == "true"
+# vCon keys per SCAN / JSON.MGET / ZADD batch when rebuilding the sorted set, and
+# how long after a completed rebuild a force reset on startup is skipped (seconds).
+VCON_SORTED_REBUILD_BATCH_SIZE = int(os.getenv("VCON_SORTED_REBUILD_BATCH_SIZE", 1000))
+VCON_SORTED_REBUILD_INTERVAL = int(os.getenv("VCON_SORTED_REBUILD_INTERVAL", 600))
+# How often the API reaps the vCons past their expiry (seconds), and how many
+# vCons are reaped per batch.
+VCON_EXPIRY_REAP_INTERVAL = int(os.getenv("VCON_EXPIRY_REAP_INTERVAL", 60))
+VCON_EXPIRY_BATCH_SIZE = int(os.getenv("VCON_EXPIRY_BATCH_SIZE", 500))
 
 
@@ -11,23 +11,30 @@ default_options = {
     "extension": "json",
     }
 
-async def save(
-    vcon_uuid,
+async def save_vcon(
+    vcon,
     opts=default_options,
 ):
     logger.info("Saving vCon to file storage")
     try:
-        # Cannot have redis clients in the global context as they do not get shutdown
-        # correctly.  They get created on an async event loop that may go away.
-        vcon_redis = VconRedis()
-        vcon = await vcon_redis.get_vcon(vcon_uuid)
         if opts['add_timestamp_to_filename']:
             filename = f"{opts['filename']}-{datetime.now().isoformat()}.{opts['extension']}"
         else:
             filename = f"{opts['filename']}.{opts['extension']}"
         with open(f"{opts['path']}/{filename}", "w") as f:
             f.write(vcon.dumps())
-        logger.info(f"file storage plugin: inserted vCon: {vcon_uuid}")
+        logger.info(f"file storage plugin: inserted vCon: {vcon.uuid}")
     except Exception as e:
-        logger.error(f"file storage plugin: failed to insert vCon: {vcon_uuid}, error: {e} ")
+        logger.error(f"file storage plugin: failed to insert vCon: {vcon.uuid}, error: {e} ")
         raise e
+
+
+async def save(
+    vcon_uuid,
+    opts=default_options,
+):
+    # Cannot have redis clients in the global context as they do not get shutdown
+    # correctly.  They get created on an async event loop that may go away.
+    vcon_redis = VconRedis()
+    vcon = await vcon_redis.get_vcon(vcon_uuid)
+    await save_vcon(vcon, opts)
@@ -9,6 +9,8 @@ logger = init_logger(__name__)
 
 
 default_options = {"name": "mongo", "database":"conserver", "collection_name":"vcons"}
+# pymongo is synchronous, keep it off the event loop
+default_executor = "thread"
 
 def prepare_vcon_for_mongo(vcon: dict) -> dict:
     clean_vcon = json.loads(vcon.dumps())
@@ -19,27 +21,33 @@ def prepare_vcon_for_mongo(vcon: dict) -> dict:
     return clean_vcon
 
 
-async def save(
-    vcon_uuid,
+async def save_vcon(
+    vcon,
     opts=default_options,
 ):
     logger.info("Starting the mongo storage")
     client = pymongo.MongoClient(MONGODB_URL)
     try:
-        # Cannot create redis client in global context as it may get wait on async 
-        # event loop which may go away.
-        vcon_redis = VconRedis()
-        vcon = await vcon_redis.get_vcon(vcon_uuid)
         db = client[opts['database']]
         collection = db[opts['collection']]
         # upsert this vCon
         results = collection.update_one(
-            {"_id": vcon_uuid},
+            {"_id": vcon.uuid},
             {"$set": prepare_vcon_for_mongo(vcon)},
             upsert=True
         )
-        logger.info(f"mongo storage plugin: inserted vCon: {vcon_uuid}, results: {results} ")
+        logger.info(f"mongo storage plugin: inserted vCon: {vcon.uuid}, results: {results} ")
     except Exception as e:
-        logger.error(f"mongo storage plugin: failed to insert vCon: {vcon_uuid}, error: {e} ")
+        logger.error(f"mongo storage plugin: failed to insert vCon: {vcon.uuid}, error: {e} ")
         raise e
 
+
+async def save(
+    vcon_uuid,
+    opts=default_options,
+):
+    # Cannot create redis client in global context as it may get wait on async 
+    # event loop which may go away.
+    vcon_redis = VconRedis()
+    vcon = await vcon_redis.get_vcon(vcon_uuid)
+    await save_vcon(vcon, opts)
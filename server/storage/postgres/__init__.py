@@ -11,18 +11,16 @@ import json
 
 logger = init_logger(__name__)
 default_options = {"name": "postgres"}
+# peewee is synchronous, keep it off the event loop
+default_executor = "thread"
 
 
-async def save(
-    vcon_uuid,
+async def save_vcon(
+    vcon,
     opts=default_options,
 ):
     logger.info("Starting the postgres storage")
     try:
-        # cannot have redis clients in the global context as they get
-        # created on an async event loop which may go away.
-        vcon_redis = VconRedis()
-        vcon = await vcon_redis.get_vcon(vcon_uuid)
         # Connect to Postgres
         db = PostgresqlExtDatabase(
             opts['database'], 
@@ -59,7 +57,7 @@ async def save(
             "created_at": vcon.created_at,
             "updated_at": vcon.created_at,
             "subject": vcon.subject,
-            "vcon_json": json.loads(vcon.dumps()),
+            "vcon_json": vcon.to_dict(),
             "type": source,
         }
         Vcons.insert(**vcon_data).on_conflict(
@@ -67,9 +65,20 @@ async def save(
         ).execute()
 
         db.close()
-        logger.info(f"postgres storage plugin: inserted vCon: {vcon_uuid}")
+        logger.info(f"postgres storage plugin: inserted vCon: {vcon.uuid}")
 
     except Exception as e:
-        logger.error(f"postgres storage plugin: failed to insert vCon: {vcon_uuid}, error: {e} ")
+        logger.error(f"postgres storage plugin: failed to insert vCon: {vcon.uuid}, error: {e} ")
     finally:
         db.close()
+
+
+async def save(
+    vcon_uuid,
+    opts=default_options,
+):
+    # cannot have redis clients in the global context as they get
+    # created on an async event loop which may go away.
+    vcon_redis = VconRedis()
+    vcon = await vcon_redis.get_vcon(vcon_uuid)
+    await save_vcon(vcon, opts)
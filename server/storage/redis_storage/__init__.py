@@ -10,20 +10,26 @@ default_options = {
                     "prefix":"vcon_storage",
                     "expires": 60*60*24*7
                 }
-async def save(
-    vcon_uuid,
+async def save_vcon(
+    vcon,
     opts=default_options,
 ):
     logger.info("Starting the REDIS storage")
     try:
-        # Cannot reate redis clients in global context as they get started on async event
-        # loop which may go away.
-        vcon_redis = VconRedis()
-        vcon = await vcon_redis.get_vcon(vcon_uuid)
         r = redis.Redis.from_url(opts['redis_url'])
-        await r.set(f"{opts['prefix']}:{vcon_uuid}", vcon.dumps(), ex=opts['expires'])
-        logger.info(f"redis storage plugin: inserted vCon: {vcon_uuid}")
+        await r.set(f"{opts['prefix']}:{vcon.uuid}", vcon.dumps(), ex=opts['expires'])
+        logger.info(f"redis storage plugin: inserted vCon: {vcon.uuid}")
     except Exception as e:
-        logger.error(f"redis storage plugin: failed to insert vCon: {vcon_uuid}, error: {e} ")
+        logger.error(f"redis storage plugin: failed to insert vCon: {vcon.uuid}, error: {e} ")
         raise e
 
+
+async def save(
+    vcon_uuid,
+    opts=default_options,
+):
+    # Cannot reate redis clients in global context as they get started on async event
+    # loop which may go away.
+    vcon_redis = VconRedis()
+    vcon = await vcon_redis.get_vcon(vcon_uuid)
+    await save_vcon(vcon, opts)
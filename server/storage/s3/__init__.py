@@ -8,18 +8,16 @@ logger = init_logger(__name__)
 
 
 default_options = {}
+# boto3 is synchronous, keep it off the event loop
+default_executor = "thread"
 
 
-async def save(
-    vcon_uuid,
+async def save_vcon(
+    vcon,
     opts=default_options,
 ):
     logger.info("Starting the S3 storage")
     try:
-        # Cannot create redis client in global context as it can get blocked on async
-        # event loop which may go away.
-        vcon_redis = VconRedis()
-        vcon = await vcon_redis.get_vcon(vcon_uuid)
         s3 = boto3.client(
             "s3",
             aws_access_key_id=opts['aws_access_key_id'],
@@ -29,14 +27,24 @@ async def save(
         s3_path = opts.get('s3_path')
         created_at = datetime.fromisoformat(vcon.created_at)
         timestamp = created_at.strftime('%Y/%m/%d')
-        key = vcon_uuid + ".vcon"
+        key = vcon.uuid + ".vcon"
         destination_directory = f'{timestamp}/{key}'
         if s3_path:
             destination_directory = s3_path + "/" + destination_directory
         s3.put_object(Bucket=opts["aws_bucket"], Key=destination_directory, Body=vcon.dumps())
 
-        logger.info(f"s3 storage plugin: inserted vCon: {vcon_uuid}")   
+        logger.info(f"s3 storage plugin: inserted vCon: {vcon.uuid}")   
     except Exception as e:
-        logger.error(f"s3 storage plugin: failed to insert vCon: {vcon_uuid}, error: {e} ")
+        logger.error(f"s3 storage plugin: failed to insert vCon: {vcon.uuid}, error: {e} ")
         raise e
 
+
+async def save(
+    vcon_uuid,
+    opts=default_options,
+):
+    # Cannot create redis client in global context as it can get blocked on async
+    # event loop which may go away.
+    vcon_redis = VconRedis()
+    vcon = await vcon_redis.get_vcon(vcon_uuid)
+    await save_vcon(vcon, opts)
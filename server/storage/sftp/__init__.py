@@ -20,9 +20,11 @@ default_options = {
         "filename": "vcon",
         "extension": "json",
         }
+# paramiko is synchronous, keep it off the event loop
+default_executor = "thread"
 
-async def save(
-    vcon_uuid,
+async def save_vcon(
+    vcon,
     opts=default_options,
 ):
     logger.info("Saving vCon to sftp storage")
@@ -36,20 +38,26 @@ async def save(
     sftp = SFTPClient.from_transport(transport)
     # Upload the vCon to the SFTP site
     try:
-        # Cannot create redis clients in global context as they get started on an
-        # async event loop which may go away.
-        vcon_redis = VconRedis()
-        vcon = await vcon_redis.get_vcon(vcon_uuid)
         filename = opts['filename']
         if opts['add_timestamp_to_filename']:
             filename += f"_{datetime.now().isoformat()}"
         filename += f".{opts['extension']}"
         sftp.putfo(vcon.dumps(), os.path.join(opts['path'], filename))
-        logger.info(f"sftp storage plugin: uploaded vCon: {vcon_uuid} to {opts['url']}")
+        logger.info(f"sftp storage plugin: uploaded vCon: {vcon.uuid} to {opts['url']}")
     except Exception as e:
-        logger.error(f"sftp storage plugin: failed to upload vCon: {vcon_uuid}, error: {e} ")
+        logger.error(f"sftp storage plugin: failed to upload vCon: {vcon.uuid}, error: {e} ")
         raise e
     finally:
         sftp.close()
         transport.close()
 
+
+async def save(
+    vcon_uuid,
+    opts=default_options,
+):
+    # Cannot create redis clients in global context as they get started on an
+    # async event loop which may go away.
+    vcon_redis = VconRedis()
+    vcon = await vcon_redis.get_vcon(vcon_uuid)
+    await save_vcon(vcon, opts)
@@ -0,0 +1,85 @@
+"""
+Runs the conserver as several worker processes, one per CPU core by default.
+
+Each worker process owns its own redis pool and consumes the share of the
+chain ingress lists hashed to it (see main_loop.run_workers).  Workers that
+crash are restarted, and on SIGTERM the workers are asked to drain the vCons
+they have in flight before the supervisor exits.
+
+    python ./supervisor.py
+"""
+import asyncio
+import os
+import signal
+import time
+
+import redis_mgr
+from lib.logging_utils import init_logger
+from lib.process_utils import start_async_process
+from load_config import load_config
+from main_loop import run_worker_process
+from settings import CONSERVER_PROCESSES, SUPERVISOR_DRAIN_TIMEOUT
+
+logger = init_logger(__name__)
+
+RESTART_CHECK_INTERVAL = 1
+
+
+async def prepare():
+    # Load the config once, before forking, then drop the pool so that no
+    # worker inherits connections bound to this process' event loop.
+    redis_mgr.create_pool()
+    await load_config()
+    await redis_mgr.shutdown_pool()
+
+
+def supervise(worker_count):
+    stopping = False
+
+    def handle_stop(signum, frame):
+        nonlocal stopping
+        logger.info("Supervisor received signal %s, draining workers", signum)
+        stopping = True
+
+    workers = {}
+    for worker_index in range(worker_count):
+        workers[worker_index] = start_async_process(run_worker_process, worker_index, worker_count)
+        logger.info("Started worker %s pid %s", worker_index, workers[worker_index].pid)
+
+    # Installed after the first fork, the workers set up their own handlers
+    signal.signal(signal.SIGTERM, handle_stop)
+    signal.signal(signal.SIGINT, handle_stop)
+
+    while not stopping:
+        for worker_index, process in workers.items():
+            if not process.is_alive():
+                logger.error(
+                    "Worker %s pid %s exited with %s, restarting",
+                    worker_index, process.pid, process.exitcode
+                )
+                workers[worker_index] = start_async_process(run_worker_process, worker_index, worker_count)
+        time.sleep(RESTART_CHECK_INTERVAL)
+
+    # Process.terminate sends SIGTERM, which the workers treat as a drain request
+    for process in workers.values():
+        if process.is_alive():
+            process.terminate()
+    deadline = time.monotonic() + SUPERVISOR_DRAIN_TIMEOUT
+    for worker_index, process in workers.items():
+        process.join(max(0, deadline - time.monotonic()))
+        if process.is_alive():
+            logger.error("Worker %s did not drain in time, killing it", worker_index)
+            process.kill()
+            process.join()
+    logger.info("Supervisor stopped")
+
+
+def main():
+    worker_count = CONSERVER_PROCESSES or os.cpu_count() or 1
+    logger.info("Starting %s conserver worker processes", worker_count)
+    asyncio.run(prepare())
+    supervise(worker_count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Throughput and latency benchmark of a conserver chain.
+
+Runs the consumers of main_loop on a chain of stub links (links.stub) with a
+configurable latency distribution, feeds it vCons from
+vcon_fixture.generate_mock_vcon and reports:
+
+    - throughput, vCons per second from the first push to the last vCon
+      reaching the egress list
+    - p50/p95/p99 end to end latency, from the push on the ingress list to
+      the arrival on the egress list
+    - mean time spent in each link
+    - redis round trips per vCon made by the conserver
+
+Run it from the server directory against a local Redis Stack:
+
+    python tests/benchmark_chain.py --vcons 2000 --links 3 --latency-ms 5 --consumers 4
+
+or without a redis server, with --fakeredis.  The keys it creates are
+removed when it is done.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+from benchmark_utils import create_clients, get_round_trips, latency_summary, reset_round_trips
+import vcon_fixture
+
+import redis_mgr
+import main_loop
+from lib.chain_plan import ChainPlan, compile_plan
+from settings import REDIS_URL
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vcons", type=int, default=1000, help="number of vCons to push through the chain")
+    parser.add_argument("--links", type=int, default=3, help="number of stub links in the chain")
+    parser.add_argument("--latency-ms", type=float, default=0, help="latency of each stub link")
+    parser.add_argument(
+        "--distribution", default="fixed", choices=["fixed", "uniform", "exponential", "lognormal"],
+        help="distribution of the stub link latency"
+    )
+    parser.add_argument("--jitter-ms", type=float, default=0, help="+/- range of the uniform distribution")
+    parser.add_argument("--sigma", type=float, default=0.5, help="shape of the lognormal distribution")
+    parser.add_argument("--cpu-ms", type=float, default=0, help="CPU time burnt by each stub link")
+    parser.add_argument("--executor", default="inline", choices=["inline", "thread", "process"])
+    parser.add_argument("--consumers", type=int, default=1, help="consumers on the ingress list")
+    parser.add_argument("--concurrency", type=int, default=0, help="vCons in flight, 0 for one per consumer")
+    parser.add_argument("--batch-size", default="1", help="vCons claimed at once, a number or auto")
+    parser.add_argument("--reliable", action="store_true", help="use the reliable queue")
+    parser.add_argument("--rate", type=float, default=0, help="vCons pushed per second, 0 to push them all at once")
+    parser.add_argument("--timeout", type=float, default=300, help="seconds to wait for the vCons")
+    parser.add_argument("--redis-url", default=REDIS_URL)
+    parser.add_argument("--fakeredis", action="store_true", help="run against fakeredis rather than redis")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    parser.add_argument("--verbose", action="store_true", help="keep the conserver logging")
+    return parser.parse_args()
+
+
+def build_plan(args, ingress_list, egress_list):
+    link_options = {
+        "latency_ms": args.latency_ms,
+        "distribution": args.distribution,
+        "jitter_ms": args.jitter_ms,
+        "sigma": args.sigma,
+        "cpu_ms": args.cpu_ms,
+    }
+    links = {
+        f"stub_{index}": {"module": "links.stub", "options": link_options, "executor": args.executor}
+        for index in range(args.links)
+    }
+    chain = {
+        "links": list(links),
+        "ingress_lists": [ingress_list],
+        "egress_lists": [egress_list],
+        "consumers": args.consumers,
+        "batch_size": args.batch_size if args.batch_size == "auto" else int(args.batch_size),
+        "reliable": args.reliable,
+    }
+    if args.concurrency:
+        chain["concurrency"] = args.concurrency
+    config = {"links": links, "storages": {}, "chains": {"benchmark": chain}}
+    return ChainPlan(compile_plan(config, 0))
+
+
+async def store_vcons(client, vcons, chunk_size=500):
+    for start in range(0, len(vcons), chunk_size):
+        async with client.pipeline(transaction=False) as pipe:
+            for vcon in vcons[start:start + chunk_size]:
+                pipe.json().set(f"vcon:{vcon['uuid']}", "$", vcon)
+            await pipe.execute()
+
+
+async def feed(client, ingress_list, vcon_ids, rate, pushed_at, chunk_size=500):
+    """Push the vCon UUIDs on the ingress list, at rate per second or all at once"""
+    if rate:
+        interval = 1 / rate
+        next_push = time.perf_counter()
+        for vcon_id in vcon_ids:
+            delay = next_push - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            pushed_at[vcon_id] = time.perf_counter()
+            await client.rpush(ingress_list, vcon_id)
+            next_push += interval
+        return
+
+    for start in range(0, len(vcon_ids), chunk_size):
+        chunk = vcon_ids[start:start + chunk_size]
+        now = time.perf_counter()
+        for vcon_id in chunk:
+            pushed_at[vcon_id] = now
+        await client.rpush(ingress_list, *chunk)
+
+
+async def collect(client, egress_list, pushed_at, expected, timeout):
+    """Wait for the vCons on the egress list, returns their latencies and
+    the time the last one arrived"""
+    latencies = []
+    deadline = time.perf_counter() + timeout
+    last_arrival = time.perf_counter()
+    while len(latencies) < expected and time.perf_counter() < deadline:
+        values = await client.blpop([egress_list], timeout=1)
+        if not values:
+            continue
+        last_arrival = time.perf_counter()
+        latencies.append(last_arrival - pushed_at[values[1].decode("utf-8")])
+    return latencies, last_arrival
+
+
+async def cleanup(client, prefix, vcon_ids, chunk_size=500):
+    keys = [key async for key in client.scan_iter(match=f"{prefix}*")]
+    keys.extend(f"vcon:{vcon_id}" for vcon_id in vcon_ids)
+    for start in range(0, len(keys), chunk_size):
+        await client.delete(*keys[start:start + chunk_size])
+
+
+async def run_benchmark(args):
+    conserver_client, client = create_clients(args.redis_url, args.fakeredis)
+    # Route the conserver through the round trip counting client
+    redis_mgr.get_client = lambda: conserver_client
+
+    prefix = f"benchmark:{uuid.uuid4().hex[:8]}:"
+    ingress_list = f"{prefix}ingress"
+    egress_list = f"{prefix}egress"
+    plan = build_plan(args, ingress_list, egress_list)
+
+    vcons = [vcon_fixture.generate_mock_vcon() for _ in range(args.vcons)]
+    vcon_ids = [vcon["uuid"] for vcon in vcons]
+    await store_vcons(client, vcons)
+
+    stop_event = asyncio.Event()
+    workers = asyncio.create_task(main_loop.run_plan_workers(plan, stop_event))
+    pushed_at = {}
+    try:
+        reset_round_trips()
+        started = time.perf_counter()
+        feeder = asyncio.create_task(feed(client, ingress_list, vcon_ids, args.rate, pushed_at))
+        latencies, finished = await collect(client, egress_list, pushed_at, len(vcon_ids), args.timeout)
+        await feeder
+        round_trips = get_round_trips()
+    finally:
+        stop_event.set()
+        await workers
+        await cleanup(client, prefix, vcon_ids)
+
+    elapsed = finished - started
+    link_stats = main_loop.get_link_stats()
+    return {
+        "vcons": len(vcon_ids),
+        "completed": len(latencies),
+        "elapsed_seconds": round(elapsed, 3),
+        "throughput_per_second": round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        "latency_ms": latency_summary(latencies),
+        "link_mean_ms": {
+            name: round(stats["seconds"] / stats["processed"] * 1000, 3)
+            for name, stats in link_stats.items() if stats["processed"]
+        },
+        "round_trips_per_vcon": round(round_trips / len(latencies), 2) if latencies else None,
+    }
+
+
+def print_report(report):
+    print(f"vCons:                {report['completed']} of {report['vcons']}")
+    print(f"elapsed:              {report['elapsed_seconds']} s")
+    print(f"throughput:           {report['throughput_per_second']} vCons/s")
+    latency = report["latency_ms"]
+    print(
+        f"latency (ms):         p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}"
+    )
+    for name, mean_ms in report["link_mean_ms"].items():
+        print(f"link {name + ' (ms):':15} {mean_ms}")
+    print(f"round trips per vCon: {report['round_trips_per_vcon']}")
+
+
+def main():
+    args = parse_args()
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+    report = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
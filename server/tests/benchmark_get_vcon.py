@@ -0,0 +1,94 @@
+"""
+Latency benchmark of GET /vcon/{uuid} on large vCons.
+
+Compares, for each read of a vCon from redis, the previous path:
+
+    r.json().get parses the JSON text redis replies with into a dict, and
+    JSONResponse encodes the dict again with the stdlib json module
+
+with the raw passthrough get_vcon now uses, where the JSON text of the
+JSON.GET reply is the body of the response as is.  Each read is timed from
+the request to redis to the rendered body, and the p50/p95/p99 latencies of
+the two paths are reported.
+
+    python tests/benchmark_get_vcon.py --body-kb 4096 --reads 200
+"""
+import argparse
+import asyncio
+import base64
+import os
+import time
+import uuid
+
+from benchmark_utils import create_clients, latency_summary
+import vcon_fixture
+
+from fastapi.responses import JSONResponse, Response
+from lib.redis_cluster import vcon_key
+from settings import REDIS_URL
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--vcons", type=int, default=10, help="vCons stored and read in turn")
+    parser.add_argument("--reads", type=int, default=200, help="reads timed per path")
+    parser.add_argument("--body-kb", type=int, default=2048, help="size of an inline recording added to each vCon")
+    parser.add_argument("--redis-url", default=REDIS_URL)
+    parser.add_argument("--fakeredis", action="store_true", help="run against fakeredis instead of REDIS_URL")
+    return parser.parse_args()
+
+
+def make_vcon(body_kb):
+    vcon_dict = vcon_fixture.generate_mock_vcon()
+    vcon_dict["uuid"] = str(uuid.uuid4())
+    if body_kb:
+        vcon_dict["dialog"][0]["body"] = base64.urlsafe_b64encode(os.urandom(body_kb * 1024)).decode("utf-8")
+        vcon_dict["dialog"][0]["encoding"] = "base64url"
+    return vcon_dict
+
+
+async def read_before(r, key):
+    vcon = await r.json().get(key)
+    return JSONResponse(content=vcon).body
+
+
+async def read_after(r, key):
+    vcon = await r.execute_command("JSON.GET", key)
+    return Response(content=vcon, media_type="application/json").body
+
+
+async def run(args):
+    r, setup = create_clients(args.redis_url, args.fakeredis)
+    keys = []
+    for _ in range(args.vcons):
+        vcon_dict = make_vcon(args.body_kb)
+        key = vcon_key(vcon_dict["uuid"])
+        await setup.json().set(key, "$", vcon_dict)
+        keys.append(key)
+
+    try:
+        size = len(await read_after(r, keys[0]))
+        print(f"vCon size: {size / 1024:.1f} KB, {args.reads} reads per path")
+        print(f"{'path':8} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+        results = {}
+        for path, read in (("before", read_before), ("after", read_after)):
+            latencies = []
+            for i in range(args.reads):
+                started = time.perf_counter()
+                await read(r, keys[i % len(keys)])
+                latencies.append(time.perf_counter() - started)
+            summary = latency_summary(latencies)
+            results[path] = summary["p99"]
+            print(f"{path:8} {summary['p50']:10.3f} {summary['p95']:10.3f} {summary['p99']:10.3f} {summary['max']:10.3f}")
+        if results["after"]:
+            print(f"p99 speedup: {results['before'] / results['after']:.2f}x")
+    finally:
+        await setup.delete(*keys)
+
+
+def main():
+    asyncio.run(run(parse_args()))
+
+
+if __name__ == "__main__":
+    main()
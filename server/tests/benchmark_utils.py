@@ -0,0 +1,84 @@
+"""
+Helpers shared by the benchmark scripts in this directory.
+
+The benchmarks run against a local Redis Stack (REDIS_URL), or against
+fakeredis with --fakeredis, which needs `pip install 'fakeredis[json]'`.
+"""
+import math
+import os
+import sys
+
+# The benchmarks are run as scripts, make the server modules importable,
+# and the repository root, as pytest.ini does, for the links and storages
+# importing them through the server package
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVER_DIR, os.path.dirname(SERVER_DIR)]
+
+from redis.asyncio.client import Pipeline, Redis  # noqa: E402
+
+round_trips = {"count": 0}
+
+
+class CountingPipeline(Pipeline):
+    """Pipeline counting one round trip per execute"""
+
+    async def execute(self, raise_on_error=True):
+        if self.command_stack:
+            round_trips["count"] += 1
+        return await super().execute(raise_on_error)
+
+
+class RoundTripCounter:
+    """Mixin counting the round trips a redis client makes to the server"""
+
+    async def execute_command(self, *args, **options):
+        round_trips["count"] += 1
+        return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class CountingRedis(RoundTripCounter, Redis):
+    pass
+
+
+def reset_round_trips():
+    round_trips["count"] = 0
+
+
+def get_round_trips():
+    return round_trips["count"]
+
+
+def create_clients(redis_url, use_fakeredis=False):
+    """Returns a round trip counting client for the code under test, and a
+    plain client on the same data for the benchmark's own traffic."""
+    if use_fakeredis:
+        try:
+            from fakeredis import FakeServer
+            from fakeredis.aioredis import FakeRedis
+        except ImportError:
+            sys.exit("--fakeredis needs the fakeredis package: pip install 'fakeredis[json]'")
+        server = FakeServer()
+        counting_class = type("CountingFakeRedis", (RoundTripCounter, FakeRedis), {})
+        return counting_class(server=server), FakeRedis(server=server)
+    return CountingRedis.from_url(redis_url), Redis.from_url(redis_url)
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of values, None if there are none"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = math.ceil(pct / 100 * len(ordered))
+    return ordered[max(0, min(len(ordered), rank) - 1)]
+
+
+def latency_summary(seconds):
+    """p50, p95, p99 and max of latencies in seconds, in milliseconds"""
+    summary = {}
+    for name, pct in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100)):
+        value = percentile(seconds, pct)
+        summary[name] = round(value * 1000, 3) if value is not None else None
+    return summary
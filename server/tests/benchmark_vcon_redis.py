@@ -0,0 +1,96 @@
+"""
+CPU and allocation benchmark of the vCon (de)serialization done by VconRedis.
+
+Compares, for one store and one get of a vCon, the previous path:
+
+    store: json.loads(vCon.dumps()), then redis-py serializes the dict again
+    get:   redis-py parses the reply, json.dumps of the dict, then Vcon.loads
+           parses it once more
+
+with the Vcon.to_dict / Vcon.from_dict path VconRedis now uses, where the vCon
+is serialized or parsed once, by redis-py.  Redis itself is left out, the wire
+encoding is done with the same json module redis-py uses.
+
+    python tests/benchmark_vcon_redis.py --body-kb 2048 --iterations 50
+"""
+import argparse
+import base64
+import json
+import os
+import time
+import tracemalloc
+
+import vcon
+import vcon_fixture
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100, help="operations timed per path")
+    parser.add_argument("--body-kb", type=int, default=0, help="size of an inline recording added to the vCon")
+    return parser.parse_args()
+
+
+def make_vcon(body_kb):
+    vcon_dict = vcon_fixture.generate_mock_vcon()
+    if body_kb:
+        vcon_dict["dialog"][0]["body"] = base64.urlsafe_b64encode(os.urandom(body_kb * 1024)).decode("utf-8")
+        vcon_dict["dialog"][0]["encoding"] = "base64url"
+    return vcon.Vcon.from_dict(vcon_dict)
+
+
+def store_before(vCon):
+    return json.dumps(json.loads(vCon.dumps()))
+
+
+def store_after(vCon):
+    return json.dumps(vCon.to_dict())
+
+
+def get_before(wire):
+    vcon_dict = json.loads(wire)
+    vCon = vcon.Vcon()
+    vCon.loads(json.dumps(vcon_dict))
+    return vCon
+
+
+def get_after(wire):
+    return vcon.Vcon.from_dict(json.loads(wire))
+
+
+def measure(operation, argument, iterations):
+    """Returns the CPU milliseconds per call, and the peak bytes allocated
+    during one call"""
+    started = time.process_time()
+    for _ in range(iterations):
+        operation(argument)
+    cpu_ms = (time.process_time() - started) / iterations * 1000
+
+    tracemalloc.start()
+    operation(argument)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return cpu_ms, peak
+
+
+def main():
+    args = parse_args()
+    vCon = make_vcon(args.body_kb)
+    wire = store_after(vCon)
+    print(f"vCon size: {len(wire) / 1024:.1f} KB, {args.iterations} iterations")
+    print(f"{'operation':12} {'path':8} {'cpu ms/op':>10} {'peak KB':>10}")
+    for name, before, after, argument in (
+        ("store_vcon", store_before, store_after, vCon),
+        ("get_vcon", get_before, get_after, wire),
+    ):
+        results = {}
+        for path, operation in (("before", before), ("after", after)):
+            cpu_ms, peak = measure(operation, argument, args.iterations)
+            results[path] = cpu_ms
+            print(f"{name:12} {path:8} {cpu_ms:10.3f} {peak / 1024:10.1f}")
+        if results["after"]:
+            print(f"{name:12} {'speedup':8} {results['before'] / results['after']:10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,13 @@
 from fastapi.testclient import TestClient
 from vcon_fixture import generate_mock_vcon
+import gzip
+import json
 import pytest
+import redis
 import api
+from lib import vcon_index
+from lib.chain_queue import dead_letter_list_name
+from settings import REDIS_URL
 
 
 def post_vcon(vcon):
@@ -62,3 +68,136 @@ def test_get_vcons():
             response = client.delete("/vcon/{}".format(vcon_id))
             assert response.status_code == 204
             print(f"API response for {vcon_id}: {response}")
+
+
+@pytest.mark.anyio
+def test_dead_letter_replay():
+    r = redis.Redis.from_url(REDIS_URL)
+    ingress_list = "test_dead_letter_ingress"
+    dead_letter_list = dead_letter_list_name(ingress_list)
+    r.delete(ingress_list, dead_letter_list)
+    r.lpush(dead_letter_list, "first", "second")
+
+    with TestClient(api.app) as client:
+        response = client.get("/dead_letter", params={"ingress_list": ingress_list})
+        assert response.status_code == 200
+        assert response.json() == ["second", "first"]
+
+        # The oldest failure is replayed first
+        response = client.post("/dead_letter/replay", params={"ingress_list": ingress_list})
+        assert response.status_code == 200
+        assert response.json() == ["first", "second"]
+
+    assert r.llen(dead_letter_list) == 0
+    assert r.lrange(ingress_list, 0, -1) == [b"second", b"first"]
+    r.delete(ingress_list)
+
+
+@pytest.mark.anyio
+def test_post_vcons():
+    r = redis.Redis.from_url(REDIS_URL)
+    ingress_list = "test_post_vcons_ingress"
+    r.delete(ingress_list)
+    vcons = [generate_mock_vcon() for i in range(3)]
+    body = "\n".join([json.dumps(vcons[0]), "not json", json.dumps({"vcon": "0.0.1"})] + [json.dumps(vcon) for vcon in vcons[1:]])
+
+    with TestClient(api.app) as client:
+        response = client.post("/vcons", params={"ingress_list": ingress_list}, content=body)
+        assert response.status_code == 200
+        statuses = {status["index"]: status for status in map(json.loads, response.text.splitlines())}
+        assert [statuses[index]["status"] for index in range(5)] == [201, 400, 422, 201, 201]
+        assert statuses[3]["uuid"] == vcons[1]["uuid"]
+
+        for vcon in vcons:
+            response = client.get("/vcon/{}".format(vcon["uuid"]))
+            assert response.status_code == 200
+            client.delete("/vcon/{}".format(vcon["uuid"]))
+
+    assert sorted(r.lrange(ingress_list, 0, -1)) == sorted(vcon["uuid"].encode() for vcon in vcons)
+    r.delete(ingress_list)
+
+
+@pytest.mark.anyio
+def test_post_vcons_errors(monkeypatch):
+    def fail(*args, **kwargs):
+        raise ValueError("no index")
+
+    monkeypatch.setattr(vcon_index, "VCON_INDEX_ENABLED", True)
+    monkeypatch.setattr(vcon_index, "queue_index_update", fail)
+    vcons = [generate_mock_vcon() for i in range(2)]
+    vcons[0]["created_at"] = "yesterday"
+    vcons[1]["created_at"] = "2023-04-15T00:00:00Z"
+    body = "\n".join(json.dumps(vcon) for vcon in vcons)
+
+    with TestClient(api.app) as client:
+        response = client.post("/vcons", content=body)
+        assert response.status_code == 200
+        statuses = [json.loads(line) for line in response.text.splitlines()]
+        assert [status["status"] for status in statuses] == [422, 201]
+        # Stored, only missing from the indexes
+        assert statuses[1]["index_error"] == "no index"
+        assert client.get("/vcon/{}".format(vcons[0]["uuid"])).status_code == 404
+        assert client.get("/vcon/{}".format(vcons[1]["uuid"])).status_code == 200
+        client.delete("/vcon/{}".format(vcons[1]["uuid"]))
+
+
+@pytest.mark.anyio
+def test_batch_get():
+    vcons = [generate_mock_vcon() for i in range(2)]
+    for vcon in vcons:
+        post_vcon(vcon)
+    missing = "00000000-0000-0000-0000-000000000000"
+
+    with TestClient(api.app) as client:
+        response = client.post("/vcon/batch_get", json=[vcons[0]["uuid"], missing, vcons[1]["uuid"]])
+        assert response.status_code == 200
+        fetched = response.json()
+        assert [vcon and vcon["uuid"] for vcon in fetched] == [vcons[0]["uuid"], None, vcons[1]["uuid"]]
+
+        for vcon in vcons:
+            client.delete("/vcon/{}".format(vcon["uuid"]))
+
+
+@pytest.mark.anyio
+def test_export():
+    vcons = [generate_mock_vcon() for i in range(3)]
+    for day, vcon in enumerate(vcons):
+        vcon["created_at"] = "1999-01-0{}T00:00:00".format(day + 1)
+        post_vcon(vcon)
+    params = {"since": "1999-01-01T00:00:00", "until": "1999-01-03T00:00:00"}
+
+    with TestClient(api.app) as client:
+        response = client.get("/vcon/export", params={**params, "limit": 2})
+        assert response.status_code == 200
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [vcon["uuid"] for vcon in lines[:2]] == [vcons[0]["uuid"], vcons[1]["uuid"]]
+
+        # Resume after the first two
+        response = client.get("/vcon/export", params={**params, "cursor": lines[2]["next_cursor"], "compression": "gzip"})
+        assert response.status_code == 200
+        lines = [json.loads(line) for line in gzip.decompress(response.content).splitlines()]
+        assert [vcon["uuid"] for vcon in lines] == [vcons[2]["uuid"]]
+
+        for vcon in vcons:
+            client.delete("/vcon/{}".format(vcon["uuid"]))
+
+
+@pytest.mark.anyio
+def test_get_vcons_cursor():
+    vcons = [generate_mock_vcon() for i in range(3)]
+    for day, vcon in enumerate(vcons):
+        vcon["created_at"] = "1998-01-0{}T00:00:00".format(day + 1)
+        post_vcon(vcon)
+    params = {"since": "1997-12-31T00:00:00", "until": "1998-01-04T00:00:00", "size": 2}
+
+    with TestClient(api.app) as client:
+        response = client.get("/vcon", params={**params, "cursor": ""})
+        assert response.status_code == 200
+        first = response.json()
+        assert first["uuids"] == [vcons[2]["uuid"], vcons[1]["uuid"]]
+
+        response = client.get("/vcon", params={**params, "cursor": first["next_cursor"]})
+        assert response.json() == {"uuids": [vcons[0]["uuid"]], "next_cursor": None}
+
+        for vcon in vcons:
+            client.delete("/vcon/{}".format(vcon["uuid"]))
@@ -0,0 +1,197 @@
+import asyncio
+import uuid
+import redis.asyncio as redis
+from lib.chain_plan import ChainPlan, compile_plan
+from lib.chain_queue import ReliableQueue, StreamQueue, count_entries_after, push_stream, stream_backlog
+from settings import REDIS_URL
+
+
+def run_with_list(test):
+    """Run test(r, ingress_list) on a fresh ingress list, removing its keys after"""
+    async def run():
+        r = redis.from_url(REDIS_URL)
+        ingress_list = f"test_chain_queue_{uuid.uuid4()}"
+        try:
+            return await test(r, ingress_list)
+        finally:
+            keys = [key async for key in r.scan_iter(match=f"{ingress_list}*")]
+            if keys:
+                await r.delete(*keys)
+            await r.close()
+    return asyncio.run(run())
+
+
+def test_reliable_queue_claim_ack():
+    async def claim_ack(r, ingress_list):
+        await r.rpush(ingress_list, "a", "b", "c")
+        queue = ReliableQueue(r, ingress_list, "w1", visibility_timeout=30)
+        vcon_ids = await queue.claim_batch(2)
+        assert vcon_ids == ["a", "b"]
+        assert sorted(await r.lrange(queue.processing_list, 0, -1)) == [b"a", b"b"]
+        assert await r.zcard(queue.inflight_key) == 2
+        assert await r.hget(queue.owners_key, "a") == queue.processing_list.encode()
+        assert await r.hget(queue.attempts_key, "a") == b"1"
+
+        await queue.ack("a")
+        assert await r.lrange(queue.processing_list, 0, -1) == [b"b"]
+        assert await r.zscore(queue.inflight_key, "a") is None
+        assert await r.hget(queue.owners_key, "a") is None
+        assert await r.hget(queue.attempts_key, "a") is None
+        assert await r.lrange(ingress_list, 0, -1) == [b"c"]
+
+    run_with_list(claim_ack)
+
+
+def test_reliable_queue_retry_then_dead_letter():
+    async def retry(r, ingress_list):
+        await r.rpush(ingress_list, "a")
+        queue = ReliableQueue(r, ingress_list, "w1", visibility_timeout=30, max_attempts=2)
+
+        assert await queue.claim() == "a"
+        await queue.fail("a")
+        # Put back on the ingress list for another attempt
+        assert await r.lrange(ingress_list, 0, -1) == [b"a"]
+        assert await r.lrange(queue.processing_list, 0, -1) == []
+        assert await r.hget(queue.attempts_key, "a") == b"1"
+
+        assert await queue.claim() == "a"
+        assert await r.hget(queue.attempts_key, "a") == b"2"
+        await queue.fail("a")
+        # max_attempts reached, parked on the dead letter list
+        assert await r.lrange(ingress_list, 0, -1) == []
+        assert await r.lrange(f"{ingress_list}:dead_letter", 0, -1) == [b"a"]
+        assert await r.hget(queue.attempts_key, "a") is None
+        assert await r.zcard(queue.inflight_key) == 0
+
+    run_with_list(retry)
+
+
+def test_reliable_queue_requeue_expired():
+    async def requeue(r, ingress_list):
+        await r.rpush(ingress_list, "a", "b")
+        stalled = ReliableQueue(r, ingress_list, "w1", visibility_timeout=0)
+        other = ReliableQueue(r, ingress_list, "w2", visibility_timeout=30)
+        assert await stalled.claim_batch(1) == ["a"]
+        assert await other.claim_batch(1) == ["b"]
+
+        # Only a is past its visibility deadline, released from the
+        # processing list of its owner rather than that of the caller
+        assert await other.requeue_expired() == 1
+        assert await r.lrange(stalled.processing_list, 0, -1) == []
+        assert await r.lrange(other.processing_list, 0, -1) == [b"b"]
+        assert await r.lrange(ingress_list, 0, -1) == [b"a"]
+        assert await r.hget(stalled.owners_key, "a") is None
+        assert await r.hget(stalled.attempts_key, "a") == b"1"
+        assert await other.requeue_expired() == 0
+
+    run_with_list(requeue)
+
+
+def test_reliable_queue_recover():
+    async def recover(r, ingress_list):
+        await r.rpush(ingress_list, "a", "b")
+        crashed = ReliableQueue(r, ingress_list, "w1", visibility_timeout=30)
+        assert await crashed.claim_batch(2) == ["a", "b"]
+
+        # The same worker restarted
+        restarted = ReliableQueue(r, ingress_list, "w1", visibility_timeout=30)
+        assert await restarted.recover() == 2
+        assert await r.lrange(restarted.processing_list, 0, -1) == []
+        assert sorted(await r.lrange(ingress_list, 0, -1)) == [b"a", b"b"]
+        assert await r.zcard(restarted.inflight_key) == 0
+        assert await r.hlen(restarted.owners_key) == 0
+
+    run_with_list(recover)
+
+
+def test_stream_queue_claim_ack():
+    async def claim_ack(r, ingress_list):
+        await push_stream(r, ingress_list, ["a", "b", "c"])
+        queue = StreamQueue(r, ingress_list, "chain", "c1", visibility_timeout=30)
+        # No group yet, the whole stream is backlog
+        assert await stream_backlog(r, ingress_list, "chain") == 3
+        assert await queue.claim_batch(2) == ["a", "b"]
+        assert (await r.xpending(queue.stream, "chain"))["pending"] == 2
+        assert await stream_backlog(r, ingress_list, "chain") == 1
+
+        await queue.ack("a", "b")
+        assert (await r.xpending(queue.stream, "chain"))["pending"] == 0
+        # The acknowledged entries stay in the stream but are not backlog
+        assert await r.xlen(queue.stream) == 3
+        assert await stream_backlog(r, ingress_list, "chain") == 1
+        last_delivered = (await r.xinfo_groups(queue.stream))[0]["last-delivered-id"]
+        assert await count_entries_after(r, queue.stream, last_delivered, page_size=1) == 1
+
+    run_with_list(claim_ack)
+
+
+def test_stream_queue_reclaim_then_dead_letter():
+    async def reclaim(r, ingress_list):
+        await push_stream(r, ingress_list, ["a"])
+        stalled = StreamQueue(r, ingress_list, "chain", "c1", visibility_timeout=0, max_attempts=2)
+        other = StreamQueue(r, ingress_list, "chain", "c2", visibility_timeout=0, max_attempts=2)
+
+        assert await stalled.claim_batch(1) == ["a"]
+        await stalled.fail("a")
+        # Left pending for another consumer to claim
+        assert (await r.xpending(stalled.stream, "chain"))["pending"] == 1
+
+        assert await other.requeue_expired() == 1
+        assert await other.claim_batch(1) == ["a"]
+        pending = await r.xpending_range(other.stream, "chain", "-", "+", 1)
+        assert pending[0]["consumer"] == b"c2"
+        assert pending[0]["times_delivered"] == 2
+
+        await other.fail("a")
+        # Delivered max_attempts times, parked on the dead letter list
+        assert await r.lrange(f"{ingress_list}:dead_letter", 0, -1) == [b"a"]
+        assert (await r.xpending(other.stream, "chain"))["pending"] == 0
+
+    run_with_list(reclaim)
+
+
+def test_stream_queue_requeue_expired_cursor():
+    async def requeue(r, ingress_list):
+        await push_stream(r, ingress_list, ["a", "b", "c"])
+        stalled = StreamQueue(r, ingress_list, "chain", "c1", visibility_timeout=0)
+        other = StreamQueue(r, ingress_list, "chain", "c2", visibility_timeout=0)
+        assert await stalled.claim_batch(3) == ["a", "b", "c"]
+
+        # The second pass goes on after the entries of the first
+        assert await other.requeue_expired(limit=2) == 2
+        assert await other.requeue_expired(limit=2) == 1
+        assert await other.claim_batch(3) == ["a", "b", "c"]
+        assert other.autoclaim_cursor in (b"0-0", "0-0")
+
+    run_with_list(requeue)
+
+
+def test_stream_lists_of_unloadable_chain():
+    plan = compile_plan({
+        "links": {"missing": {"module": "no_such_module"}},
+        "chains": {
+            "streamed": {"links": ["missing"], "ingress_lists": ["in"], "egress_lists": ["out"], "transport": "stream"},
+            "listed": {"links": [], "ingress_lists": ["other"]},
+        },
+    }, 1)
+    assert plan["stream_lists"] == ["in", "out"]
+    # The chain cannot be loaded, its lists are still carried by streams
+    chain_plan = ChainPlan(plan)
+    assert "streamed" not in chain_plan.chains
+    assert chain_plan.stream_lists == {"in", "out"}
+
+
+def test_stream_queue_recover():
+    async def recover(r, ingress_list):
+        await push_stream(r, ingress_list, ["a", "b"])
+        crashed = StreamQueue(r, ingress_list, "chain", "c1", visibility_timeout=30)
+        assert await crashed.claim_batch(2) == ["a", "b"]
+
+        # The same consumer restarted gets its pending entries first
+        restarted = StreamQueue(r, ingress_list, "chain", "c1", visibility_timeout=30)
+        assert await restarted.recover() == 2
+        assert await restarted.claim_batch(5) == ["a", "b"]
+        await restarted.ack("a", "b")
+        assert (await r.xpending(restarted.stream, "chain"))["pending"] == 0
+
+    run_with_list(recover)
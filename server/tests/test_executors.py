@@ -0,0 +1,57 @@
+import asyncio
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+from lib.chain_plan import ChainPlan
+from lib.executors import get_thread_pool_stats, run_step, shutdown_executors
+
+
+def test_hung_storage_only_uses_its_own_threads():
+    release = threading.Event()
+
+    async def save_vcon(vCon, opts):
+        release.wait(5)
+
+    async def run_vcon(vCon, opts):
+        return vCon
+
+    module = SimpleNamespace(save_vcon=save_vcon, run_vcon=run_vcon)
+    storage = SimpleNamespace(module=module, executor="thread", options={}, thread_pool=("storage:hung", 1))
+    link = SimpleNamespace(module=module, executor="thread", options={}, thread_pool=("default", 1))
+
+    async def run():
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(run_step(storage, "save_vcon", "vcon"), 0.1)
+        # The timed out save still holds the only thread of the storage
+        busy = get_thread_pool_stats()["storage:hung"]["busy"]
+        returned = await asyncio.wait_for(run_step(link, "run_vcon", "vcon"), 1)
+        release.set()
+        return busy, returned
+
+    try:
+        busy, returned = asyncio.run(run())
+        assert busy == 1
+        assert returned == "vcon"
+        for _ in range(50):
+            if not get_thread_pool_stats()["storage:hung"]["busy"]:
+                break
+            time.sleep(0.01)
+        assert get_thread_pool_stats()["storage:hung"] == {"threads": 1, "busy": 0}
+    finally:
+        release.set()
+        shutdown_executors()
+
+
+def test_vcon_paths_rejected_on_process():
+    plan = ChainPlan({
+        "links": {
+            "partial": {"module": "json", "executor": "process", "vcon_paths": ["analysis"]},
+            "full": {"module": "json", "executor": "process"},
+        },
+        "chains": {
+            "partial_chain": {"links": ["partial"]},
+            "full_chain": {"links": ["full"]},
+        },
+    })
+    assert list(plan.chains) == ["full_chain"]
@@ -0,0 +1,52 @@
+import asyncio
+import pytest
+from lib.json_stream import JsonStreamError, iter_json_items
+
+
+async def chunked(data, size):
+    data = data.encode("utf-8")
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+
+def parse(data, size=3, max_item_bytes=1000):
+    async def collect():
+        return [item async for item in iter_json_items(chunked(data, size), max_item_bytes)]
+    return asyncio.run(collect())
+
+
+def test_ndjson():
+    items = parse('{"a": 1}\n\nnot json\n{"b": "é"}')
+    assert items[0] == (0, {"a": 1})
+    assert isinstance(items[1][1], ValueError)
+    assert items[2] == (2, {"b": "é"})
+
+
+def test_json_array():
+    assert parse(' [{"a": 1}, {"b": [1, 2]}]\n') == [(0, {"a": 1}), (1, {"b": [1, 2]})]
+
+
+def test_json_array_invalid():
+    with pytest.raises(JsonStreamError):
+        parse('[{"a": 1}, {"b"')
+    with pytest.raises(JsonStreamError):
+        parse('[{"a": "' + "x" * 100 + '"}]', max_item_bytes=50)
+
+
+def test_json_array_strings_and_scalars():
+    data = '[{"a": "}]\\"{", "b": [1, {"c": "\\\\"}]}, "x]", 1.5, true, null]'
+    for size in (1, 2, 5, 100):
+        assert parse(data, size=size) == [
+            (0, {"a": '}]"{', "b": [1, {"c": "\\"}]}), (1, "x]"), (2, 1.5), (3, True), (4, None),
+        ]
+    with pytest.raises(JsonStreamError):
+        parse('[{"a": 1}] {"b": 2}')
+
+
+def test_max_item_bytes_counts_bytes():
+    # 30 characters, 60 bytes of UTF-8
+    document = '{"a": "' + "é" * 30 + '"}'
+    with pytest.raises(JsonStreamError):
+        parse(document, size=10, max_item_bytes=50)
+    with pytest.raises(JsonStreamError):
+        parse("[" + document + "]", size=10, max_item_bytes=50)
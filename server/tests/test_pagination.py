@@ -0,0 +1,24 @@
+import pytest
+from datetime import datetime
+from lib.pagination import cursor_datetime, decode_cursor, encode_cursor
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor(1681516800.0, "0f3a5b8e-1111-2222-3333-444455556666")
+    assert "=" not in cursor
+    assert decode_cursor(cursor) == (1681516800.0, "0f3a5b8e-1111-2222-3333-444455556666")
+
+
+def test_datetime_cursor_keeps_microseconds():
+    created_at = datetime(2023, 4, 15, 0, 0, 0, 999999)
+    position, vcon_uuid = decode_cursor(encode_cursor(created_at, "0f3a5b8e-1111-2222-3333-444455556666"))
+    assert position == created_at
+    assert cursor_datetime(position) is position
+    assert vcon_uuid == "0f3a5b8e-1111-2222-3333-444455556666"
+
+
+def test_invalid_cursor():
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
+    with pytest.raises(ValueError):
+        decode_cursor(encode_cursor(1, "x")[:-4])
@@ -0,0 +1,362 @@
+import asyncio
+import copy
+import time
+from datetime import datetime, timezone
+import pytest
+import redis.asyncio as redis
+import vcon
+from lib import redis_cluster, vcon_index
+from lib.redis_cluster import vcon_id_from_key
+from lib.vcon_cache import VconCache
+from lib.vcon_expiry import EXPIRY_SET_KEY, expire_vcon, reap_expired_vcons
+from lib.vcon_index import (
+    REBUILD_PROGRESS_KEY, created_at_timestamp, get_rebuild_progress, index_key, remove_vcon_indexes, search_vcons,
+    start_rebuild, vcon_index_keys,
+)
+from lib.vcon_redis import (
+    PartialVcon, UnloadedVconSection, VconRedis, parse_vcon_paths, set_element_field, transfer_snapshot,
+    vcon_changes,
+)
+from settings import REDIS_URL, VCON_SORTED_SET_NAME
+from vcon_fixture import generate_mock_vcon
+
+
+def test_vcon_changes_append():
+    snapshot = generate_mock_vcon()
+    current = copy.deepcopy(snapshot)
+    current["analysis"].append({"type": "tags", "dialog": 0, "body": ["iron", "maiden"]})
+    current["subject"] = "test"
+
+    changes = vcon_changes(snapshot, current)
+    assert ("arrappend", "$.analysis", [current["analysis"][-1]]) in changes
+    assert ("set", "$.subject", ["test"]) in changes
+    assert len(changes) == 2
+
+
+def test_vcon_changes_in_place():
+    snapshot = generate_mock_vcon()
+    current = copy.deepcopy(snapshot)
+    current["parties"][0]["name"] = "Someone Else"
+    del current["redacted"]
+
+    changes = vcon_changes(snapshot, current)
+    assert changes == [
+        ("set", "$.parties[0]", [current["parties"][0]]),
+        ("delete", "$.redacted", []),
+    ]
+    assert vcon_changes(current, copy.deepcopy(current)) == []
+
+
+def test_parse_vcon_paths():
+    assert parse_vcon_paths(["analysis", "dialog.url", "dialog.type"]) == {
+        "analysis": None,
+        "dialog": ["url", "type"],
+    }
+    # A whole section wins over fields of it
+    assert parse_vcon_paths(["dialog.url", "dialog"]) == {"dialog": None}
+    with pytest.raises(ValueError):
+        parse_vcon_paths(["recordings"])
+
+
+def test_partial_vcon():
+    partial_vcon = PartialVcon(["analysis"])
+    partial_vcon._vcon_dict = {"uuid": "1234", "analysis": []}
+    assert partial_vcon.uuid == "1234"
+    assert partial_vcon.analysis == []
+    with pytest.raises(UnloadedVconSection):
+        partial_vcon.dialog
+    with pytest.raises(vcon.InvalidVconState):
+        partial_vcon.add_analysis(0, "tags", ["iron"])
+    with pytest.raises(vcon.InvalidVconState):
+        partial_vcon.dumps()
+
+
+def test_partial_vcon_set_element_field():
+    partial_vcon = PartialVcon(["analysis"])
+    partial_vcon._vcon_dict = {"uuid": "1234", "analysis": [{"type": "summary"}]}
+    set_element_field(partial_vcon, "analysis", 0, "was_posted_to_slack", True)
+    assert partial_vcon.analysis[0]["was_posted_to_slack"] is True
+    assert partial_vcon._updates == [("$.analysis[0].was_posted_to_slack", True)]
+
+    full_vcon = vcon.Vcon.from_dict(generate_mock_vcon())
+    set_element_field(full_vcon, "analysis", 0, "was_posted_to_slack", True)
+    assert full_vcon.analysis[0]["was_posted_to_slack"] is True
+
+
+def test_post_analysis_to_slack_partial_vcon(monkeypatch):
+    pytest.importorskip("slack_sdk")
+    from links import post_analysis_to_slack
+
+    posted = []
+    monkeypatch.setattr(post_analysis_to_slack, "post_blocks_to_channel", lambda *args: posted.append(args))
+    vcon_dict = generate_mock_vcon()
+    vcon_dict["analysis"] = [
+        {"type": "summary", "dialog": 0, "body": "A frustrated customer"},
+        {"type": "customer_frustration", "dialog": 0, "body": "NEEDS REVIEW"},
+    ]
+
+    async def run_partial():
+        r = redis.from_url(REDIS_URL)
+        vcon_redis = VconRedis(redis_client=r)
+        await vcon_redis.store_vcon(vcon.Vcon.from_dict(vcon_dict))
+        try:
+            partial_vcon = await vcon_redis.get_vcon(vcon_dict["uuid"], paths=post_analysis_to_slack.vcon_paths)
+            result = await post_analysis_to_slack.run_vcon(partial_vcon, {"default_channel_name": "alerts"})
+            stored = await vcon_redis.store_partial_vcon(result)
+            return stored, await vcon_redis.get_vcon(vcon_dict["uuid"])
+        finally:
+            await r.delete(f"vcon:{vcon_dict['uuid']}")
+            await r.close()
+
+    stored, full_vcon = asyncio.run(run_partial())
+    assert len(posted) == 1
+    assert stored == 1
+    assert full_vcon.analysis[1]["was_posted_to_slack"] is True
+
+
+def test_store_changes_of_copy():
+    async def store_copy():
+        r = redis.from_url(REDIS_URL)
+        vcon_redis = VconRedis(redis_client=r)
+        vCon = vcon.Vcon.from_dict(generate_mock_vcon())
+        await vcon_redis.store_vcon(vCon)
+        try:
+            loaded = await vcon_redis.get_vcon(vCon.uuid, track_changes=True)
+            # As returned by a link on a process executor
+            returned = vcon.Vcon()
+            returned.loads(loaded.dumps())
+            returned.add_analysis(0, "tags", ["iron", "maiden"])
+            assert transfer_snapshot(loaded, returned)
+            # Dropped by a store of the whole vCon
+            await r.json().set(f"vcon:{vCon.uuid}", "$.marker", 1)
+            changes = await vcon_redis.store_vcon_changes(returned)
+            return changes, await r.json().get(f"vcon:{vCon.uuid}")
+        finally:
+            await r.delete(f"vcon:{vCon.uuid}")
+            await r.close()
+
+    changes, stored = asyncio.run(store_copy())
+    # Only the appended analysis, rather than the whole vCon
+    assert changes == 1
+    assert stored["marker"] == 1
+    assert stored["analysis"][-1]["body"] == ["iron", "maiden"]
+    assert not transfer_snapshot(vcon.Vcon(), vcon.Vcon())
+
+
+def test_get_store_vcons():
+    async def store_and_get():
+        r = redis.from_url(REDIS_URL)
+        vcon_redis = VconRedis(redis_client=r)
+        vcons = [vcon.Vcon.from_dict(generate_mock_vcon()) for _ in range(5)]
+        try:
+            await vcon_redis.store_vcons(vcons, chunk_size=2)
+            vcon_ids = [vCon.uuid for vCon in vcons]
+            fetched = await vcon_redis.get_vcons(vcon_ids[:2] + ["missing"] + vcon_ids[2:], chunk_size=2)
+            return vcon_ids, fetched
+        finally:
+            await r.delete(*[f"vcon:{vCon.uuid}" for vCon in vcons])
+            await r.close()
+
+    vcon_ids, fetched = asyncio.run(store_and_get())
+    assert fetched[2] is None
+    assert [vCon.uuid for vCon in fetched[:2] + fetched[3:]] == vcon_ids
+
+
+def test_vcon_cache_lru():
+    cache = VconCache(max_bytes=10)
+    cache.put("a", 1, b"aaaa")
+    cache.put("b", 1, b"bbbb")
+    assert cache.get("a") == (1, b"aaaa")
+    # b is now the least recently used
+    cache.put("c", 2, b"cccc")
+    assert cache.get("b") is None
+    assert cache.get("a") == (1, b"aaaa")
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 8
+    # Too large to be cached at all
+    cache.put("d", 1, b"d" * 11)
+    assert cache.get("d") is None
+
+
+def test_vcon_index_keys():
+    vcon_dict = generate_mock_vcon()
+    vcon_dict["parties"] = [
+        {"tel": "+15551234567", "mailto": None},
+        {"tel": "", "mailto": "Someone@Example.com"},
+    ]
+    keys = vcon_index_keys(vcon_dict)
+    assert index_key("tel", "+15551234567") in keys
+    assert "vcon_index:mailto:someone@example.com" in keys
+    assert index_key("dialog_type", vcon_dict["dialog"][0]["type"]) in keys
+    # Empty values are not indexed
+    assert "vcon_index:tel:" not in keys
+
+
+def test_created_at_timestamp():
+    assert created_at_timestamp("2023-04-15T00:00:00Z") == 1681516800
+    assert created_at_timestamp("2023-04-15T00:00:00+00:00") == 1681516800
+    assert created_at_timestamp(1681516800) == 1681516800
+    assert created_at_timestamp(datetime(2023, 4, 15, tzinfo=timezone.utc)) == 1681516800
+
+
+def test_store_vcon_index_error(monkeypatch):
+    def fail(*args, **kwargs):
+        raise ValueError("no index")
+
+    monkeypatch.setattr(vcon_index, "VCON_INDEX_ENABLED", True)
+    monkeypatch.setattr(vcon_index, "queue_index_update", fail)
+
+    async def store():
+        r = redis.from_url(REDIS_URL)
+        vcon_redis = VconRedis(redis_client=r)
+        vcons = [vcon.Vcon.from_dict(generate_mock_vcon()) for _ in range(2)]
+        try:
+            # The vCons are stored even though they cannot be indexed
+            await vcon_redis.store_vcon(vcons[0])
+            await vcon_redis.store_vcons(vcons[1:])
+            errors = await vcon_index.update_vcons_indexes(r, [vCon.to_dict() for vCon in vcons])
+            return errors, await r.exists(*[f"vcon:{vCon.uuid}" for vCon in vcons])
+        finally:
+            await r.delete(*[f"vcon:{vCon.uuid}" for vCon in vcons])
+            await r.close()
+
+    errors, exists = asyncio.run(store())
+    assert exists == 2
+    assert [str(error) for error in errors] == ["no index", "no index"]
+
+
+def test_search_vcons(monkeypatch):
+    monkeypatch.setattr(vcon_index, "VCON_INDEX_ENABLED", True)
+
+    async def store_and_search():
+        r = redis.from_url(REDIS_URL)
+        vcon_redis = VconRedis(redis_client=r)
+        vCon = vcon.Vcon.from_dict(generate_mock_vcon())
+        tel = vCon.parties[0]["tel"]
+        dialog_type = vCon.dialog[0]["type"]
+        try:
+            await vcon_redis.store_vcon(vCon)
+            found = await search_vcons(r, {"tel": tel, "dialog_type": dialog_type})
+            missed = await search_vcons(r, {"tel": tel, "dialog_type": "no such type"})
+            await remove_vcon_indexes(r, vCon.uuid)
+            removed = await search_vcons(r, {"tel": tel})
+            return vCon.uuid, found, missed, removed
+        finally:
+            await r.delete(f"vcon:{vCon.uuid}")
+            await r.close()
+
+    vcon_id, found, missed, removed = asyncio.run(store_and_search())
+    assert vcon_id in found
+    assert missed == []
+    assert vcon_id not in removed
+
+
+def test_reap_expired_vcons(monkeypatch):
+    monkeypatch.setattr(vcon_index, "VCON_INDEX_ENABLED", True)
+
+    async def expire_and_reap():
+        r = redis.from_url(REDIS_URL)
+        vcon_redis = VconRedis(redis_client=r)
+        vCon = vcon.Vcon.from_dict(generate_mock_vcon())
+        try:
+            await vcon_redis.store_vcon(vCon)
+            await r.zadd(VCON_SORTED_SET_NAME, {f"vcon:{vCon.uuid}": 0})
+            await expire_vcon(r, vCon.uuid, 60)
+            not_yet = await reap_expired_vcons(r)
+            counts = await reap_expired_vcons(r, now=time.time() + 61)
+            remains = (
+                await r.exists(f"vcon:{vCon.uuid}"),
+                await r.zscore(VCON_SORTED_SET_NAME, f"vcon:{vCon.uuid}"),
+                await r.zscore(EXPIRY_SET_KEY, vCon.uuid),
+                await search_vcons(r, {"tel": vCon.parties[0]["tel"]}),
+            )
+            return vCon, not_yet, counts, remains
+        finally:
+            await r.delete(f"vcon:{vCon.uuid}")
+            await r.close()
+
+    vCon, not_yet, counts, (exists, score, expiry, found) = asyncio.run(expire_and_reap())
+    vcon_id = vCon.uuid
+    assert not_yet["reaped"] == 0
+    assert counts == {
+        "reaped": 1,
+        "vcons": 1,
+        "sorted_set": 1,
+        "indexes": len(vcon_index_keys(vCon.to_dict())),
+    }
+    assert not exists and score is None and expiry is None
+    assert vcon_id not in found
+
+
+def test_vcon_id_from_key():
+    assert vcon_id_from_key(b"vcon:0f3a") == "0f3a"
+    assert vcon_id_from_key("vcon:{0f3a}") == "0f3a"
+
+
+def test_start_rebuild_records_failure():
+    class FailingRedis(redis.Redis):
+        def lock(self, *args, **kwargs):
+            raise RuntimeError("no lock")
+
+    async def rebuild():
+        r = FailingRedis.from_url(REDIS_URL)
+        await r.delete(REBUILD_PROGRESS_KEY)
+        try:
+            task = start_rebuild(r)
+            with pytest.raises(RuntimeError):
+                await task
+            # Let the done callback record the error
+            for _ in range(10):
+                await asyncio.sleep(0.01)
+            return await get_rebuild_progress(r)
+        finally:
+            await r.delete(REBUILD_PROGRESS_KEY)
+            await r.close()
+
+    progress = asyncio.run(rebuild())
+    assert progress["status"] == "failed"
+    assert "no lock" in progress["error"]
+
+
+class ClusterLikeRedis(redis.Redis):
+    """A client without .json(), as the RedisCluster client of redis-py"""
+
+    def json(self, *args, **kwargs):
+        raise AttributeError("json")
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return ClusterLikePipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class ClusterLikePipeline(redis.client.Pipeline):
+    def json(self, *args, **kwargs):
+        raise AttributeError("json")
+
+
+def test_cluster_store_and_get(monkeypatch):
+    monkeypatch.setattr(redis_cluster, "REDIS_CLUSTER", True)
+    monkeypatch.setattr(vcon_index, "REDIS_CLUSTER", True)
+
+    async def store_and_get():
+        r = ClusterLikeRedis.from_url(REDIS_URL)
+        vcon_redis = VconRedis(redis_client=r)
+        vCon = vcon.Vcon.from_dict(generate_mock_vcon())
+        try:
+            await vcon_redis.store_vcon(vCon)
+            loaded = await vcon_redis.get_vcon(vCon.uuid, track_changes=True)
+            loaded.add_analysis(0, "tags", ["iron", "maiden"])
+            await vcon_redis.store_vcon_changes(loaded)
+            partial_vcon = await vcon_redis.get_vcon(vCon.uuid, paths=["analysis", "dialog.url"])
+            fetched = await vcon_redis.get_vcons([vCon.uuid, "missing"])
+            return vCon, partial_vcon, fetched, await r.exists(f"vcon:{{{vCon.uuid}}}")
+        finally:
+            await remove_vcon_indexes(r, vCon.uuid)
+            await r.delete(f"vcon:{{{vCon.uuid}}}")
+            await r.close()
+
+    vCon, partial_vcon, fetched, exists = asyncio.run(store_and_get())
+    # The key carries the hash tag
+    assert exists
+    assert partial_vcon.analysis[-1]["body"] == ["iron", "maiden"]
+    assert [dialog["url"] for dialog in partial_vcon.dialog] == [dialog["url"] for dialog in vCon.dialog]
+    assert fetched[0].uuid == vCon.uuid and fetched[1] is None
@@ -1,7 +1,7 @@
 import pytest
 import json
 import random
-from datetime import datetime
+from datetime import datetime, timezone
 from faker import Faker
 fake = Faker()
 
@@ -17,7 +17,7 @@ def generate_mock_vcon():
         "analysis": [],
         "appended": None,
         "redacted": {},
-        "created_at": fake.iso8601(),
+        "created_at": fake.iso8601(tzinfo=timezone.utc),
         "attachments": []
     }
 
@@ -32,7 +32,7 @@ def generate_mock_vcon():
                 "disposition": random.choice(["ANSWERED","FAILED","NO ANSWER","BUSY"])
             },
             "type": "recording",
-            "start": fake.iso8601(),
+            "start": fake.iso8601(tzinfo=timezone.utc),
             "parties": [0, 1],
             "duration": random.randint(60, 600),
             "encoding": None,
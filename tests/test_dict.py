@@ -0,0 +1,43 @@
+"""
+unit tests for constructing and exporting a vCon as a dict
+"""
+
+import json
+import pytest
+import vcon
+
+def test_to_dict_from_dict() -> None:
+  vCon = vcon.Vcon()
+  vCon.set_uuid("example.com")
+  vCon.set_party_parameter("tel", "+12345678901")
+  vCon.add_analysis(0, "tags", ["iron", "maiden"])
+
+  vcon_dict = vCon.to_dict()
+  assert(vcon_dict == json.loads(vCon.dumps()))
+
+  copy_vcon = vcon.Vcon.from_dict(json.loads(vCon.dumps()))
+  assert(copy_vcon.uuid == vCon.uuid)
+  assert(copy_vcon.parties[0]["tel"] == "+12345678901")
+  assert(copy_vcon.analysis[0]["body"] == ["iron", "maiden"])
+  assert(copy_vcon.dumps() == vCon.dumps())
+
+def test_to_dict_no_uuid() -> None:
+  vCon = vcon.Vcon()
+  with pytest.raises(vcon.InvalidVconState):
+    vCon.to_dict()
+
+def test_from_dict_migrates() -> None:
+  old_dict = {
+    "vcon": "0.0.1",
+    "uuid": "01855517-ac4e-8edc-a0b8-b5b6d5a3a5e8",
+    "analysis": [{"type": "transcript", "dialog": 0, "transcript": "hello"}]
+  }
+  vCon = vcon.Vcon.from_dict(old_dict)
+  assert(vCon.analysis[0]["body"] == "hello")
+  assert(vCon.analysis[0]["encoding"] == "none")
+  assert("transcript" not in vCon.analysis[0])
+
+def test_from_dict_invalid() -> None:
+  with pytest.raises(vcon.InvalidVconJson):
+    vcon.Vcon.from_dict({"foo": "bar"})
+
@@ -822,40 +822,58 @@ class Vcon():
 
     self._vcon_dict[Vcon.ANALYSIS].append(analysis_element)
 
-  def dumps(self, signed = True) -> str:
+  def to_dict(self, signed = True) -> dict:
     """
-    Dump the vCon as a JSON string.
+    Get the vCon as a dict, in the form dumps would serialize, without
+    serializing it.  The returned dict is the vCon's own, not a copy, it
+    must not be modified.
 
     Parameters:
 
     signed (Boolean): If the vCon is signed locally or verfied,
-        True: serialize the signed version
-        False: serialize the unsigned version
+        True: the signed version
+        False: the unsigned version
 
     Returns:
-             String containing JSON representation of the vCon.
+             dict containing the vCon
     """
 
-    # TODO: Should it throw an acception if its not signed?  Could have argument to
-    # not throw if it not signed.
-
     if(self._state == VconStates.UNSIGNED):
       if(self.uuid is None or len(self.uuid) < 1):
         raise InvalidVconState("vCon has no UUID set.  Use set_uuid method.")
 
-      return(json.dumps(self._vcon_dict, default=lambda o: o.__dict__, **dumps_options))
+      return(self._vcon_dict)
 
     if(self._state in [VconStates.SIGNED, VconStates.UNVERIFIED, VconStates.VERIFIED]):
       if(signed is False and self._state != VconStates.UNVERIFIED):
-        return(json.dumps(self._vcon_dict, default=lambda o: o.__dict__, **dumps_options))
-      return(json.dumps(self._jws_dict, default=lambda o: o.__dict__, **dumps_options))
+        return(self._vcon_dict)
+      return(self._jws_dict)
 
     if(self._state in [VconStates.ENCRYPTED, VconStates.DECRYPTED]):
       if(signed is False):
         raise AttributeError("not supported: unsigned JSON output for encrypted vCon")
-      return(json.dumps(self._jwe_dict, default=lambda o: o.__dict__, **dumps_options))
+      return(self._jwe_dict)
 
     raise InvalidVconState("vCon state: {} is not valid for dumps".format(self._state))
+
+  def dumps(self, signed = True) -> str:
+    """
+    Dump the vCon as a JSON string.
+
+    Parameters:
+
+    signed (Boolean): If the vCon is signed locally or verfied,
+        True: serialize the signed version
+        False: serialize the unsigned version
+
+    Returns:
+             String containing JSON representation of the vCon.
+    """
+
+    # TODO: Should it throw an acception if its not signed?  Could have argument to
+    # not throw if it not signed.
+
+    return(json.dumps(self.to_dict(signed), default=lambda o: o.__dict__, **dumps_options))
   
 
   def __str__(self):
@@ -888,12 +906,26 @@ class Vcon():
 
     #TODO: Should check unsafe stuff is not loaded
 
+    self.load_dict(json.loads(vcon_json))
+
+  def load_dict(self, vcon_dict : dict) -> None:
+    """
+    Load the vCon from a dict, such as a parsed JSON vCon.
+    see Vcon.loads for more details.
+
+    The vCon takes ownership of vcon_dict rather than copying it, it must
+    not be used by the caller afterwards.
+
+    Parameters:
+      vcon_dict (dict): the vCon in the form of parsed JSON
+
+    Returns: none
+    """
+
     # TODO should use self._attempting_modify() ???
     if(self._state != VconStates.UNSIGNED):
       raise InvalidVconState("Cannot load Vcon unless current state is UNSIGNED.  Current state: {}".format(self._state))
 
-    vcon_dict = json.loads(vcon_json)
-
     # we need to check the format as to whether it is signed or
     # not and deconstruct the loaded object.
     # load differently based upon the contents of the JSON
@@ -937,6 +969,22 @@ class Vcon():
       raise InvalidVconJson("Not recognized as a unsigned, signed or encrypted JSON vCon")
 
 
+  @classmethod
+  def from_dict(cls, vcon_dict : dict) -> Vcon:
+    """
+    Construct a vCon from a dict, such as a parsed JSON vCon, without
+    serializing and parsing it again.  see Vcon.load_dict for more details.
+
+    Parameters:
+      vcon_dict (dict): the vCon in the form of parsed JSON
+
+    Returns:
+      the new Vcon
+    """
+    new_vcon = cls()
+    new_vcon.load_dict(vcon_dict)
+    return(new_vcon)
+
   def sign(self, private_key_pem_file_name : str, cert_chain_pem_file_names : typing.List[str]) -> None:
     """
     Sign the vcon using the given private key from the give certificate chain.